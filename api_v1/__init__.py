@@ -1,10 +1,25 @@
 from api_v1.ai_translator import AITranslator
+from api_v1.ai_translator_stream import AITranslatorStream
+from api_v1.ai_translator_batch import AITranslatorBatch
+from api_v1.translate_jobs import TranslateJobs, TranslateJob
 from api_v1.human_feedback import HumanFeedback
+from api_v1.feedback_import import FeedbackImport
 from api_v1.support_languages import SupportLanguages
+from api_v1.cache_stats import CacheStats
+from api_v1.rate_limit_stats import RateLimitStats
+from api_v1.engine_stats import EngineStats
 
 
 def register_api_v1(api):
     api.add_resource(AITranslator, "/v1/ai_translate/translate")
+    api.add_resource(AITranslatorStream, "/v1/ai_translate/translate_stream")
+    api.add_resource(AITranslatorBatch, "/v1/ai_translate/translate_batch")
+    api.add_resource(TranslateJobs, "/v1/ai_translate/jobs")
+    api.add_resource(TranslateJob, "/v1/ai_translate/jobs/<string:job_id>")
     api.add_resource(HumanFeedback, "/v1/ai_translate/feedback")
+    api.add_resource(FeedbackImport, "/v1/ai_translate/feedback/import")
     api.add_resource(SupportLanguages, "/v1/ai_translate/languages")
+    api.add_resource(CacheStats, "/v1/ai_translate/cache_stats")
+    api.add_resource(RateLimitStats, "/v1/ai_translate/rate_limit_stats")
+    api.add_resource(EngineStats, "/v1/ai_translate/engine_stats")
 
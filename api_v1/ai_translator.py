@@ -4,46 +4,144 @@ from flask_restful import Resource
 
 sys.path.append(os.path.abspath(os.path.join(__file__, "..", "..")))
 
-from config.config import cfg
+from config.config import cfg, TranslationContext
 from modules.translator import AITranslatorModule
+from modules.document_translator import DocumentTranslatorModule
+from modules.incremental_translator import IncrementalTranslatorModule
+from modules.multi_target_translator import MultiTargetTranslatorModule
+from utils import metrics
+from utils.doc_format import DOC_FORMATS
+from utils.languages import get_language_registry
+
+
+def parse_engine_options(source_lang="English", target_lang="Chinese", payload=None):
+    """
+    解析翻译接口的engine和是否搜索术语参数, 不修改全局cfg
+    :param source_lang: 源语言
+    :param target_lang: 目标语言
+    :param payload: 请求体dict, 默认为flask的request.json
+    :return: TranslationContext, 本次请求的上下文
+    """
+    payload = request.json if payload is None else payload
+    engine = payload.get("engine", "gpt35")
+    is_search_term = payload.get("is_search_term", 0)
+    try:
+        is_search_term = bool(int(is_search_term)) if isinstance(is_search_term, str) else bool(is_search_term)
+    except Exception as e:
+        raise Exception(f"is_search_term must be 0 or 1, DETAIL: {e}")
+    return TranslationContext.create(engine, source_lang, target_lang, is_search_term)
+
+
+def parse_translate_request(payload=None):
+    """
+    解析并校验翻译接口的公共参数
+    :param payload: 请求体dict, 默认为flask的request.json
+    :return: (text, TranslationContext)
+    """
+    payload = request.json if payload is None else payload
+    text = payload.get("text")
+    assert text, "text is required"
+    # 语言可以传语言名、代码或别名, 统一解析成语言名
+    source_lang = get_language_registry().require(payload.get("source_lang", "English"), "source_lang")
+    target_lang = get_language_registry().require(payload.get("target_lang", "Chinese"), "target_lang")
+    ctx = parse_engine_options(source_lang, target_lang, payload)
+    return text, ctx
+
+
+def parse_target_langs(payload=None):
+    """
+    解析一次翻译成多种目标语言的target_langs参数
+    :param payload: 请求体dict, 默认为flask的request.json
+    :return: 去重后的目标语言名列表, 没有传target_langs时返回None
+    """
+    payload = request.json if payload is None else payload
+    target_langs = payload.get("target_langs")
+    if target_langs is None:
+        return None
+    assert isinstance(target_langs, list) and target_langs, "target_langs must be a non-empty list"
+    assert len(target_langs) <= cfg.MULTI_TARGET_MAX, f"target_langs can contain at most {cfg.MULTI_TARGET_MAX} languages"
+    return list(dict.fromkeys(get_language_registry().require(lang, "target_langs") for lang in target_langs))
 
 
 class AITranslator(Resource):
     def post(self):
         """
-        人工智能翻译接口
+        人工智能翻译接口, 请求里timings为1时在返回里带上各阶段的耗时和token数,
+        传target_langs时一次翻译成多种目标语言, data.translations为目标语言 -> 译文,
+        传doc_id时保存这一版的文本块和译文, 同一doc_id再次提交时只翻译改动的部分
         :return:
         """
-        try:
-            text = request.json.get("text")
-            source_lang = request.json.get("source_lang", "English")
-            target_lang = request.json.get("target_lang", "Chinese")
-            cfg.AZURE_GPT_ENGINE = request.json.get("engine", "gpt35")
-            is_search_term = request.json.get("is_search_term", 0)
+        with metrics.collect_timings("translate") as timings:
             try:
-                cfg.IS_SEARCH_TERM_DATA = bool(int(is_search_term)) if isinstance(is_search_term, str) else bool(is_search_term)
+                text, ctx = parse_translate_request()
+                parallel = request.json.get("parallel")
+                doc_format = request.json.get("format", cfg.DEFAULT_DOC_FORMAT)
+                assert doc_format in DOC_FORMATS, f"format must be one of {list(DOC_FORMATS)}"
+                target_langs = parse_target_langs()
+                doc_id = request.json.get("doc_id")
+                if doc_id is not None:
+                    assert isinstance(doc_id, str) and 0 < len(doc_id) <= 256, \
+                        "doc_id must be a non-empty string of at most 256 characters"
+                    assert doc_format == "text" and not target_langs, \
+                        "doc_id only supports format text with a single target_lang"
+                if target_langs:
+                    return self.translate_multi_target(text, ctx, target_langs, parallel, doc_format, timings)
+                versioning = {}
+                if doc_id is not None:
+                    translated, versioning = IncrementalTranslatorModule(ctx=ctx).translate(
+                        doc_id, text, ctx.source_lang, ctx.target_lang, parallel)
+                    versioning["doc_id"] = doc_id
+                elif doc_format == "text":
+                    translated = AITranslatorModule(ctx=ctx).translate(text, ctx.source_lang, ctx.target_lang,
+                                                                       parallel)
+                else:
+                    translated = DocumentTranslatorModule(ctx=ctx).translate(text, ctx.source_lang, ctx.target_lang,
+                                                                             doc_format)
+                result = {
+                    "code": 200,
+                    "message": "success",
+                    "data": {
+                        "text": text,
+                        "translated": translated,
+                        "source_lang": ctx.source_lang,
+                        "target_lang": ctx.target_lang,
+                        **versioning,
+                        "time_cost": round(timings.elapsed(), 3),
+                    }
+                }
+                if request.json.get("timings"):
+                    result["data"]["timings"] = timings.summary()
             except Exception as e:
-                raise Exception(f"is_search_term must be 0 or 1, DETAIL: {e}")
-            assert text, "text is required"
-            assert source_lang in cfg.SUPPORTED_LANGUAGES, f"source_lang must be one of {cfg.SUPPORTED_LANGUAGES}"
-            assert target_lang in cfg.SUPPORTED_LANGUAGES, f"target_lang must be one of {cfg.SUPPORTED_LANGUAGES}"
-            translated, time_cost = AITranslatorModule().translate(text, source_lang, target_lang)
-            result = {
-                "code": 200,
-                "message": "success",
-                "data": {
-                    "text": text,
-                    "translated": translated,
-                    "source_lang": self.source_lang,
-                    "target_lang": self.target_lang,
+                result = {
+                    "code": 500,
+                    "message": f"Translate went wrong, DETAIL: ```{e}```",
+                    "data": {}
                 }
+        return result
+
+    @staticmethod
+    def translate_multi_target(text, ctx, target_langs, parallel, doc_format, timings):
+        """
+        一次翻译成多种目标语言, multi_target_mode为joint或fanout, 默认cfg.MULTI_TARGET_MODE
+        """
+        assert doc_format == "text", "target_langs only supports format text"
+        mode = request.json.get("multi_target_mode") or cfg.MULTI_TARGET_MODE
+        translations = MultiTargetTranslatorModule(ctx=ctx).translate(text, ctx.source_lang, target_langs, mode,
+                                                                      parallel)
+        result = {
+            "code": 200,
+            "message": "success",
+            "data": {
+                "text": text,
+                "translations": translations,
+                "source_lang": ctx.source_lang,
+                "target_langs": target_langs,
+                "multi_target_mode": mode,
+                "time_cost": round(timings.elapsed(), 3),
             }
-        except Exception as e:
-            result = {
-                "code": 500,
-                "message": f"Translate went wrong, DETAIL: ```{e}```",
-                "data": {}
-            }
+        }
+        if request.json.get("timings"):
+            result["data"]["timings"] = timings.summary()
         return result
 
 
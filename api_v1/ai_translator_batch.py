@@ -0,0 +1,46 @@
+from flask import request
+from flask_restful import Resource
+
+from api_v1.ai_translator import parse_engine_options
+from config.config import cfg
+from modules.batch_translator import BatchTranslatorModule
+from utils import metrics
+
+
+class AITranslatorBatch(Resource):
+    def post(self):
+        """
+        批量翻译接口, items里每项可以单独指定source_lang/target_lang, 不指定时用外层的默认值,
+        请求里timings为1时在返回里带上各阶段的耗时和token数
+        :return:
+        """
+        with metrics.collect_timings("translate_batch") as timings:
+            try:
+                items = request.json.get("items")
+                source_lang = request.json.get("source_lang", "English")
+                target_lang = request.json.get("target_lang", "Chinese")
+                ctx = parse_engine_options(source_lang, target_lang)
+                assert isinstance(items, list) and items, "items is required and must be a non-empty list"
+                assert len(items) <= cfg.BATCH_MAX_ITEMS, f"items should be no more than {cfg.BATCH_MAX_ITEMS}"
+                items = [{"source_lang": source_lang, "target_lang": target_lang,
+                          **(item if isinstance(item, dict) else {"text": item})} for item in items]
+                results = BatchTranslatorModule(ctx=ctx).translate_batch(items)
+                result = {
+                    "code": 200,
+                    "message": "success",
+                    "data": {
+                        "items": results,
+                        "total": len(results),
+                        "failed": sum(1 for item in results if item["error"]),
+                        "time_cost": round(timings.elapsed(), 3),
+                    }
+                }
+                if request.json.get("timings"):
+                    result["data"]["timings"] = timings.summary()
+            except Exception as e:
+                result = {
+                    "code": 500,
+                    "message": f"Batch translate went wrong, DETAIL: ```{e}```",
+                    "data": {}
+                }
+        return result
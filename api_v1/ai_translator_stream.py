@@ -0,0 +1,45 @@
+import json
+from flask import request, Response, stream_with_context
+from flask_restful import Resource
+
+from api_v1.ai_translator import parse_translate_request
+from modules.translator import AITranslatorModule
+
+
+class AITranslatorStream(Resource):
+    def post(self):
+        """
+        流式翻译接口, 每翻译完一个文本块就推送一次, 默认SSE格式, stream_format为jsonl时按行返回json
+        :return:
+        """
+        try:
+            text, ctx = parse_translate_request()
+            token_deltas = bool(request.json.get("token_deltas", False))
+            stream_format = request.json.get("stream_format", "sse")
+            assert stream_format in ["sse", "jsonl"], "stream_format must be one of ['sse', 'jsonl']"
+            events = AITranslatorModule(ctx=ctx).translate_stream(text, ctx.source_lang, ctx.target_lang, token_deltas)
+        except Exception as e:
+            return {
+                "code": 500,
+                "message": f"Translate went wrong, DETAIL: ```{e}```",
+                "data": {}
+            }
+
+        def generate():
+            try:
+                for event in events:
+                    yield self.format_event(event, stream_format)
+            except Exception as e:
+                yield self.format_event({"event": "error", "message": f"Translate went wrong, DETAIL: ```{e}```"},
+                                        stream_format)
+
+        mimetype = "text/event-stream" if stream_format == "sse" else "application/x-ndjson"
+        return Response(stream_with_context(generate()), mimetype=mimetype,
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    @staticmethod
+    def format_event(event, stream_format):
+        data = json.dumps(event, ensure_ascii=False)
+        if stream_format == "jsonl":
+            return f"{data}\n"
+        return f"event: {event['event']}\ndata: {data}\n\n"
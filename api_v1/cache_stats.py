@@ -0,0 +1,12 @@
+from flask_restful import Resource
+from utils.cache import get_translation_cache
+
+
+class CacheStats(Resource):
+    def get(self):
+        result = {
+            "code": 200,
+            "message": "success",
+            "data": get_translation_cache().stats()
+        }
+        return result
@@ -0,0 +1,12 @@
+from flask_restful import Resource
+from utils.engine_router import get_engine_router
+
+
+class EngineStats(Resource):
+    def get(self):
+        result = {
+            "code": 200,
+            "message": "success",
+            "data": get_engine_router().stats()
+        }
+        return result
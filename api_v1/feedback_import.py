@@ -0,0 +1,60 @@
+import os
+
+from flask import request, Response, stream_with_context
+from flask_restful import Resource
+
+from api_v1.ai_translator_stream import AITranslatorStream
+from config.config import cfg
+from modules.feedback_ingest import FORMATS, FeedbackIngestor, read_pairs
+from modules.term_index import get_term_index
+from utils.languages import get_language_registry
+
+
+class FeedbackImport(Resource):
+    def post(self):
+        """
+        批量导入人工反馈, 请求体为TMX/CSV/JSONL文件内容, 边读边写入ES, 流式返回单条失败、进度和结果,
+        传入job_id时保存断点, 同一job_id重新上传同一文件会从断点继续
+        :return:
+        """
+        try:
+            data_format = request.args.get("format", "jsonl")
+            source_lang = request.args.get("source_lang")
+            target_lang = request.args.get("target_lang")
+            job_id = request.args.get("job_id")
+            stream_format = request.args.get("stream_format", "jsonl")
+            data_tag = request.args.get("data_tag", "memory")
+            assert data_format in FORMATS, f"format should be in {FORMATS}"
+            source_lang = get_language_registry().require(source_lang, "source_lang")
+            target_lang = get_language_registry().require(target_lang, "target_lang")
+            assert stream_format in ["sse", "jsonl"], "stream_format must be one of ['sse', 'jsonl']"
+            assert data_tag in ["memory", "term"], "data_tag must be one of ['memory', 'term']"
+            checkpoint_path = None
+            if job_id:
+                assert job_id.replace("-", "").replace("_", "").isalnum(), "job_id should be alphanumeric"
+                os.makedirs(cfg.INGEST_CHECKPOINT_DIR, exist_ok=True)
+                checkpoint_path = os.path.join(cfg.INGEST_CHECKPOINT_DIR, f"{job_id}.json")
+            records = read_pairs(request.stream, data_format, source_lang, target_lang)
+            ingestor = FeedbackIngestor(checkpoint_path=checkpoint_path, data_tag=data_tag)
+            events = ingestor.ingest(records, source_lang, target_lang)
+        except Exception as e:
+            return {
+                "code": 500,
+                "message": f"Feedback import went wrong, DETAIL: ```{e}```",
+                "data": {}
+            }
+
+        def generate():
+            try:
+                for event in events:
+                    yield AITranslatorStream.format_event(event, stream_format)
+                if data_tag == "term":
+                    # 导入的术语不等定时同步, 马上在后台重建术语索引
+                    get_term_index().reload_in_background()
+            except Exception as e:
+                yield AITranslatorStream.format_event(
+                    {"event": "error", "message": f"Feedback import went wrong, DETAIL: ```{e}```"}, stream_format)
+
+        mimetype = "text/event-stream" if stream_format == "sse" else "application/x-ndjson"
+        return Response(stream_with_context(generate()), mimetype=mimetype,
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
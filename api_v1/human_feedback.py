@@ -1,7 +1,7 @@
 from flask_restful import Resource
 from flask import request
-from config.config import cfg
 from modules.human_feedback import HumanFeedbackModule
+from utils.languages import get_language_registry
 
 
 class HumanFeedback(Resource):
@@ -11,16 +11,19 @@ class HumanFeedback(Resource):
             translation = request.json.get("translation")
             source_lang = request.json.get("source_lang")
             target_lang = request.json.get("target_lang")
+            data_tag = request.json.get("data_tag", "memory")
             assert type(need_translate) == type(translation), "need_translate and translation should be the same type"
-            assert source_lang in cfg.SUPPORTED_LANGUAGES, f"source_lang should be in {cfg.SUPPORTED_LANGUAGES}"
-            assert target_lang in cfg.SUPPORTED_LANGUAGES, f"target_lang should be in {cfg.SUPPORTED_LANGUAGES}"
+            source_lang = get_language_registry().require(source_lang, "source_lang")
+            target_lang = get_language_registry().require(target_lang, "target_lang")
+            assert data_tag in ["memory", "term"], "data_tag should be in ['memory', 'term']"
             human_client = HumanFeedbackModule()
-            whole_es_data = human_client.save_feedback(need_translate, translation, source_lang, target_lang)
+            whole_es_data = human_client.save_feedback(need_translate, translation, source_lang, target_lang,
+                                                       data_tag)
             result = {
                 "code": 200,
                 "message": "save success",
                 "data": {
-                    "insert_uid": [item["_source"].get("uid") for item in whole_es_data]
+                    "insert_uid": [item["_id"] for item in whole_es_data]
                 }
             }
         except Exception as e:
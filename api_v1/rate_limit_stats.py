@@ -0,0 +1,12 @@
+from flask_restful import Resource
+from utils.rate_limiter import get_llm_scheduler
+
+
+class RateLimitStats(Resource):
+    def get(self):
+        result = {
+            "code": 200,
+            "message": "success",
+            "data": get_llm_scheduler().stats()
+        }
+        return result
@@ -1,14 +1,16 @@
 from flask_restful import Resource
-from config.config import cfg
+from utils.languages import get_language_registry
 
 
 class SupportLanguages(Resource):
     def get(self):
+        registry = get_language_registry()
         result = {
             "code": 200,
             "message": "success",
             "data": {
-                "supported_languages": cfg.SUPPORTED_LANGUAGES
+                "supported_languages": registry.names(),
+                "languages": registry.to_dict()
             }
         }
         return result
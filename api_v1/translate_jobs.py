@@ -0,0 +1,57 @@
+from flask_restful import Resource
+
+from api_v1.ai_translator import parse_translate_request
+from config.config import cfg
+from modules.translation_jobs import get_job_store
+
+
+class TranslateJobs(Resource):
+    def post(self):
+        """
+        提交长文档翻译任务, 参数与翻译接口相同, 立即返回任务id, 由worker在后台翻译
+        :return:
+        """
+        try:
+            text, ctx = parse_translate_request()
+            assert len(text) <= cfg.JOB_TEXT_LENGTH_LIMIT, f"text should be no longer than {cfg.JOB_TEXT_LENGTH_LIMIT}"
+            job_id = get_job_store().submit(text, ctx)
+            result = {
+                "code": 200,
+                "message": "success",
+                "data": {
+                    "job_id": job_id,
+                    "status": "queued",
+                }
+            }
+        except Exception as e:
+            result = {
+                "code": 500,
+                "message": f"Submit translate job went wrong, DETAIL: ```{e}```",
+                "data": {}
+            }
+        return result
+
+
+class TranslateJob(Resource):
+    def get(self, job_id):
+        """
+        查询翻译任务的状态、进度百分比和预计剩余时间, 完成后data.translated为译文
+        :param job_id: 任务id
+        :return:
+        """
+        try:
+            job = get_job_store().get(job_id)
+            if job is None:
+                return {"code": 404, "message": f"job {job_id} not found", "data": {}}
+            result = {
+                "code": 200,
+                "message": "success",
+                "data": job
+            }
+        except Exception as e:
+            result = {
+                "code": 500,
+                "message": f"Get translate job went wrong, DETAIL: ```{e}```",
+                "data": {}
+            }
+        return result
@@ -1,6 +1,10 @@
-from flask import Flask
+import os
+
+from flask import Flask, Response
 from flask_restful import Api
 from api_v1 import register_api_v1
+from modules.translation_jobs import start_embedded_workers
+from utils import metrics
 
 app = Flask(__name__)
 
@@ -12,8 +16,19 @@ def root():
     return "Hello humans, I'm an AI translator"
 
 
+@app.get("/metrics")
+def prometheus_metrics():
+    """
+    Prometheus格式的各阶段耗时和token指标
+    """
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 register_api_v1(api)
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", debug=True, port=8000)
+    # 导入app时不启动后台线程, 由启动服务的入口负责: 这里是开发用的服务器, 生产环境用gunicorn -c gunicorn.conf.py,
+    # 在每个worker fork之后启动; 长文档翻译任务的worker单独部署时把JOB_EMBEDDED_WORKERS设为0
+    start_embedded_workers()
+    app.run(host="0.0.0.0", debug=os.getenv("FLASK_DEBUG") == "1", port=8000)
@@ -0,0 +1,162 @@
+"""
+异步服务入口, 与app.py(Flask)并存, 翻译接口的GPT/embedding/ES请求都是异步的, 使用进程内共享的连接池
+运行: uvicorn asgi:app --host 0.0.0.0 --port 8001
+"""
+import asyncio
+import json
+
+from api_v1.ai_translator import parse_target_langs, parse_translate_request
+from config.config import cfg
+from modules.async_translator import AsyncAITranslatorModule
+from utils.async_clients import get_async_clients
+from utils import metrics
+from utils.cache import get_translation_cache
+from utils.engine_router import get_engine_router
+from utils.languages import get_language_registry
+from utils.doc_format import DOC_FORMATS
+from utils.rate_limiter import get_llm_scheduler
+
+
+async def read_json(receive):
+    """
+    读取完整的请求体并解析为json
+    """
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return json.loads(body or b"{}")
+
+
+async def send_json(send, data, status=200):
+    await send_body(send, json.dumps(data, ensure_ascii=False).encode("utf-8"), b"application/json", status)
+
+
+async def send_body(send, payload, content_type, status=200):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type), (b"content-length", str(len(payload)).encode())],
+    })
+    await send({"type": "http.response.body", "body": payload})
+
+
+async def root(scope, receive):
+    return "Hello humans, I'm an AI translator"
+
+
+def check_async_options(payload):
+    """
+    异步服务只支持普通文本的翻译, 其他选项明确报错, 不会忽略后按普通文本翻译
+    """
+    doc_format = payload.get("format", cfg.DEFAULT_DOC_FORMAT)
+    assert doc_format in DOC_FORMATS, f"format must be one of {list(DOC_FORMATS)}"
+    assert doc_format == "text", f"format {doc_format} is not supported by the async server, use the Flask server"
+    assert payload.get("doc_id") is None, "doc_id is not supported by the async server, use the Flask server"
+    mode = payload.get("multi_target_mode") or "fanout"
+    assert mode == "fanout", f"multi_target_mode {mode} is not supported by the async server, use fanout"
+
+
+async def translate(scope, receive):
+    """
+    人工智能翻译接口, 与Flask的/v1/ai_translate/translate相同的请求里, 只支持format为text,
+    不支持doc_id, 多目标语言只按fanout翻译, 传了不支持的选项时返回code 500和原因
+    """
+    with metrics.collect_timings("translate") as timings:
+        try:
+            payload = await read_json(receive)
+            text, ctx = parse_translate_request(payload)
+            target_langs = parse_target_langs(payload)
+            check_async_options(payload)
+            if target_langs:
+                # 异步服务里多目标语言只按目标语言并发翻译
+                translated = await asyncio.gather(*(
+                    AsyncAITranslatorModule(ctx=ctx.replace(target_lang=target_lang)).translate(
+                        text, ctx.source_lang, target_lang, payload.get("parallel")) for target_lang in target_langs))
+                data = {"text": text, "translations": dict(zip(target_langs, translated)),
+                        "source_lang": ctx.source_lang, "target_langs": target_langs, "multi_target_mode": "fanout"}
+            else:
+                translated = await AsyncAITranslatorModule(ctx=ctx).translate(text, ctx.source_lang, ctx.target_lang,
+                                                                              payload.get("parallel"))
+                data = {"text": text, "translated": translated, "source_lang": ctx.source_lang,
+                        "target_lang": ctx.target_lang}
+            result = {
+                "code": 200,
+                "message": "success",
+                "data": {**data, "time_cost": round(timings.elapsed(), 3)}
+            }
+            if payload.get("timings"):
+                result["data"]["timings"] = timings.summary()
+            return result
+        except Exception as e:
+            return {
+                "code": 500,
+                "message": f"Translate went wrong, DETAIL: ```{e}```",
+                "data": {}
+            }
+
+
+async def support_languages(scope, receive):
+    return {"code": 200, "message": "success", "data": {"supported_languages": get_language_registry().names(),
+                                                         "languages": get_language_registry().to_dict()}}
+
+
+async def cache_stats(scope, receive):
+    return {"code": 200, "message": "success", "data": get_translation_cache().stats()}
+
+
+async def rate_limit_stats(scope, receive):
+    return {"code": 200, "message": "success", "data": get_llm_scheduler().stats()}
+
+
+async def engine_stats(scope, receive):
+    return {"code": 200, "message": "success", "data": get_engine_router().stats()}
+
+
+async def prometheus_metrics(scope, receive):
+    return metrics.render().encode("utf-8")
+
+
+ROUTES = {
+    ("GET", "/"): root,
+    ("POST", "/v1/ai_translate/translate"): translate,
+    ("GET", "/v1/ai_translate/languages"): support_languages,
+    ("GET", "/v1/ai_translate/cache_stats"): cache_stats,
+    ("GET", "/v1/ai_translate/rate_limit_stats"): rate_limit_stats,
+    ("GET", "/v1/ai_translate/engine_stats"): engine_stats,
+    ("GET", "/metrics"): prometheus_metrics,
+}
+
+
+async def lifespan(receive, send):
+    """
+    启动时创建共享连接池, 关闭时释放
+    """
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await get_async_clients().start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await get_async_clients().close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    handler = ROUTES.get((scope["method"], scope["path"].rstrip("/") or "/"))
+    if handler is None:
+        await send_json(send, {"code": 404, "message": f"{scope['method']} {scope['path']} not found", "data": {}}, 404)
+        return
+    result = await handler(scope, receive)
+    if isinstance(result, bytes):
+        await send_body(send, result, metrics.CONTENT_TYPE.encode())
+        return
+    await send_json(send, result)
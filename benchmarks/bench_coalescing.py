@@ -0,0 +1,78 @@
+"""
+并发请求合并的压测: N个请求同时翻译同一篇文章(整篇相同), 或同时翻译只有结尾不同的文章(前面的文本块相同),
+对比关闭和开启合并时GPT的请求数和请求延迟, 开启合并时GPT请求数不随重复的并发数增长
+运行: python benchmarks/bench_coalescing.py
+环境变量: BENCH_CONCURRENCY 逗号分隔的并发数, BENCH_LLM_LATENCY 假GPT每个请求的延迟(秒)
+"""
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.abspath(os.path.join(__file__, "..", "..")))
+
+from benchmarks.corpus import use_encoding
+from config.config import cfg, TranslationContext
+from modules.translator import AITranslatorModule
+from utils import stubs
+from utils.cache import TranslationCache
+
+PARAGRAPHS = [
+    "Microglia belong to tissue-resident macrophages of the central nervous system, representing the primary innate "
+    "immune cells. This cell type constitutes about seven percent of non-neuronal cells in the mammalian brain.",
+    "Its unique identity resides in the fact that once entering the CNS, it is perennially exposed to a unique "
+    "environment following the formation of the blood-brain barrier.",
+    "Additionally, tissue-resident macrophage progenies derive from various peripheral sites that exhibit "
+    "hematopoietic potential, and their fate is shaped by the local niche.",
+]
+
+
+def build_article(paragraphs=80):
+    return "\n\n".join(f"{PARAGRAPHS[index % len(PARAGRAPHS)]} (Section {index}.)" for index in range(paragraphs))
+
+
+def run(server, documents, coalesce, ctx):
+    """
+    所有请求同时开始, 共用一个空的翻译缓存
+    :return: (GPT请求数, 请求延迟中位数, 最大延迟)
+    """
+    cfg.COALESCE_TRANSLATIONS = coalesce
+    cache = TranslationCache(max_size=100000, ttl=0, db_path="")
+    barrier = threading.Barrier(len(documents))
+    calls = server.calls
+
+    def one(document):
+        translator = AITranslatorModule(cache=cache, es_client=stubs.FakeElasticsearch(), ctx=ctx)
+        barrier.wait()
+        start = time.perf_counter()
+        translator.translate(document, parallel=True)
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=len(documents)) as executor:
+        latencies = sorted(executor.map(one, documents))
+    return server.calls - calls, latencies[len(latencies) // 2], latencies[-1]
+
+
+if __name__ == '__main__':
+    use_encoding()
+    concurrency = [int(item) for item in os.getenv("BENCH_CONCURRENCY", "1,8,32,128").split(",")]
+    latency = float(os.getenv("BENCH_LLM_LATENCY", 0.2))
+    cfg.USE_TRANSLATION_MEMORY = False
+    cfg.LLM_RATE_LIMITS = {}
+    ctx = TranslationContext.create("gpt35")
+    article = build_article()
+    scenarios = [
+        ("same article", lambda n: [article] * n),
+        ("shared chunks", lambda n: [f"{article}\n\nReader {index} says thanks." for index in range(n)]),
+    ]
+    with stubs.FakeOpenAIServer(latency=latency) as server:
+        server.configure_openai()
+        print(f"LLM latency: {latency}s, article chunks are translated in parallel")
+        print(f"{'scenario':>14}{'concurrency':>13}{'calls(off)':>12}{'calls(on)':>11}{'p50 off(s)':>12}"
+              f"{'p50 on(s)':>11}{'max on(s)':>11}")
+        for name, build in scenarios:
+            for num in concurrency:
+                off_calls, off_p50, _ = run(server, build(num), False, ctx)
+                on_calls, on_p50, on_max = run(server, build(num), True, ctx)
+                print(f"{name:>14}{num:>13}{off_calls:>12}{on_calls:>11}{off_p50:>12.3f}{on_p50:>11.3f}{on_max:>11.3f}")
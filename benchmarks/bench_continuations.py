@@ -0,0 +1,124 @@
+"""
+续写次数基准测试: 假OpenAI服务器按上下文窗口截断回复(finish_reason为length), 对比旧的处理方式
+(max_tokens固定为模型上限, 历史不限轮数和token数、只在超出窗口时删除且不给回复留token, 被截断后递归续写)
+和现在按输入预估回复token、预留空间、预判溢出时切小文本块的方式,
+统计同一批文档需要的GPT请求次数, 多出文本块数的部分就是续写带来的额外往返
+运行: python benchmarks/bench_continuations.py
+环境变量: BENCH_DOCS 文档数, BENCH_DOC_CHUNKS 每篇文档大约的文本块数
+"""
+import json
+import os
+import re
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(__file__, "..", "..")))
+
+from benchmarks.corpus import use_encoding
+from config.config import cfg, TranslationContext
+from modules.translator import AITranslatorModule
+from utils import stubs, utils
+from utils.cache import NullCache
+
+CONTINUE_PROMPT = "Well translated, but the output does not end, please continue the output."
+SENTENCES = [
+    "Microglia belong to tissue-resident macrophages of the central nervous system, representing the primary innate immune cells. ",
+    "This cell type constitutes about seven percent of non-neuronal cells in the mammalian brain. ",
+    "Its unique identity resides in the fact that once entering the CNS, it is perennially exposed to a unique environment. ",
+]
+
+
+class ContextWindowServer(stubs.FakeOpenAIServer):
+    """
+    有上下文窗口的假服务器: 回复比原文长一半, prompt加回复超过窗口或max_tokens时截断回复, 续写时接着上次截断的位置输出
+    """
+
+    def __init__(self, context_tokens, **kwargs):
+        super().__init__(**kwargs)
+        self.context_tokens = context_tokens
+        self.truncated = 0
+
+    def full_reply(self, query):
+        text = re.findall(r"```(.*?)```", query, re.S)[-1]
+        return json.dumps({"result": f"{self.prefix}{text}{text[:len(text) // 2]}"}, ensure_ascii=False)
+
+    def complete(self, body):
+        messages = body["messages"]
+        # 最后一条不是续写请求的user消息是待翻译文本, 它之后的assistant消息是已经输出过的部分
+        position = max(index for index, item in enumerate(messages)
+                       if item["role"] == "user" and item["content"] != CONTINUE_PROMPT)
+        emitted = "".join(item["content"] for item in messages[position + 1:] if item["role"] == "assistant")
+        remainder = self.full_reply(messages[position]["content"])[len(emitted):]
+        room = min(body.get("max_tokens") or self.context_tokens,
+                   self.context_tokens - utils.token_usage_from_messages(messages, "gpt35"))
+        encoding = utils.get_encoding()
+        tokens = encoding.encode(remainder)
+        if len(tokens) <= room:
+            return remainder, "stop"
+        with self.lock:
+            self.truncated += 1
+        return encoding.decode(tokens[:max(1, room)]), "length"
+
+
+def legacy_gpt_request(message, translated_result="", ctx=None):
+    """
+    旧的处理方式: max_tokens固定为模型上限, 被截断时在原message上追加续写请求并递归
+    """
+    response = utils.chat_completion(message, ctx, max_tokens=ctx.max_tokens)
+    content = response['choices'][0].get("message").get("content")
+    translated_result = f"{translated_result}{content}"
+    if response['choices'][0].get("finish_reason") != "length":
+        return translated_result
+    message.append({"role": "assistant", "content": content})
+    message.append({"role": "user", "content": CONTINUE_PROMPT})
+    utils.delete_oldest_history_message(message, ctx)
+    return legacy_gpt_request(message, translated_result, ctx)
+
+
+def build_documents(doc_num, chunk_num):
+    sentence_tokens = utils.token_usage(SENTENCES[0])
+    sentences_per_doc = cfg.ENGINE_TOKENS_MAPPING["gpt35"] // 4 // sentence_tokens * chunk_num
+    return [f"Document {doc}. " + "".join(SENTENCES[(doc + index) % len(SENTENCES)] for index in range(sentences_per_doc))
+            for doc in range(doc_num)]
+
+
+def run(documents, legacy):
+    gpt_request, output_reserve, overflow_pieces = (utils.gpt_request, AITranslatorModule.output_reserve,
+                                                    AITranslatorModule.overflow_pieces)
+    history_limits = cfg.HISTORY_MAX_TURNS, cfg.HISTORY_MAX_TOKENS
+    if legacy:
+        utils.gpt_request = legacy_gpt_request
+        AITranslatorModule.output_reserve = lambda self, translate_text: 0
+        AITranslatorModule.overflow_pieces = lambda self, message, translate_text, prompt_tokens=None: None
+        # 旧的历史不限轮数和token数, 一直保留到上下文窗口放不下为止
+        cfg.HISTORY_MAX_TURNS, cfg.HISTORY_MAX_TOKENS = sys.maxsize, 0
+    chunks = 0
+    try:
+        with ContextWindowServer(cfg.ENGINE_TOKENS_MAPPING["gpt35"]) as server:
+            server.configure_openai()
+            for document in documents:
+                translator = AITranslatorModule(cache=NullCache(), es_client=stubs.FakeElasticsearch(),
+                                                ctx=TranslationContext.create("gpt35"))
+                chunks += len(translator.prepare_chunks(document)[0])
+                translator.translate(document, parallel=False)
+    finally:
+        utils.gpt_request = gpt_request
+        AITranslatorModule.output_reserve, AITranslatorModule.overflow_pieces = output_reserve, overflow_pieces
+        cfg.HISTORY_MAX_TURNS, cfg.HISTORY_MAX_TOKENS = history_limits
+    return chunks, server.calls, server.truncated
+
+
+if __name__ == '__main__':
+    use_encoding()
+    doc_num = int(os.getenv("BENCH_DOCS", 5))
+    chunk_num = int(os.getenv("BENCH_DOC_CHUNKS", 8))
+    cfg.USE_AZURE_AI = True
+    cfg.USE_TRANSLATION_MEMORY = False
+    documents = build_documents(doc_num, chunk_num)
+    print(f"documents: {doc_num}, ~{chunk_num} chunks each, context window: {cfg.ENGINE_TOKENS_MAPPING['gpt35']} tokens")
+    print(f"{'mode':>10}{'chunks':>10}{'requests':>10}{'truncated':>11}{'extra round-trips':>19}")
+    results = {}
+    for mode, legacy in [("legacy", True), ("budgeted", False)]:
+        chunks, calls, truncated = results[mode] = run(documents, legacy)
+        print(f"{mode:>10}{chunks:>10}{calls:>10}{truncated:>11}{calls - chunks:>19}")
+    eliminated = (results["legacy"][1] - results["legacy"][0]) - (results["budgeted"][1] - results["budgeted"][0])
+    print(f"extra round-trips eliminated: {eliminated}")
@@ -0,0 +1,125 @@
+"""
+文档格式基准测试: 同一批Markdown/HTML文档, 对比整篇当作普通文本翻译(代码块、链接地址、标签都发给GPT)
+和DocumentTranslatorModule只翻译文本单元, 统计请求数、prompt/回复token数和耗时,
+假GPT的延迟按回复token数计算, 模拟逐token生成的耗时
+运行: python benchmarks/bench_document_format.py
+环境变量: BENCH_DOCS 文档数(Markdown和HTML各一半), BENCH_TOKEN_LATENCY 每个回复token的延迟(秒)
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.abspath(os.path.join(__file__, "..", "..")))
+
+from benchmarks.corpus import use_encoding
+from config.config import cfg, TranslationContext
+from modules.document_translator import DocumentTranslatorModule
+from modules.translator import AITranslatorModule
+from utils import stubs, utils
+from utils.cache import NullCache
+
+PARAGRAPHS = [
+    "Microglia belong to tissue-resident macrophages of the central nervous system, representing the primary innate "
+    "immune cells. See the [overview](https://en.wikipedia.org/wiki/Microglia_(cell)) for details.",
+    "This cell type constitutes about seven percent of non-neuronal cells in the mammalian brain, "
+    "and the `MicrogliaModel` class exposes it through `load_cells()`.",
+    "Its unique identity resides in the fact that once entering the CNS, it is perennially exposed to a unique "
+    "environment following the formation of the blood-brain barrier.",
+]
+CODE = '''def load_cells(path, limit=None):
+    """Load cell records from a CSV file."""
+    cells = []
+    with open(path, encoding="utf-8") as stream:
+        for row in csv.DictReader(stream):
+            cells.append(Cell(row["id"], float(row["volume"]), row.get("region", "unknown")))
+            if limit and len(cells) >= limit:
+                break
+    return cells
+'''
+
+
+def build_markdown(doc):
+    sections = []
+    for index in range(4):
+        sections.append(f"## Section {doc}.{index}\n\n{PARAGRAPHS[index % 3]}\n\n"
+                        f"![figure {index}](https://cdn.example.com/images/figure-{doc}-{index}.png)\n\n"
+                        f"```python\n{CODE}```\n\n- {PARAGRAPHS[(index + 1) % 3]}\n- Run `pip install cells=={index}.0`\n\n"
+                        f"| Parameter | Meaning |\n|---|---|\n| `limit` | Maximum number of cells to load |\n")
+    return f"# Document {doc}\n\n" + "\n".join(sections)
+
+
+def build_html(doc):
+    sections = []
+    for index in range(4):
+        sections.append(f'<h2 id="section-{index}">Section {doc}.{index}</h2>\n'
+                        f'<p class="lead">{PARAGRAPHS[index % 3].split(" See ")[0]} See the '
+                        f'<a href="https://example.com/docs/{doc}/{index}?ref=nav&amp;lang=en">overview</a>.</p>\n'
+                        f'<img src="https://cdn.example.com/images/figure-{doc}-{index}.png" alt="figure">\n'
+                        f'<pre><code class="language-python">{CODE}</code></pre>\n'
+                        f'<ul><li>{PARAGRAPHS[(index + 1) % 3]}</li><li>Run <code>pip install cells</code></li></ul>\n')
+    return (f'<html><head><title>Document {doc}</title><style>body {{ font-family: sans-serif; }} '
+            f'pre {{ background: #f6f8fa; padding: 16px; }}</style></head>\n<body>\n' + "".join(sections)
+            + '<script>window.dataLayer = window.dataLayer || []; dataLayer.push({"page": "docs"});</script>\n'
+              '</body></html>')
+
+
+class TokenRecorder(stubs.StubLLM):
+    """
+    记录prompt和回复token数的假GPT, 延迟与回复token数成正比
+    """
+
+    def __init__(self, token_latency):
+        super().__init__(latency=0.0)
+        self.token_latency = token_latency
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, message, ctx=None, **kwargs):
+        reply = json.dumps(json.loads(super().__call__(message, ctx)), ensure_ascii=False, indent=4)
+        prompt_tokens, output_tokens = utils.prompt_token_usage(message, ctx), utils.token_usage(reply)
+        with self.lock:
+            self.prompt_tokens += prompt_tokens
+            self.output_tokens += output_tokens
+        time.sleep(output_tokens * self.token_latency)
+        return reply
+
+
+def run(documents, format_aware, ctx, token_latency):
+    llm = TokenRecorder(token_latency)
+    gpt_request = utils.gpt_request
+    utils.gpt_request = llm
+    start = time.perf_counter()
+    try:
+        for document, doc_format in documents:
+            if format_aware:
+                DocumentTranslatorModule(cache=NullCache(), es_client=stubs.FakeElasticsearch(), ctx=ctx).translate(
+                    document, doc_format=doc_format)
+            else:
+                AITranslatorModule(cache=NullCache(), es_client=stubs.FakeElasticsearch(), ctx=ctx).translate(
+                    document, parallel=False)
+    finally:
+        utils.gpt_request = gpt_request
+    return llm.calls, llm.prompt_tokens, llm.output_tokens, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    use_encoding()
+    doc_num = int(os.getenv("BENCH_DOCS", 10))
+    token_latency = float(os.getenv("BENCH_TOKEN_LATENCY", 0.0005))
+    cfg.USE_TRANSLATION_MEMORY = False
+    ctx = TranslationContext.create("gpt35")
+    documents = [(build_markdown(doc), "markdown") if doc % 2 == 0 else (build_html(doc), "html")
+                 for doc in range(doc_num)]
+    print(f"documents: {doc_num} (markdown/html), source tokens: "
+          f"{sum(utils.token_usage_batch([document for document, _ in documents]))}")
+    print(f"{'mode':>8}{'requests':>10}{'prompt':>10}{'output':>10}{'seconds':>10}")
+    results = {}
+    for mode, format_aware in [("plain", False), ("format", True)]:
+        calls, prompt_tokens, output_tokens, cost = results[mode] = run(documents, format_aware, ctx, token_latency)
+        print(f"{mode:>8}{calls:>10}{prompt_tokens:>10}{output_tokens:>10}{cost:>10.3f}")
+    plain, aware = results["plain"], results["format"]
+    print(f"tokens saved: {1 - (aware[1] + aware[2]) / (plain[1] + plain[2]):.1%}, "
+          f"latency saved: {1 - aware[3] / plain[3]:.1%}")
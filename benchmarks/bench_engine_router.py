@@ -0,0 +1,85 @@
+"""
+GPT后端路由基准测试: 三个延迟不同的本地假OpenAI服务器作为同一engine的三个后端(快但有长尾、稍慢、很慢),
+对比只用一个后端、按延迟路由、路由加对冲请求, 以及路由时最快的后端中途故障(全部返回503)的请求延迟分布和失败数
+运行: python benchmarks/bench_engine_router.py
+环境变量: BENCH_REQUESTS 每种模式的请求数, BENCH_CONCURRENCY 并发数, BENCH_SLOW_RATE 最快后端变慢的请求比例
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.abspath(os.path.join(__file__, "..", "..")))
+
+from benchmarks.corpus import use_encoding
+from config.config import cfg, TranslationContext
+from utils import engine_router, stubs, utils
+from utils.engine_router import Backend, EngineRouter
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run(servers, names, request_num, concurrency, hedge, outage=False):
+    cfg.ENGINE_HEDGE_ENABLED = hedge
+    router = engine_router._router = EngineRouter([
+        Backend(name, "gpt35", model="gpt-3.5-turbo", api_base=f"{servers[name].url}/v1", api_key="fake-key",
+                api_type="open_ai") for name in names])
+    ctx = TranslationContext.create("gpt35")
+    for server in servers.values():
+        server.down = False
+
+    def one(index):
+        if outage and index == request_num // 2:
+            servers["east"].down = True
+        message = [{"role": "user", "content": f"```request {index} {time.time()}```"}]
+        start = time.perf_counter()
+        try:
+            utils.gpt_request(message, ctx=ctx)
+        except Exception:
+            return None
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one, range(request_num)))
+    elapsed = time.perf_counter() - start
+    latencies = [result for result in results if result is not None]
+    return elapsed, latencies, results.count(None), router.stats()
+
+
+if __name__ == '__main__':
+    use_encoding()
+    request_num = int(os.getenv("BENCH_REQUESTS", 400))
+    concurrency = int(os.getenv("BENCH_CONCURRENCY", 8))
+    slow_rate = float(os.getenv("BENCH_SLOW_RATE", 0.02))
+    # 不限流, 退避时间缩短, 测的是路由本身
+    cfg.LLM_RATE_LIMITS = {}
+    cfg.LLM_BACKOFF_BASE = 0.05
+    servers = {
+        "east": stubs.FakeOpenAIServer(latency=0.05, slow_rate=slow_rate, slow_latency=1.0).start(),
+        "west": stubs.FakeOpenAIServer(latency=0.12, slow_rate=0.02, slow_latency=1.0).start(),
+        "local": stubs.FakeOpenAIServer(latency=0.4).start(),
+    }
+    print(f"requests: {request_num}, concurrency: {concurrency}, backends: east 50ms ({slow_rate:.0%} +1s), "
+          f"west 120ms (2% +1s), local 400ms")
+    print(f"{'mode':>16}{'time(s)':>9}{'p50':>8}{'p95':>8}{'p99':>8}{'max':>8}{'failed':>8}{'hedges':>8}"
+          f"{'wins':>6}{'failovers':>11}  requests per backend")
+    modes = [
+        ("single", ["east"], False, False),
+        ("routed", ["east", "west", "local"], False, False),
+        ("routed+hedge", ["east", "west", "local"], True, False),
+        ("east outage", ["east", "west", "local"], True, True),
+    ]
+    try:
+        for mode, names, hedge, outage in modes:
+            elapsed, latencies, failed, stats = run(servers, names, request_num, concurrency, hedge, outage)
+            per_backend = ", ".join(f"{name} {item['requests']}" for name, item in stats["backends"].items())
+            print(f"{mode:>16}{elapsed:>9.2f}{percentile(latencies, 0.5):>8.3f}{percentile(latencies, 0.95):>8.3f}"
+                  f"{percentile(latencies, 0.99):>8.3f}{max(latencies):>8.3f}{failed:>8}{stats['hedges']:>8}"
+                  f"{stats['hedge_wins']:>6}{stats['failovers']:>11}  {per_backend}")
+    finally:
+        for server in servers.values():
+            server.stop()
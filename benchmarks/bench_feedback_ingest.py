@@ -0,0 +1,103 @@
+"""
+人工反馈批量导入基准测试: 用内存ES替身和假embedding, 对比逐批调用save_feedback(每批一次同步bulk)
+和FeedbackIngestor(边读边写, parallel_bulk并发写入)导入同一份JSONL的吞吐, 以及导入后留在embedding缓存里的向量数;
+parallel_bulk省下的是等ES的时间: 几个bulk请求同时等, 等的同时读下一批和请求embedding.
+ES替身在同一个进程里序列化/解析1536维向量的JSON, 这部分和假embedding的计算都占着GIL, 并发不了,
+bulk延迟很小时两种方式差不多, 延迟接近真实ES写入带向量的文档的耗时时才能看出差别
+运行: python benchmarks/bench_feedback_ingest.py
+环境变量: BENCH_PAIRS 记录条数, BENCH_ES_LATENCY 每个bulk请求的模拟延迟(秒), 逗号分隔的多个值各测一次,
+BENCH_EMBED_LATENCY 每个embedding请求的模拟延迟(秒)
+"""
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(__file__, "..", "..")))
+
+from benchmarks.corpus import use_encoding
+from config.config import cfg
+from modules.feedback_ingest import FeedbackIngestor, language_code, read_pairs
+from modules.human_feedback import HumanFeedbackModule
+from utils import embedding_service, stubs
+
+
+class SlowElasticsearch(stubs.FakeElasticsearch):
+    """
+    每个bulk请求固定延迟的ES替身, 模拟网络往返和写入耗时
+    """
+
+    def __init__(self, latency):
+        super().__init__()
+        self.latency = latency
+
+    def bulk(self, *args, **kwargs):
+        time.sleep(self.latency)
+        return super().bulk(*args, **kwargs)
+
+
+def build_jsonl(pair_num):
+    lines = [json.dumps({"source": f"Memory sentence number {index}.", "target": f"第{index}条记忆。"},
+                        ensure_ascii=False) for index in range(pair_num)]
+    return "\n".join(lines).encode()
+
+
+def check_tmx_languages():
+    """
+    TMX的xml:lang可以带文字和地区(zh-Hant-TW), 繁体和简体的译文不能混在一起
+    """
+    expected = {"zh-Hant-TW": "zh-Hant", "zh-Hant-HK": "zh-Hant", "zh-Hans-CN": "zh", "zh-TW": "zh-Hant",
+                "zh-CN": "zh", "en-US": "en", "en-Latn-US": "en"}
+    for tag, code in expected.items():
+        assert language_code(tag) == code, f"{tag} resolved to {language_code(tag)}, expect {code}"
+    tmx = ('<tmx><body><tu><tuv xml:lang="en-US"><seg>Hello</seg></tuv><tuv xml:lang="zh-Hans-CN"><seg>你好</seg></tuv>'
+           '<tuv xml:lang="zh-Hant-TW"><seg>妳好</seg></tuv></tu></body></tmx>').encode()
+    for target_lang, target in [("Chinese", "你好"), ("Traditional Chinese", "妳好")]:
+        records = list(read_pairs(io.BytesIO(tmx), "tmx", "English", target_lang))
+        assert records == [{"source": "Hello", "target": target}], records
+
+
+def use_fresh_embedding_service(embed_latency):
+    embedding_service._embedding_service = embedding_service.EmbeddingService(
+        backend=stubs.FakeEmbedding(latency=embed_latency), store=embedding_service.EmbeddingStore(cfg.VECTOR_DIM))
+
+
+def run_save_feedback(data, latency, embed_latency):
+    use_fresh_embedding_service(embed_latency)
+    es_client = SlowElasticsearch(latency)
+    module = HumanFeedbackModule(es_client=es_client)
+    pairs = [(item["source"], item["target"]) for item in read_pairs(io.BytesIO(data), "jsonl", "English", "Chinese")]
+    start = time.perf_counter()
+    for offset in range(0, len(pairs), cfg.INGEST_BULK_CHUNK):
+        batch = pairs[offset:offset + cfg.INGEST_BULK_CHUNK]
+        module.save_feedback([source for source, _ in batch], [target for _, target in batch], "English", "Chinese")
+    return time.perf_counter() - start, len(es_client.indices_data.get(cfg.INDEX, {}))
+
+
+def run_ingestor(data, latency, embed_latency):
+    use_fresh_embedding_service(embed_latency)
+    es_client = SlowElasticsearch(latency)
+    start = time.perf_counter()
+    records = read_pairs(io.BytesIO(data), "jsonl", "English", "Chinese")
+    for _ in FeedbackIngestor(es_client=es_client).ingest(records, "English", "Chinese"):
+        pass
+    return time.perf_counter() - start, len(es_client.indices_data.get(cfg.INDEX, {}))
+
+
+if __name__ == '__main__':
+    use_encoding()
+    check_tmx_languages()
+    pair_num = int(os.getenv("BENCH_PAIRS", 5000))
+    latencies = [float(value) for value in os.getenv("BENCH_ES_LATENCY", "0.05,0.5").split(",")]
+    embed_latency = float(os.getenv("BENCH_EMBED_LATENCY", 0.05))
+    cfg.USE_TRANSLATION_MEMORY = False
+    data = build_jsonl(pair_num)
+    print(f"pairs: {pair_num}, embedding latency: {embed_latency}s, bulk threads: {cfg.INGEST_BULK_THREADS}, "
+          f"bulk chunk: {cfg.INGEST_BULK_CHUNK}")
+    print(f"{'bulk latency(s)':>16}{'mode':>14}{'seconds':>10}{'pairs/sec':>12}{'indexed':>10}{'cached vectors':>16}")
+    for latency in latencies:
+        for mode, fn in [("save_feedback", run_save_feedback), ("ingestor", run_ingestor)]:
+            cost, indexed = fn(data, latency, embed_latency)
+            cached = len(embedding_service.get_embedding_service().store)
+            print(f"{latency:>16}{mode:>14}{cost:>10.2f}{pair_num / cost:>12.0f}{indexed:>10}{cached:>16}")
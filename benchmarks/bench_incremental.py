@@ -0,0 +1,104 @@
+"""
+编辑后重新提交长文档的基准测试: 先翻译初版, 再依次提交改一句、开头插入一段、删除一段、末尾追加一段和原样重新提交的版本,
+对比普通翻译(只有文本块缓存)和按doc_id增量翻译的GPT请求数、prompt/回复token数和耗时
+运行: python benchmarks/bench_incremental.py
+环境变量: BENCH_PARAGRAPHS 文章的段落数, BENCH_LLM_LATENCY 假GPT每个请求的延迟(秒)
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(__file__, "..", "..")))
+
+from benchmarks.corpus import use_encoding
+from config.config import cfg, TranslationContext
+from modules.incremental_translator import DocumentStore, IncrementalTranslatorModule
+from modules.translator import AITranslatorModule
+from utils import metrics, stubs
+from utils.cache import TranslationCache
+
+SENTENCES = [
+    "Microglia belong to tissue-resident macrophages of the central nervous system, representing the primary innate "
+    "immune cells.",
+    "This cell type constitutes about seven percent of non-neuronal cells in the mammalian brain.",
+    "Its unique identity resides in the fact that once entering the CNS, it is perennially exposed to a unique "
+    "environment following the formation of the blood-brain barrier.",
+    "Additionally, tissue-resident macrophage progenies derive from various peripheral sites that exhibit "
+    "hematopoietic potential.",
+]
+
+
+def paragraph(index):
+    return " ".join(f"{SENTENCES[(index + offset) % len(SENTENCES)]} ({index}.{offset})" for offset in range(3))
+
+
+def versions(paragraph_num):
+    """
+    :return: [(版本名, 全文)], 每一版在上一版的基础上修改
+    """
+    paragraphs = [paragraph(index) for index in range(paragraph_num)]
+    result = [("initial", list(paragraphs))]
+    middle = paragraph_num // 2
+    paragraphs[middle] = paragraphs[middle].replace("seven percent", "about 7%")
+    result.append(("edit sentence", list(paragraphs)))
+    paragraphs.insert(1, "A new introductory paragraph was added by the editor.")
+    result.append(("insert at start", list(paragraphs)))
+    del paragraphs[middle // 2]
+    result.append(("delete paragraph", list(paragraphs)))
+    paragraphs.append("The closing remarks were appended in the last revision.")
+    result.append(("append at end", list(paragraphs)))
+    result.append(("unchanged", list(paragraphs)))
+    return [(name, "\n\n".join(items)) for name, items in result]
+
+
+def token_totals():
+    totals = {"prompt": 0, "completion": 0}
+    for (_, kind), value in metrics.LLM_TOKENS.values.items():
+        totals[kind] = totals.get(kind, 0) + value
+    return totals
+
+
+def run(server, documents, versioned, ctx):
+    """
+    依次翻译每一版, 所有版本共用一个翻译缓存
+    :return: [(版本名, GPT请求数, prompt token数, 回复token数, 耗时)]
+    """
+    cache = TranslationCache(max_size=100000, ttl=0, db_path="")
+    es_client = stubs.FakeElasticsearch()
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        store = DocumentStore(os.path.join(directory, "documents.db"))
+        for name, document in documents:
+            calls, tokens = server.calls, token_totals()
+            start = time.perf_counter()
+            if versioned:
+                IncrementalTranslatorModule(cache=cache, es_client=es_client, ctx=ctx, store=store).translate(
+                    "bench-doc", document)
+            else:
+                AITranslatorModule(cache=cache, es_client=es_client, ctx=ctx).translate(document)
+            elapsed = time.perf_counter() - start
+            after = token_totals()
+            rows.append((name, server.calls - calls, after["prompt"] - tokens["prompt"],
+                         after["completion"] - tokens["completion"], elapsed))
+    return rows
+
+
+if __name__ == '__main__':
+    use_encoding()
+    paragraph_num = int(os.getenv("BENCH_PARAGRAPHS", 200))
+    latency = float(os.getenv("BENCH_LLM_LATENCY", 0.05))
+    cfg.USE_TRANSLATION_MEMORY = False
+    cfg.LLM_RATE_LIMITS = {}
+    ctx = TranslationContext.create("gpt35")
+    documents = versions(paragraph_num)
+    with stubs.FakeOpenAIServer(latency=latency) as server:
+        server.configure_openai()
+        print(f"paragraphs: {paragraph_num}, LLM latency: {latency}s, chunks are translated sequentially with history")
+        print(f"{'version':>18}{'mode':>11}{'calls':>7}{'prompt tokens':>15}{'output tokens':>15}{'time(s)':>9}")
+        plain = run(server, documents, False, ctx)
+        versioned = run(server, documents, True, ctx)
+        for plain_row, versioned_row in zip(plain, versioned):
+            for mode, row in (("plain", plain_row), ("doc_id", versioned_row)):
+                name, calls, prompt_tokens, completion_tokens, elapsed = row
+                print(f"{name:>18}{mode:>11}{calls:>7}{prompt_tokens:>15}{completion_tokens:>15}{elapsed:>9.2f}")
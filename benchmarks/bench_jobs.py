@@ -0,0 +1,160 @@
+"""
+长文档翻译任务的基准测试:
+1. 在线请求延迟: 固定数量的HTTP worker线程(模拟gunicorn的线程数)同时收到几篇长文档和大量短文本请求,
+   对比长文档同步翻译(占住HTTP线程直到翻译完)和提交翻译任务(立即返回, 由任务worker在后台翻译)时短文本请求的延迟和长文档的完成时间
+2. 崩溃恢复: worker翻译到一半崩溃(不释放租约), 租约过期后另一个worker接着翻译, 统计两次的GPT请求数, 检查译文与一次翻译完的相同
+运行: python benchmarks/bench_jobs.py
+环境变量: BENCH_HTTP_THREADS 模拟的HTTP线程数, BENCH_JOB_WORKERS 任务worker线程数, BENCH_LONG_DOCS 长文档篇数,
+BENCH_SHORT_REQUESTS 短文本请求数, BENCH_LLM_LATENCY 假GPT每个请求的延迟(秒)
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.abspath(os.path.join(__file__, "..", "..")))
+
+from benchmarks.corpus import build_corpus, use_encoding
+from config.config import cfg, TranslationContext
+from modules.translation_jobs import JobStore, JobWorker, JobWorkerPool
+from modules.translator import AITranslatorModule
+from utils import stubs
+from utils.cache import NullCache
+
+
+class WorkerCrash(BaseException):
+    """
+    模拟worker进程被杀: 不是Exception, JobWorker不会把任务标记为失败, 租约留在数据库里
+    """
+
+
+def translator(ctx):
+    return AITranslatorModule(cache=NullCache(), es_client=stubs.FakeElasticsearch(), ctx=ctx)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def serve(mode, long_docs, short_docs, http_threads, job_workers, ctx):
+    """
+    长文档先到, 短文本紧跟着到, 所有请求排队等HTTP线程
+    :param mode: sync为在HTTP线程里同步翻译长文档, job为提交翻译任务
+    :return: (短文本请求的延迟列表, 长文档的完成时间列表)
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        store = JobStore(os.path.join(directory, "jobs.db"))
+        pool = JobWorkerPool(job_workers, store).start() if mode == "job" else None
+        start = time.perf_counter()
+
+        def long_request(doc):
+            if mode == "sync":
+                translator(ctx).translate(doc, parallel=False)
+                return time.perf_counter() - start
+            return store.submit(doc, ctx)
+
+        def short_request(doc):
+            translator(ctx).translate(doc)
+            return time.perf_counter() - start
+
+        with ThreadPoolExecutor(max_workers=http_threads) as executor:
+            long_futures = [executor.submit(long_request, doc) for doc in long_docs]
+            short_futures = [executor.submit(short_request, doc) for doc in short_docs]
+            short_latencies = [future.result() for future in short_futures]
+            long_results = [future.result() for future in long_futures]
+        if mode == "job":
+            pending = set(long_results)
+            long_results = []
+            while pending:
+                for job_id in list(pending):
+                    job = store.get(job_id)
+                    assert job["status"] != "failed", job["error"]
+                    if job["status"] == "done":
+                        long_results.append(job["finished_at"] - job["created_at"])
+                        pending.discard(job_id)
+                time.sleep(0.02)
+            pool.stop()
+    return short_latencies, long_results
+
+
+def crash_and_resume(server, doc, ctx, crash_after):
+    """
+    :return: (文本块数, 崩溃前的GPT请求数, 崩溃时的进度, 恢复后的GPT请求数, 一次翻译完的GPT请求数, 译文是否相同)
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        store = JobStore(os.path.join(directory, "jobs.db"))
+        job_id = store.submit(doc, ctx)
+
+        def crashing(job_ctx):
+            module = translator(job_ctx)
+            part_translate, done = module.part_translate, []
+
+            def crash(*args, **kwargs):
+                if len(done) >= crash_after:
+                    raise WorkerCrash()
+                done.append(True)
+                return part_translate(*args, **kwargs)
+
+            module.part_translate = crash
+            return module
+
+        calls = server.calls
+        try:
+            JobWorker(store, "worker-crashed", crashing).run_once()
+        except WorkerCrash:
+            pass
+        crashed_calls = server.calls - calls
+        progress = store.get(job_id)["progress"]
+        # 等崩溃的worker的租约过期
+        time.sleep(cfg.JOB_LEASE_SECONDS + 0.05)
+        calls = server.calls
+        JobWorker(store, "worker-resumed", translator).run_once()
+        resumed_calls = server.calls - calls
+        resumed = store.get(job_id)
+        assert resumed["status"] == "done" and resumed["attempts"] == 2, resumed
+
+        calls = server.calls
+        reference_id = store.submit(doc, ctx)
+        JobWorker(store, "worker-reference", translator).run_once()
+        reference = store.get(reference_id)
+        return (resumed["total_chunks"], crashed_calls, progress, resumed_calls, server.calls - calls,
+                resumed["translated"] == reference["translated"])
+
+
+if __name__ == '__main__':
+    http_threads = int(os.getenv("BENCH_HTTP_THREADS", 4))
+    job_workers = int(os.getenv("BENCH_JOB_WORKERS", 2))
+    long_num = int(os.getenv("BENCH_LONG_DOCS", 4))
+    short_num = int(os.getenv("BENCH_SHORT_REQUESTS", 40))
+    latency = float(os.getenv("BENCH_LLM_LATENCY", 0.05))
+    encoding = use_encoding()
+    cfg.USE_TRANSLATION_MEMORY = False
+    cfg.CACHE_ENABLED = False
+    # 任务worker按默认方式新建ES客户端, 这里只需要能构造出来, 不会真的连接
+    cfg.ELASTIC_USERNAME, cfg.ELASTIC_PASSWORD = "bench", "bench"
+    cfg.COALESCE_TRANSLATIONS = False
+    cfg.LLM_RATE_LIMITS = {}
+    cfg.JOB_POLL_INTERVAL = 0.02
+    cfg.JOB_LEASE_SECONDS = 0.5
+    ctx = TranslationContext.create("gpt35")
+    corpus = build_corpus(0)
+    long_docs = (corpus["long"] * long_num)[:long_num]
+    # 每篇长文档加上编号, 不同任务之间不会合并成同一个GPT请求
+    long_docs = [f"{doc}\n\n(Document {index}.)" for index, doc in enumerate(long_docs)]
+    short_docs = [f"{doc} (Request {index}.)" for index, doc in enumerate((corpus["short"] * short_num)[:short_num])]
+    with stubs.FakeOpenAIServer(latency=latency) as server:
+        server.configure_openai()
+        print(f"encoding: {encoding}, HTTP threads: {http_threads}, job workers: {job_workers}, "
+              f"long docs: {long_num}, short requests: {short_num}, LLM latency: {latency}s")
+        print(f"{'mode':>6}{'short p50(s)':>14}{'short p99(s)':>14}{'long done median(s)':>21}{'long done max(s)':>18}")
+        for mode in ("sync", "job"):
+            short_latencies, long_times = serve(mode, long_docs, short_docs, http_threads, job_workers, ctx)
+            print(f"{mode:>6}{percentile(short_latencies, 50):>14.2f}{percentile(short_latencies, 99):>14.2f}"
+                  f"{statistics.median(long_times):>21.2f}{max(long_times):>18.2f}")
+
+        total, crashed, progress, resumed, reference, same = crash_and_resume(server, long_docs[0], ctx, 3)
+        print(f"crash and resume: {total} chunks, {crashed} LLM calls before the crash at {progress}%, "
+              f"{resumed} after resuming, {reference} for an uninterrupted job, same translation: {same}")
@@ -0,0 +1,95 @@
+"""
+对话历史基准测试: 对比旧的逐块翻译方式(GPT原始回复整条记入历史, 直到快超出上下文窗口才逐条删除)
+和现在的MessageHistory(固定前缀、只保存原文/译文、按cfg.HISTORY_MAX_TURNS/HISTORY_MAX_TOKENS限制历史),
+统计同一批文档发送的prompt token总数. 文本块接近TEXT_TOKEN_LIMIT时加上给回复预留的token已经放不下历史,
+这里默认用较小的文本块, 历史能放下若干轮时才有差别
+运行: python benchmarks/bench_message_history.py
+环境变量: BENCH_DOCS 文档数, BENCH_DOC_CHUNKS 每篇文档大约的文本块数, BENCH_CHUNK_TOKENS 文本块的token限制
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(__file__, "..", "..")))
+
+from benchmarks.corpus import use_encoding
+from config.config import cfg, TranslationContext
+from modules.translator import AITranslatorModule
+from utils import stubs, utils
+from utils.cache import NullCache
+
+SENTENCES = [
+    "Microglia belong to tissue-resident macrophages of the central nervous system, representing the primary innate immune cells. ",
+    "This cell type constitutes about seven percent of non-neuronal cells in the mammalian brain. ",
+    "Its unique identity resides in the fact that once entering the CNS, it is perennially exposed to a unique environment. ",
+]
+
+
+class PromptRecorder(stubs.StubLLM):
+    """
+    记录每次请求prompt token数的假GPT, 回复和真实GPT一样带缩进的json
+    """
+
+    def __init__(self):
+        super().__init__(latency=0.0)
+        self.prompt_tokens = 0
+
+    def __call__(self, message, ctx=None, **kwargs):
+        self.prompt_tokens += utils.prompt_token_usage(message, ctx)
+        reply = json.loads(super().__call__(message, ctx))
+        return json.dumps(reply, ensure_ascii=False, indent=4)
+
+
+def build_documents(doc_num, chunk_num, chunk_tokens):
+    sentence_tokens = utils.token_usage(SENTENCES[0])
+    sentences_per_doc = max(1, chunk_tokens // sentence_tokens) * chunk_num
+    return [f"Document {doc}. " + "".join(SENTENCES[(doc + index) % len(SENTENCES)] for index in range(sentences_per_doc))
+            for doc in range(doc_num)]
+
+
+def legacy_translate(translator, chunks, llm):
+    """
+    旧的处理方式: 每篇文档重新构造初始prompt, 原始回复记入历史, 每块都从头计算token删除历史
+    """
+    message = translator.construct_init_message()
+    for chunk in chunks:
+        message.append({"role": "user", "content": translator.format_query(chunk)})
+        utils.delete_oldest_history_message(message, translator.ctx, reserve=translator.output_reserve(chunk))
+        message.append({"role": "assistant", "content": llm(message, translator.ctx)})
+
+
+def run(documents, legacy, ctx):
+    llm = PromptRecorder()
+    gpt_request = utils.gpt_request
+    utils.gpt_request = llm
+    start = time.perf_counter()
+    try:
+        for document in documents:
+            translator = AITranslatorModule(cache=NullCache(), es_client=stubs.FakeElasticsearch(), ctx=ctx)
+            if legacy:
+                chunks = translator.prepare_chunks(document)[0]
+                legacy_translate(translator, chunks, llm)
+            else:
+                translator.translate(document, parallel=False)
+    finally:
+        utils.gpt_request = gpt_request
+    return llm.calls, llm.prompt_tokens, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    use_encoding()
+    doc_num = int(os.getenv("BENCH_DOCS", 5))
+    chunk_num = int(os.getenv("BENCH_DOC_CHUNKS", 12))
+    chunk_tokens = int(os.getenv("BENCH_CHUNK_TOKENS", 200))
+    ctx = TranslationContext.create("gpt35").replace(text_token_limit=chunk_tokens)
+    cfg.USE_TRANSLATION_MEMORY = False
+    documents = build_documents(doc_num, chunk_num, chunk_tokens)
+    print(f"documents: {doc_num}, ~{chunk_num} chunks of {chunk_tokens} tokens each, history: {cfg.HISTORY_MAX_TURNS} turns / "
+          f"{cfg.HISTORY_MAX_TOKENS} tokens")
+    print(f"{'mode':>10}{'requests':>10}{'prompt tokens':>15}{'per doc':>10}{'seconds':>10}")
+    results = {}
+    for mode, legacy in [("legacy", True), ("history", False)]:
+        calls, tokens, cost = results[mode] = run(documents, legacy, ctx)
+        print(f"{mode:>10}{calls:>10}{tokens:>15}{tokens // doc_num:>10}{cost:>10.3f}")
+    print(f"prompt tokens saved: {1 - results['history'][1] / results['legacy'][1]:.1%}")
@@ -0,0 +1,85 @@
+"""
+多目标语言翻译的基准测试: 同一篇文章翻译成多种目标语言, 对比每种语言单独请求、fanout(共用切分和记忆库匹配, 按语言并发)
+和joint(每个文本块一个prompt翻译成所有语言)的GPT请求数、prompt/回复token数和耗时
+运行: python benchmarks/bench_multi_target.py
+环境变量: BENCH_TARGETS 逗号分隔的目标语言, BENCH_LLM_LATENCY 假GPT每个请求的延迟(秒), BENCH_TOKEN_LATENCY 每个回复token的生成延迟(秒)
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.abspath(os.path.join(__file__, "..", "..")))
+
+from benchmarks.corpus import use_encoding
+from config.config import cfg, TranslationContext
+from modules.multi_target_translator import MultiTargetTranslatorModule
+from modules.translator import AITranslatorModule
+from utils import metrics, stubs
+from utils.cache import TranslationCache
+
+PARAGRAPHS = [
+    "Microglia belong to tissue-resident macrophages of the central nervous system, representing the primary innate "
+    "immune cells. This cell type constitutes about seven percent of non-neuronal cells in the mammalian brain.",
+    "Its unique identity resides in the fact that once entering the CNS, it is perennially exposed to a unique "
+    "environment following the formation of the blood-brain barrier.",
+    "Additionally, tissue-resident macrophage progenies derive from various peripheral sites that exhibit "
+    "hematopoietic potential, and their fate is shaped by the local niche.",
+]
+
+
+def build_article(paragraphs=40):
+    return "\n\n".join(f"{PARAGRAPHS[index % len(PARAGRAPHS)]} (Section {index}.)" for index in range(paragraphs))
+
+
+def token_totals():
+    totals = {"prompt": 0, "completion": 0}
+    for (_, kind), value in metrics.LLM_TOKENS.values.items():
+        totals[kind] = totals.get(kind, 0) + value
+    return totals
+
+
+def run(server, article, targets, mode, parallel, ctx):
+    """
+    每种方式用空的翻译缓存
+    :return: (GPT请求数, prompt token数, 回复token数, 耗时)
+    """
+    cache = TranslationCache(max_size=100000, ttl=0, db_path="")
+    es_client = stubs.FakeElasticsearch()
+    calls, tokens = server.calls, token_totals()
+    start = time.perf_counter()
+    if mode == "separate":
+        def one(target):
+            translator = AITranslatorModule(cache=cache, es_client=es_client, ctx=ctx)
+            return translator.translate(article, "English", target, parallel)
+
+        with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            list(executor.map(one, targets))
+    else:
+        MultiTargetTranslatorModule(cache=cache, es_client=es_client, ctx=ctx).translate(
+            article, "English", targets, mode, parallel)
+    elapsed = time.perf_counter() - start
+    after = token_totals()
+    return (server.calls - calls, after["prompt"] - tokens["prompt"], after["completion"] - tokens["completion"],
+            elapsed)
+
+
+if __name__ == '__main__':
+    use_encoding()
+    targets = os.getenv("BENCH_TARGETS", "Chinese,Japanese,French,German").split(",")
+    latency = float(os.getenv("BENCH_LLM_LATENCY", 0.2))
+    token_latency = float(os.getenv("BENCH_TOKEN_LATENCY", 0.002))
+    cfg.USE_TRANSLATION_MEMORY = False
+    cfg.COALESCE_TRANSLATIONS = False
+    cfg.LLM_RATE_LIMITS = {}
+    ctx = TranslationContext.create("gpt35")
+    article = build_article()
+    with stubs.FakeOpenAIServer(latency=latency, token_latency=token_latency) as server:
+        server.configure_openai()
+        print(f"targets: {', '.join(targets)}, LLM latency: {latency}s + {token_latency}s per output token")
+        print(f"{'mode':>10}{'parallel':>10}{'calls':>8}{'prompt tokens':>15}{'output tokens':>15}{'time(s)':>9}")
+        for parallel in (False, True):
+            for mode in ("separate", "fanout", "joint"):
+                calls, prompt_tokens, completion_tokens, elapsed = run(server, article, targets, mode, parallel, ctx)
+                print(f"{mode:>10}{str(parallel):>10}{calls:>8}{prompt_tokens:>15}{completion_tokens:>15}"
+                      f"{elapsed:>9.2f}")
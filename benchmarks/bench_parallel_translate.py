@@ -0,0 +1,47 @@
+"""
+并行翻译基准测试: 用本地假GPT对比串行/并行翻译在不同文本块数量下的耗时
+运行: python benchmarks/bench_parallel_translate.py
+"""
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(__file__, "..", "..")))
+
+from benchmarks.corpus import use_encoding
+from config.config import cfg
+from modules.translator import AITranslatorModule
+from utils import utils
+from utils.stubs import StubLLM, FakeElasticsearch
+
+SENTENCE = "Microglia belong to tissue-resident macrophages of the central nervous system, representing the primary innate immune cells."
+
+
+def build_document(chunk_num):
+    """
+    构造大约chunk_num个文本块长度的文档
+    """
+    sentence_tokens = utils.token_usage(SENTENCE)
+    sentences_per_chunk = max(1, cfg.ENGINE_TOKENS_MAPPING["gpt35"] // 4 // sentence_tokens)
+    return " ".join([SENTENCE] * sentences_per_chunk * chunk_num)
+
+
+def run(chunk_num, parallel, latency):
+    utils.gpt_request = StubLLM(latency=latency)
+    translator = AITranslatorModule(es_client=FakeElasticsearch())
+    start = time.perf_counter()
+    translator.translate(build_document(chunk_num), parallel=parallel)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    use_encoding()
+    latency = float(os.getenv("STUB_LATENCY", 0.5))
+    # 文档由相同句子构成, 关闭缓存和翻译记忆避免命中后失去对比意义
+    cfg.CACHE_ENABLED = False
+    cfg.USE_TRANSLATION_MEMORY = False
+    print(f"{'chunks':>8}{'serial(s)':>12}{'parallel(s)':>14}{'speedup':>10}")
+    for chunk_num in [1, 2, 5, 10, 20]:
+        serial = run(chunk_num, False, latency)
+        parallel = run(chunk_num, True, latency)
+        print(f"{chunk_num:>8}{serial:>12.2f}{parallel:>14.2f}{serial / parallel:>9.1f}x")
@@ -0,0 +1,78 @@
+"""
+GPT调度器基准测试: 假OpenAI服务器按配额返回429(带Retry-After), 对比不限流(只重试)和按配额限流时的429次数和总耗时,
+并混合interactive/batch两个通道的请求, 查看各自的平均排队时间
+运行: python benchmarks/bench_rate_limiter.py
+环境变量: BENCH_REQUESTS 总请求数, BENCH_RPM 服务端每分钟请求配额
+"""
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.abspath(os.path.join(__file__, "..", "..")))
+
+from benchmarks.corpus import use_encoding
+from config.config import cfg, TranslationContext
+from utils import rate_limiter, stubs, utils
+
+
+class QuotaServer(stubs.FakeOpenAIServer):
+    """
+    按rpm配额限流的假服务器, 用1秒的令牌桶检查, 超出时返回429和Retry-After
+    """
+
+    def __init__(self, rpm, **kwargs):
+        super().__init__(**kwargs)
+        self.bucket = rate_limiter.TokenBucket(rpm, burst_seconds=1)
+        self.bucket_lock = threading.Lock()
+        self.rejected = 0
+
+    def reject(self, body):
+        with self.bucket_lock:
+            wait = self.bucket.wait_time(1, time.monotonic())
+            if wait > 0:
+                self.rejected += 1
+                return 429, {"Retry-After": f"{wait:.2f}"}, "Requests to the ChatCompletions_Create Operation have exceeded rate limit."
+            self.bucket.take(1)
+        return None
+
+
+def run(limits, request_num, rpm):
+    rate_limiter._scheduler = rate_limiter.LLMScheduler(limits)
+    interactive = TranslationContext.create("gpt35")
+    batch = interactive.replace(priority="batch")
+    with QuotaServer(rpm, latency=0.05) as server:
+        server.configure_openai()
+
+        def one(index):
+            ctx = interactive if index % 5 == 0 else batch
+            message = [{"role": "user", "content": f"```request {index}```"}]
+            try:
+                utils.gpt_request(message, ctx=ctx)
+                return True
+            except Exception:
+                return False
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            failed = list(executor.map(one, range(request_num))).count(False)
+        elapsed = time.perf_counter() - start
+    stats = rate_limiter.get_llm_scheduler().stats()["gpt35"]
+    return elapsed, server.rejected, failed, stats
+
+
+if __name__ == '__main__':
+    use_encoding()
+    request_num = int(os.getenv("BENCH_REQUESTS", 300))
+    rpm = int(os.getenv("BENCH_RPM", 1800))
+    cfg.USE_AZURE_AI = True
+    cfg.LLM_BACKOFF_BASE = 0.2
+    # 与服务端1秒的检查窗口一致
+    cfg.LLM_RATE_BURST_SECONDS = 1
+    print(f"requests: {request_num}, server quota: {rpm} rpm, 1/5 interactive")
+    print(f"{'mode':>10}{'time(s)':>10}{'429s':>8}{'failed':>8}{'interactive wait(s)':>22}{'batch wait(s)':>16}")
+    for mode, limits in [("retry only", {}), ("scheduled", {"gpt35": {"rpm": rpm}})]:
+        elapsed, rejected, failed, stats = run(limits, request_num, rpm)
+        print(f"{mode:>10}{elapsed:>10.2f}{rejected:>8}{failed:>8}{stats['interactive']['avg_wait_seconds']:>22.3f}"
+              f"{stats['batch']['avg_wait_seconds']:>16.3f}")
@@ -0,0 +1,105 @@
+"""
+文本切分基准测试: 在中英混合的大文档上对比旧的切分(split_sentences逐句正则补句号 / 递归的cut+breakdown_text)
+和现在的单次扫描切分split_segments + pack_segments, 并检查切分结果能否还原原文
+运行: python benchmarks/bench_segmentation.py
+环境变量: BENCH_DOC_SIZE 文档字符数, 默认1000000
+"""
+import contextlib
+import io
+import os
+import re
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(__file__, "..", "..")))
+
+from benchmarks.corpus import legacy_force_breakdown, use_encoding
+from config.config import cfg
+from utils import utils
+
+PARAGRAPHS = [
+    "值得注意的是，《意见》还提到，要扎实做好稳地价、稳房价、稳预期工作，稳妥有序推进房地产风险化解处置。严格落实地方政府债务限额管理，坚决遏制新增隐性债务。",
+    "**“中特估”又飙了**",
+    "首先，从财政部的数据来看，1—4月，国有企业营业总收入262281.9亿元，同比增长7.1%。从利润总额来看，1—4月，国有企业利润总额14388.1亿元，同比增长15.1%。",
+    "Microglia belong to tissue-resident macrophages of the central nervous system (CNS), representing the primary "
+    "innate immune cells. This cell type constitutes ~7% of non-neuronal cells in the mammalian brain! Its unique "
+    "identity resides in the fact that, once entering the CNS, it is perennially exposed to a unique environment.",
+    "混合文本 mixed with English: see https://example.com/v1.2 for details; 数据截至2023年5月。",
+]
+
+
+def build_document(size):
+    paragraphs, length, index = [], 0, 0
+    while length < size:
+        paragraph = PARAGRAPHS[index % len(PARAGRAPHS)]
+        paragraphs.append(paragraph)
+        length += len(paragraph) + 2
+        index += 1
+    return "\n\n".join(paragraphs)
+
+
+def legacy_split_sentences(text):
+    sentences = re.split(r'(?<=\D)[。\.](?=\D|$)', text)
+    return [f"{item}。" if re.search(r"[一-龥]", item) else f"{item}." for item in sentences if item.strip() != ""]
+
+
+def legacy_cut(txt_tocut, must_break_at_empty_line, limit, break_anyway=False):
+    total_tokens = utils.token_usage(txt_tocut)
+    if total_tokens <= limit:
+        return [txt_tocut]
+    lines = txt_tocut.split('\n')
+    print(lines)
+    estimated_line_cut = int(limit / total_tokens * len(lines))
+    cnt = 0
+    for cnt in reversed(range(estimated_line_cut)):
+        if must_break_at_empty_line and lines[cnt] != "":
+            continue
+        prev = "\n".join(lines[:cnt])
+        post = "\n".join(lines[cnt:])
+        if utils.token_usage(prev) < limit:
+            break
+    if cnt == 0:
+        if break_anyway:
+            prev, post = legacy_force_breakdown(txt_tocut, limit, utils.token_usage)
+        else:
+            raise RuntimeError("存在一行极长的文本！")
+    return [prev] + legacy_cut(post, must_break_at_empty_line, limit, break_anyway=break_anyway)
+
+
+def legacy_breakdown_text(txt, limit):
+    for must_break_at_empty_line in (True, False):
+        try:
+            return legacy_cut(txt, must_break_at_empty_line, limit)
+        except RuntimeError:
+            continue
+    return legacy_cut(txt, False, limit, break_anyway=True)
+
+
+def timeit(fn):
+    start = time.perf_counter()
+    # 旧的cut会打印每一层的行列表, 计入耗时但不输出
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = fn()
+    return time.perf_counter() - start, result
+
+
+if __name__ == '__main__':
+    use_encoding()
+    size = int(os.getenv("BENCH_DOC_SIZE", 1000000))
+    limit = cfg.TEXT_TOKEN_LIMIT
+    document = build_document(size)
+    # 递归的cut每层都重新编码剩余文本, 在整篇文档上是平方复杂度, 只取前5万字符测试
+    small = document[:50000]
+    print(f"document: {len(document)} chars, token limit: {limit}")
+    rows = [
+        (f"sentences+pack {len(document)}", lambda: utils.pack_chunks(legacy_split_sentences(document), limit),
+         lambda: utils.pack_segments(utils.split_segments(document, limit), limit), document),
+        (f"breakdown_text {len(small)}", lambda: legacy_breakdown_text(small, limit),
+         lambda: utils.pack_segments(utils.split_segments(small, limit), limit), small),
+    ]
+    print(f"{'case':<30}{'before(s)':>12}{'after(s)':>12}{'speedup':>10}{'chunks':>10}{'lossless':>10}")
+    for name, before, after, text in rows:
+        before_cost, _ = timeit(before)
+        after_cost, chunks = timeit(after)
+        print(f"{name:<30}{before_cost:>12.3f}{after_cost:>12.3f}{before_cost / after_cost:>9.1f}x"
+              f"{len(chunks):>10}{str(''.join(chunks) == text):>10}")
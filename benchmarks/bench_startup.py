@@ -0,0 +1,170 @@
+"""
+服务启动的基准测试: 每轮启动一个新的服务进程, 测量从启动进程到服务开始监听、到第一个翻译请求成功的时间,
+以及第一个请求与之后请求的延迟, 对比不预热(lazy, 开发服务器的方式)和gunicorn.conf.py的预热(preload)
+运行: python benchmarks/bench_startup.py
+环境变量: BENCH_ROUNDS 每种方式启动的次数, BENCH_REQUESTS 第一个请求之后再发的请求数, BENCH_LLM_LATENCY 假GPT每个请求的延迟(秒),
+BENCH_FAKE_ENCODING 设为1时服务进程直接用stubs.FakeEncoding, 不设时离线环境没有tiktoken缓存也会自动换成FakeEncoding
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.abspath(os.path.join(__file__, "..", ".."))
+sys.path.append(ROOT)
+
+TEXT = ("Microglia belong to tissue-resident macrophages of the central nervous system, representing the primary "
+        "innate immune cells. This cell type constitutes about seven percent of non-neuronal cells in the mammalian "
+        "brain. Its unique identity resides in the fact that once entering the CNS, it is perennially exposed to a "
+        "unique environment following the formation of the blood-brain barrier. (Request {index}.)")
+
+
+def serve(mode, port, fake_encoding, timings_path):
+    """
+    服务进程: 按mode启动应用, 把导入和预热的耗时写到timings_path, 然后开始监听
+    """
+    start = time.perf_counter()
+    from benchmarks.corpus import use_encoding
+    from werkzeug.serving import make_server
+    import app
+    timings = {"import": time.perf_counter() - start}
+    if fake_encoding:
+        use_encoding(fake=True)
+    if mode == "lazy":
+        # 与python app.py相同, 只启动翻译任务的worker线程
+        from modules.translation_jobs import start_embedded_workers
+        start_embedded_workers()
+    else:
+        from modules import warmup
+        start = time.perf_counter()
+        warmup.preload()
+        warmup.worker_init()
+        timings["warmup"] = time.perf_counter() - start
+    server = make_server("127.0.0.1", port, app.app, threaded=True)
+    with open(timings_path, "w") as file:
+        json.dump(timings, file)
+    server.serve_forever()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def translate(port, index):
+    """
+    :return: 请求成功时返回耗时(秒), 服务还没有监听或返回的code不是200时返回None
+    """
+    body = json.dumps({"text": TEXT.format(index=index), "source_lang": "English", "target_lang": "Chinese"})
+    request = urllib.request.Request(f"http://127.0.0.1:{port}/v1/ai_translate/translate", data=body.encode(),
+                                     headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            result = json.loads(response.read())
+    except (urllib.error.URLError, ConnectionError):
+        return None
+    return time.perf_counter() - start if result.get("code") == 200 else None
+
+
+def listening(port):
+    with socket.socket() as sock:
+        return sock.connect_ex(("127.0.0.1", port)) == 0
+
+
+def run(mode, env, fake_encoding, requests, timeout=120):
+    """
+    启动一个服务进程并测量
+    :return: dict, 各项耗时(秒)
+    """
+    port = free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        timings_path = os.path.join(directory, "timings.json")
+        env = dict(env, TRANSLATION_JOB_DB=os.path.join(directory, "jobs.db"),
+                   TRANSLATION_DOCUMENT_DB=os.path.join(directory, "documents.db"))
+        if mode == "gunicorn":
+            command = ["gunicorn", "-c", "gunicorn.conf.py", "--bind", f"127.0.0.1:{port}", "--workers", "1"]
+        else:
+            command = [sys.executable, os.path.abspath(__file__), "--serve", mode, "--port", str(port),
+                       "--timings", timings_path] + (["--fake-encoding"] if fake_encoding else [])
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while not listening(port):
+                assert process.poll() is None, f"{mode} server exited with code {process.returncode}"
+                assert time.perf_counter() - start < timeout, f"{mode} server did not listen in {timeout}s"
+                time.sleep(0.005)
+            result = {"listen": time.perf_counter() - start}
+            index = 0
+            while True:
+                latency = translate(port, index)
+                index += 1
+                if latency is not None:
+                    break
+                assert time.perf_counter() - start < timeout, f"{mode} server did not succeed in {timeout}s"
+                time.sleep(0.005)
+            result["first_success"] = time.perf_counter() - start
+            result["first_latency"] = latency
+            result["later_latency"] = statistics.median(translate(port, index + offset) or float("nan")
+                                                        for offset in range(requests))
+            if os.path.exists(timings_path):
+                with open(timings_path) as file:
+                    result.update(json.load(file))
+            return result
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="测量服务从启动到第一个翻译请求成功的时间")
+    parser.add_argument("--serve", choices=["lazy", "preload"], help="作为服务进程运行")
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--timings")
+    parser.add_argument("--fake-encoding", action="store_true")
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, args.port, args.fake_encoding, args.timings)
+        return
+
+    from benchmarks.corpus import use_encoding
+    from utils import stubs
+    rounds = int(os.getenv("BENCH_ROUNDS", 3))
+    requests = int(os.getenv("BENCH_REQUESTS", 5))
+    latency = float(os.getenv("BENCH_LLM_LATENCY", 0.05))
+    encoding = use_encoding(fake=os.getenv("BENCH_FAKE_ENCODING") == "1")
+    modes = ["lazy", "preload"]
+    if encoding == "tiktoken" and subprocess.run(["which", "gunicorn"], capture_output=True).returncode == 0:
+        modes.append("gunicorn")
+    else:
+        print("gunicorn is skipped: it needs gunicorn installed and tiktoken available in the server process")
+    with stubs.FakeOpenAIServer(latency=latency) as server:
+        # 服务进程通过环境变量把GPT请求发到假服务器, ES地址不可达, 翻译记忆库检索会直接失败并跳过
+        env = dict(os.environ, AZURE_API_TYPE="open_ai", AZURE_API_BASE=f"{server.url}/v1",
+                   OPENAI_API_KEY="fake-key", ELASTIC_SERVER="http://127.0.0.1:9", ELASTIC_USERNAME="bench",
+                   ELASTIC_PASSWORD="bench")
+        env.pop("AZURE_API_VERSION", None)
+        print(f"encoding: {encoding}, rounds: {rounds}, LLM latency: {latency}s, medians over rounds")
+        print(f"{'mode':>10}{'import(s)':>11}{'warmup(s)':>11}{'listen(s)':>11}{'first ok(s)':>13}"
+              f"{'first req(s)':>14}{'later req(s)':>14}")
+        for mode in modes:
+            results = [run(mode, env, encoding == "fake", requests) for _ in range(rounds)]
+
+            def median(key):
+                values = [item[key] for item in results if key in item]
+                return f"{statistics.median(values):.3f}" if values else "-"
+
+            print(f"{mode:>10}{median('import'):>11}{median('warmup'):>11}{median('listen'):>11}"
+                  f"{median('first_success'):>13}{median('first_latency'):>14}{median('later_latency'):>14}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+流式翻译首字节时间基准测试: 本地假OpenAI服务器, 对比整篇翻译完才返回和流式接口第一个文本块到达的时间
+运行: python benchmarks/bench_stream_ttfb.py
+"""
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(__file__, "..", "..")))
+
+from benchmarks.corpus import use_encoding
+from config.config import cfg
+from app import app
+from modules.translator import AITranslatorModule
+from utils import stubs
+
+SENTENCE = "Microglia belong to tissue-resident macrophages of the central nervous system, representing the primary innate immune cells. "
+
+
+def run(server, token_deltas, sentence_num):
+    client = app.test_client()
+    document = SENTENCE * sentence_num
+    start = time.perf_counter()
+    full = AITranslatorModule(es_client=stubs.FakeElasticsearch()).translate(document + f"full{token_deltas}")
+    full_cost = time.perf_counter() - start
+
+    start = time.perf_counter()
+    response = client.post("/v1/ai_translate/translate_stream",
+                           json={"text": document + f"stream{token_deltas}", "token_deltas": token_deltas})
+    first_byte, chunk_num = None, 0
+    for line in response.response:
+        if first_byte is None:
+            first_byte = time.perf_counter() - start
+        chunk_num += line.startswith(b"event: chunk")
+    stream_cost = time.perf_counter() - start
+    return chunk_num, full_cost, first_byte, stream_cost, len(full)
+
+
+if __name__ == '__main__':
+    use_encoding()
+    # 接口内部会新建ES客户端, 这里只需要能构造出来, 不会真的连接
+    cfg.USE_TRANSLATION_MEMORY = False
+    cfg.CACHE_ENABLED = False
+    cfg.ELASTIC_USERNAME, cfg.ELASTIC_PASSWORD = "bench", "bench"
+    latency = float(os.getenv("STUB_LATENCY", 0.3))
+    with stubs.FakeOpenAIServer(latency=latency, stream_chunk_size=16, stream_interval=0.001) as server:
+        server.configure_openai()
+        print(f"{'sentences':>10}{'deltas':>8}{'chunks':>8}{'full(s)':>10}{'ttfb(s)':>10}{'stream(s)':>11}")
+        for sentence_num in [10, 50, 200]:
+            for token_deltas in [False, True]:
+                chunk_num, full_cost, first_byte, stream_cost, _ = run(server, token_deltas, sentence_num)
+                print(f"{sentence_num:>10}{str(token_deltas):>8}{chunk_num:>8}{full_cost:>10.2f}{first_byte:>10.2f}{stream_cost:>11.2f}")
@@ -0,0 +1,93 @@
+"""
+术语匹配基准测试: 10万条以上术语时, 对比逐条术语在文本块里查找(相当于每个术语/实体一次查询)
+和TerminologyIndex的Aho-Corasick一次扫描, 统计建索引耗时、每个文本块的匹配耗时和新增术语生效的耗时
+运行: python benchmarks/bench_term_index.py
+环境变量: BENCH_TERMS 术语条数, 默认100000; BENCH_CHUNKS 文本块数
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(__file__, "..", "..")))
+
+from modules import term_index
+from utils import stubs
+
+SYLLABLES = ["ka", "lo", "mi", "ne", "ra", "to", "su", "vi", "pe", "do", "gu", "xe", "bo", "ze", "fi", "ha"]
+
+
+def make_word(rng):
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+
+
+def build_terms(term_num, rng):
+    terms = {}
+    while len(terms) < term_num:
+        source = " ".join(make_word(rng) for _ in range(rng.randint(1, 3)))
+        terms[source] = f"术语{len(terms)}"
+    return terms
+
+
+def build_chunks(terms, chunk_num, rng):
+    sources = list(terms)
+    chunks = []
+    for _ in range(chunk_num):
+        words = []
+        while len(words) < 300:
+            words.append(rng.choice(sources) if rng.random() < 0.1 else make_word(rng))
+        chunks.append(" ".join(words) + ".")
+    return chunks
+
+
+def legacy_match(terms, chunk):
+    # 每个术语单独查一次, 代价与术语条数成正比
+    lowered = chunk.lower()
+    return [{source: target} for source, target in terms.items() if source in lowered]
+
+
+def build_index(terms):
+    es_client = stubs.FakeElasticsearch()
+    for doc_id, (source, target) in enumerate(terms.items()):
+        es_client.index("bench", document={"source": source, "target": target, "source_lang": "English",
+                                           "target_lang": "Chinese", "data_tag": "term"}, id=str(doc_id))
+    term_index.cfg.INDEX = "bench"
+    index = term_index.TerminologyIndex(es_client=es_client)
+    start = time.perf_counter()
+    index.load()
+    return index, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    term_num = int(os.getenv("BENCH_TERMS", 100000))
+    chunk_num = int(os.getenv("BENCH_CHUNKS", 200))
+    rng = random.Random(0)
+    terms = build_terms(term_num, rng)
+    chunks = build_chunks(terms, chunk_num, rng)
+    backend = "pyahocorasick" if term_index.ahocorasick is not None else "pure python"
+    print(f"terms: {term_num}, chunks: {chunk_num} x ~300 words, automaton: {backend}")
+
+    index, build_cost = build_index(terms)
+    start = time.perf_counter()
+    matches = index.match("English", "Chinese", chunks)
+    match_cost = time.perf_counter() - start
+
+    legacy_chunks = chunks[:max(1, chunk_num // 20)]
+    start = time.perf_counter()
+    for chunk in legacy_chunks:
+        legacy_match(terms, chunk)
+    legacy_cost = (time.perf_counter() - start) / len(legacy_chunks)
+
+    start = time.perf_counter()
+    index.add([{"source": "brand new term", "target": "新术语", "source_lang": "English",
+                "target_lang": "Chinese", "data_tag": "term"}])
+    hit = index.match("English", "Chinese", ["a brand new term here"])[0]
+    add_cost = time.perf_counter() - start
+
+    print(f"build index: {build_cost:.2f}s")
+    print(f"{'method':>14}{'ms/chunk':>12}{'terms/chunk':>14}")
+    print(f"{'per-term scan':>14}{legacy_cost * 1000:>12.2f}{'-':>14}")
+    print(f"{'aho-corasick':>14}{match_cost / chunk_num * 1000:>12.2f}"
+          f"{sum(len(item) for item in matches) / chunk_num:>14.1f}")
+    print(f"speedup: {legacy_cost / (match_cost / chunk_num):.0f}x")
+    print(f"hot add + match: {add_cost * 1000:.2f}ms, matched: {hit}")
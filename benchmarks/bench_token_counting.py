@@ -0,0 +1,80 @@
+"""
+token计算基准测试: 对比旧实现(每次解析编码器/删历史后全量重算/线性倒扫切分)和现在的实现
+运行: python benchmarks/bench_token_counting.py
+"""
+import os
+import sys
+import time
+
+import tiktoken
+
+sys.path.append(os.path.abspath(os.path.join(__file__, "..", "..")))
+
+from benchmarks.corpus import legacy_force_breakdown, use_encoding
+from config.config import cfg
+from utils import utils
+
+ENCODING = "tiktoken"
+SENTENCE = "Microglia belong to tissue-resident macrophages of the central nervous system. 值得注意的是，今天中特估这个板块又飙了。"
+
+
+def encoding_for_model(model):
+    # 旧实现每次调用都按模型名解析编码器; 离线时用的是FakeEncoding, 只对比计数本身
+    return tiktoken.encoding_for_model(model) if ENCODING == "tiktoken" else utils.get_encoding(model)
+
+
+def legacy_token_usage(text):
+    encoding = encoding_for_model("gpt-3.5-turbo")
+    return len(encoding.encode(text))
+
+
+def legacy_token_usage_from_messages(messages):
+    encoding = encoding_for_model("gpt-3.5-turbo-0301")
+    return sum(4 + sum(len(encoding.encode(value)) for value in message.values()) for message in messages) + 3
+
+
+def legacy_delete_oldest_history_message(message):
+    while legacy_token_usage_from_messages(message) >= cfg.MAX_TOKENS:
+        message.pop(2)
+
+
+def legacy_pack(text_list, limit):
+    chunks, chunk = [], ""
+    for text in text_list:
+        chunk = f"{chunk}{text}"
+        if legacy_token_usage(chunk) >= limit:
+            chunks.append(chunk)
+            chunk = ""
+    return chunks + ([chunk] if chunk else [])
+
+
+def timeit(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    ENCODING = use_encoding()
+    print(f"encoding: {ENCODING}")
+    sentence_tokens = utils.token_usage(SENTENCE)
+    sentences = [SENTENCE] * (100000 // sentence_tokens)
+    document = "".join(sentences)
+    print(f"document tokens: {utils.token_usage(document)}")
+    history = [{"role": "system", "content": "prompt"}, {"role": "user", "content": "prompt"}]
+    history += [{"role": "user", "content": SENTENCE * 20}, {"role": "assistant", "content": SENTENCE * 20}] * 50
+    rows = [
+        ("token_usage x1000 sentences", lambda: [legacy_token_usage(item) for item in sentences[:1000]],
+         lambda: [utils.token_usage(item) for item in sentences[:1000]]),
+        ("pack 100k-token document", lambda: legacy_pack(sentences, cfg.TEXT_TOKEN_LIMIT),
+         lambda: utils.pack_chunks(sentences, cfg.TEXT_TOKEN_LIMIT)),
+        ("trim 100-message history", lambda: legacy_delete_oldest_history_message(list(history)),
+         lambda: utils.delete_oldest_history_message(list(history))),
+        # 旧的倒扫在整篇文档上是平方复杂度, 只取前2万字符测试; 旧的只切出第一段, hard_split切完全部
+        ("hard split 20k chars", lambda: legacy_force_breakdown(document[:20000], 1024, utils.token_usage),
+         lambda: utils.hard_split(document[:20000], 1024)),
+    ]
+    print(f"{'case':<30}{'before(s)':>12}{'after(s)':>12}{'speedup':>10}")
+    for name, before, after in rows:
+        before_cost, after_cost = timeit(before), timeit(after)
+        print(f"{name:<30}{before_cost:>12.3f}{after_cost:>12.3f}{before_cost / after_cost:>9.1f}x")
@@ -0,0 +1,48 @@
+"""
+记忆库向量检索基准测试: 对比flat/ivf/hnsw索引在不同数据量下的批量查询延迟
+运行: python benchmarks/bench_vector_index.py
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(__file__, "..", "..")))
+
+from utils.vector_index import build_index, hnswlib
+
+DIM = int(os.getenv("BENCH_VECTOR_DIM", 1536))
+SIZES = [1000, 10000, 100000]
+QUERY_BATCH = 16
+REPEAT = 5
+
+
+def bench(index_type, size, rng):
+    vectors = rng.standard_normal((size, DIM), dtype=np.float32)
+    index = build_index(index_type, DIM)
+    start = time.perf_counter()
+    index.add([str(i) for i in range(size)], vectors, [i for i in range(size)])
+    if index_type == "ivf":
+        index.train()
+    build_cost = time.perf_counter() - start
+    # 查询向量取已有向量加少量噪声, 同时统计召回率
+    targets = rng.choice(size, QUERY_BATCH, replace=False)
+    queries = vectors[targets] + rng.standard_normal((QUERY_BATCH, DIM), dtype=np.float32) * 0.1
+    index.search(queries, 5)
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        hits = index.search(queries, 5)
+    query_cost = (time.perf_counter() - start) / REPEAT / QUERY_BATCH
+    recall = np.mean([hit[0][1] == target for hit, target in zip(hits, targets)])
+    return build_cost, query_cost, recall
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    index_types = ["flat", "ivf"] + (["hnsw"] if hnswlib is not None else [])
+    print(f"{'type':>6}{'size':>10}{'build(s)':>10}{'query(ms)':>11}{'recall@1':>10}")
+    for size in SIZES:
+        for index_type in index_types:
+            build_cost, query_cost, recall = bench(index_type, size, rng)
+            print(f"{index_type:>6}{size:>10}{build_cost:>10.2f}{query_cost * 1000:>11.3f}{recall:>10.2f}")
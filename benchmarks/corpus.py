@@ -0,0 +1,103 @@
+"""
+基准测试用的固定语料: 按随机种子生成短/中/长三档的中英混合文档, 同样的种子每次生成的内容相同, 不同提交之间的结果可以直接对比;
+以及各个基准测试共用的token编码器设置, 离线环境没有tiktoken的BPE文件时也能运行
+"""
+import random
+
+from utils import stubs, utils
+
+ENGLISH = [
+    "Microglia belong to tissue-resident macrophages of the central nervous system (CNS), representing the primary "
+    "innate immune cells.",
+    "This cell type constitutes ~7% of non-neuronal cells in the mammalian brain and has a variety of biological roles "
+    "integral to homeostasis and pathophysiology from the late embryonic to adult brain.",
+    "Its unique identity that distinguishes its \"glial\" features from tissue-resident macrophages resides in the fact "
+    "that once entering the CNS, it is perennially exposed to a unique environment.",
+    "Additionally, tissue-resident macrophage progenies derive from various peripheral sites that exhibit hematopoietic "
+    "potential.",
+    "The quarterly report shows revenue of 262,281.9 million, up 7.1% year on year.",
+    "Please restart the service after updating the configuration file.",
+    "Latency at the 99th percentile dropped from 850 ms to 310 ms after the change.",
+]
+CHINESE = [
+    "值得注意的是，《意见》还提到，要扎实做好稳地价、稳房价、稳预期工作，稳妥有序推进房地产风险化解处置。",
+    "严格落实地方政府债务限额管理，坚决遏制新增隐性债务。",
+    "值得注意的是，今天中特估这个板块又飙了，可以说对市场起到了较大的支撑作用。",
+    "那么，究竟是何缘故呢？",
+    "首先，从财政部的数据来看，1—4月，国有企业营业总收入262281.9亿元，同比增长7.1%。",
+    "从利润总额来看，1—4月，国有企业利润总额14388.1亿元，同比增长15.1%。",
+    "小胶质细胞属于中枢神经系统的组织驻留巨噬细胞，是主要的先天免疫细胞。",
+]
+# 每档文档的(句子数范围, 默认篇数)
+SIZES = {
+    "short": ((1, 2), 200),
+    "medium": ((15, 25), 20),
+    "long": ((150, 220), 3),
+}
+
+
+def build_sentence(rng, cjk_ratio):
+    sentence = rng.choice(CHINESE) if rng.random() < cjk_ratio else rng.choice(ENGLISH)
+    # 偶尔在英文句子里混入中文术语
+    if rng.random() < 0.1 and sentence.isascii():
+        sentence = sentence.replace(" the ", " the 中枢神经 ", 1)
+    return sentence
+
+
+def build_document(rng, sentence_num, cjk_ratio=0.3):
+    """
+    :param rng: random.Random
+    :param sentence_num: 句子数
+    :param cjk_ratio: 中文句子的比例
+    :return: 每3~6句分一段的文档
+    """
+    paragraphs, sentences = [], []
+    for _ in range(sentence_num):
+        sentences.append(build_sentence(rng, cjk_ratio))
+        if len(sentences) >= rng.randint(3, 6):
+            paragraphs.append(" ".join(sentences))
+            sentences = []
+    if sentences:
+        paragraphs.append(" ".join(sentences))
+    return "\n\n".join(paragraphs)
+
+
+def build_corpus(seed=0, counts=None):
+    """
+    :param seed: 随机种子
+    :param counts: dict, 每档的篇数, 默认按SIZES
+    :return: dict, short/medium/long -> 文档列表
+    """
+    rng = random.Random(seed)
+    counts = counts or {}
+    corpus = {}
+    for size, ((low, high), default_count) in SIZES.items():
+        corpus[size] = [build_document(rng, rng.randint(low, high)) for _ in range(counts.get(size, default_count))]
+    return corpus
+
+
+def legacy_force_breakdown(txt, limit, get_token_fn):
+    """
+    旧的硬切分: 从后往前逐个字符缩短前缀, 直到token数小于limit, 现在由utils.hard_split代替
+    """
+    for i in reversed(range(len(txt))):
+        if get_token_fn(txt[:i]) < limit:
+            return txt[:i], txt[i:]
+
+
+def use_encoding(fake=False):
+    """
+    每个基准测试开始前调用: 优先用tiktoken, 离线环境没有缓存BPE文件时换成stubs.FakeEncoding
+    :param fake: 是否直接用FakeEncoding
+    :return: tiktoken/fake, 结果里要注明用的是哪个
+    """
+    if not fake:
+        try:
+            utils.get_encoding("gpt-3.5-turbo")
+            utils.get_encoding(utils.MESSAGE_TOKEN_MODELS["gpt35"])
+            return "tiktoken"
+        except Exception as err:
+            print(f"tiktoken is unavailable, fall back to FakeEncoding! detail: {err}")
+    encoding = stubs.FakeEncoding()
+    utils.get_encoding = lambda model="gpt-3.5-turbo": encoding
+    return "fake"
@@ -0,0 +1,117 @@
+"""
+异步服务(asgi.py)与Flask服务(app.py)的压力测试对比, 上游GPT用本地假OpenAI服务器, 报告每秒请求数和延迟分位数
+Flask的/translate接口目前解包返回值有问题, 这里用/translate_stream的jsonl格式代替, 两边做的翻译工作相同
+运行: python benchmarks/load_async_vs_flask.py
+环境变量: LOAD_REQUESTS 总请求数, LOAD_CONCURRENCY 并发数, STUB_LATENCY 假GPT的延迟(秒)
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+import aiohttp
+from werkzeug.serving import make_server
+
+sys.path.append(os.path.abspath(os.path.join(__file__, "..", "..")))
+
+from benchmarks.corpus import use_encoding
+from config.config import cfg
+from app import app as flask_app
+from asgi import app as asgi_app
+from utils import stubs
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+TEXT = "Microglia belong to tissue-resident macrophages of the central nervous system."
+
+
+def start_flask():
+    server = make_server("127.0.0.1", 0, flask_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/v1/ai_translate/translate_stream"
+
+
+def start_asgi():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config(asgi_app, log_level="error", backlog=2048))
+    threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, f"http://127.0.0.1:{sock.getsockname()[1]}/v1/ai_translate/translate"
+
+
+async def load(url, request_num, concurrency):
+    """
+    用concurrency个并发连接发送request_num个翻译请求
+    :return: (每个成功请求的延迟列表, 失败数, 总耗时)
+    """
+    latencies, errors = [], 0
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=300)) as session:
+        async def one(index):
+            nonlocal errors
+            payload = {"text": f"{TEXT} #{index}", "stream_format": "jsonl"}
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    async with session.post(url, json=payload) as response:
+                        body = await response.text()
+                    last = json.loads(body.strip().splitlines()[-1])
+                    translated = last.get("translated") or last.get("data", {}).get("translated")
+                    if not translated:
+                        raise ValueError(body[:200])
+                    latencies.append(time.perf_counter() - start)
+                except Exception as err:
+                    errors += 1
+                    if errors <= 3:
+                        print(f"  request failed: {err}")
+
+        start = time.perf_counter()
+        await asyncio.gather(*[one(index) for index in range(request_num)])
+    return latencies, errors, time.perf_counter() - start
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def report(name, latencies, errors, elapsed):
+    print(f"{name:>8}{len(latencies) / elapsed:>10.1f}{percentile(latencies, 50) * 1000:>10.0f}"
+          f"{percentile(latencies, 99) * 1000:>10.0f}{errors:>8}")
+
+
+if __name__ == '__main__':
+    use_encoding()
+    cfg.USE_TRANSLATION_MEMORY = False
+    cfg.CACHE_ENABLED = False
+    # Flask接口用同步ES客户端, 这里只需要能构造出来, 不会真的连接
+    cfg.ELASTIC_USERNAME, cfg.ELASTIC_PASSWORD = "load", "load"
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    request_num = int(os.getenv("LOAD_REQUESTS", 1000))
+    concurrency = int(os.getenv("LOAD_CONCURRENCY", 200))
+    latency = float(os.getenv("STUB_LATENCY", 0.2))
+    with stubs.FakeOpenAIServer(latency=latency) as fake:
+        fake.configure_openai()
+        print(f"requests: {request_num}, concurrency: {concurrency}, upstream latency: {latency}s")
+        print(f"{'server':>8}{'req/s':>10}{'p50(ms)':>10}{'p99(ms)':>10}{'errors':>8}")
+        flask_server, flask_url = start_flask()
+        report("flask", *asyncio.run(load(flask_url, request_num, concurrency)))
+        flask_server.shutdown()
+        if uvicorn is None:
+            print("asgi is skipped: it needs uvicorn, please `pip install uvicorn`")
+            sys.exit(0)
+        asgi_server, asgi_url = start_asgi()
+        report("asgi", *asyncio.run(load(asgi_url, request_num, concurrency)))
+        asgi_server.should_exit = True
@@ -0,0 +1,220 @@
+"""
+离线基准测试套件: GPT和embedding请求发到本地的FakeOpenAIServer(可配置延迟、截断和报错比例), ES用内存替身,
+语料为benchmarks/corpus.py按固定种子生成的中英混合文档, 依次跑切分、token计算、端到端翻译、批量翻译和反馈导入,
+每个场景跑若干轮取统计值, 结果写成JSON报告, 传入上一次的报告时逐个场景对比中位数, 变慢超过阈值时以非0退出
+运行: python benchmarks/run_suite.py --output bench_report.json [--compare baseline.json]
+环境变量: BENCH_LLM_LATENCY 假GPT每个请求的延迟(秒), BENCH_TRUNCATE_RATE 回复被截断的比例, BENCH_ERROR_RATE 第一次请求报错的比例
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(__file__, "..", "..")))
+
+from benchmarks.corpus import build_corpus, use_encoding
+from config.config import cfg, TranslationContext
+from modules.batch_translator import BatchTranslatorModule
+from modules.feedback_ingest import FeedbackIngestor
+from modules.translator import AITranslatorModule
+from utils import embedding_service, stubs, utils
+from utils.cache import NullCache
+
+
+def use_fresh_embedding_service():
+    # 每轮重新建embedding服务, 避免后面几轮都命中向量缓存
+    embedding_service._embedding_service = embedding_service.EmbeddingService(
+        store=embedding_service.EmbeddingStore(cfg.VECTOR_DIM))
+
+
+class Suite:
+    def __init__(self, corpus, server):
+        """
+        :param corpus: build_corpus的结果
+        :param server: 已启动的FakeOpenAIServer
+        """
+        self.corpus = corpus
+        self.server = server
+        self.ctx = TranslationContext.create("gpt35")
+        sentences = [sentence for doc in corpus["medium"] for sentence in doc.split("\n\n")]
+        self.sentences = sentences
+        self.messages = [[{"role": "system", "content": "translate"}, {"role": "user", "content": doc}]
+                         for doc in corpus["short"]]
+        self.batch_items = [{"text": doc, "source_lang": "English", "target_lang": "Chinese"}
+                            for doc in corpus["short"]] * 2
+        self.records = [{"source": doc, "target": f"[译]{doc}"} for doc in corpus["short"] + corpus["medium"]]
+
+    def scenarios(self):
+        """
+        :return: [(场景名, 每轮执行的函数)], 函数返回本轮处理的条数
+        """
+        return [
+            ("segmentation", self.segmentation),
+            ("token_counting", self.token_counting),
+            ("translate_short", self.translate_short),
+            ("translate_long", lambda: self.translate_long(parallel=False)),
+            ("translate_long_parallel", lambda: self.translate_long(parallel=True)),
+            ("translate_batch", self.translate_batch),
+            ("feedback_ingest", self.feedback_ingest),
+        ]
+
+    def translator(self):
+        return AITranslatorModule(cache=NullCache(), es_client=stubs.FakeElasticsearch(), ctx=self.ctx)
+
+    def segmentation(self):
+        docs = self.corpus["medium"] + self.corpus["long"]
+        for doc in docs:
+            utils.pack_segments(utils.split_segments(doc, self.ctx.text_token_limit), self.ctx.text_token_limit)
+        return len(docs)
+
+    def token_counting(self):
+        utils.token_usage_batch(self.sentences)
+        for message in self.messages:
+            utils.prompt_token_usage(message, self.ctx)
+        return len(self.sentences) + len(self.messages)
+
+    def translate_short(self):
+        docs = self.corpus["short"][:50]
+        for doc in docs:
+            self.translator().translate(doc)
+        return len(docs)
+
+    def translate_long(self, parallel):
+        for doc in self.corpus["long"]:
+            self.translator().translate(doc, parallel=parallel)
+        return len(self.corpus["long"])
+
+    def translate_batch(self):
+        results = BatchTranslatorModule(cache=NullCache(), es_client=stubs.FakeElasticsearch(),
+                                        ctx=self.ctx).translate_batch(self.batch_items)
+        failed = [result["error"] for result in results if result["error"]]
+        assert not failed, failed[0]
+        return len(self.batch_items)
+
+    def feedback_ingest(self):
+        use_fresh_embedding_service()
+        for _ in FeedbackIngestor(es_client=stubs.FakeElasticsearch()).ingest(iter(self.records), "English",
+                                                                               "Chinese"):
+            pass
+        return len(self.records)
+
+
+def measure(fn, rounds, server):
+    """
+    先预热一轮, 再跑rounds轮
+    :return: 场景的统计结果
+    """
+    fn()
+    times, ops = [], 0
+    calls = server.calls
+    for _ in range(rounds):
+        start = time.perf_counter()
+        ops = fn()
+        times.append(time.perf_counter() - start)
+    median = statistics.median(times)
+    return {
+        "rounds": rounds,
+        "ops": ops,
+        "min": round(min(times), 6),
+        "median": round(median, 6),
+        "mean": round(statistics.mean(times), 6),
+        "max": round(max(times), 6),
+        "stdev": round(statistics.stdev(times), 6) if rounds > 1 else 0.0,
+        "ops_per_sec": round(ops / median, 2) if median else None,
+        "llm_calls_per_round": round((server.calls - calls) / rounds, 1),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def compare(report, baseline, threshold):
+    """
+    对比两次报告的中位数
+    :return: 变慢超过阈值的场景列表
+    """
+    if baseline["meta"].get("encoding") != report["meta"].get("encoding"):
+        print(f"warning: baseline uses {baseline['meta'].get('encoding')} encoding, "
+              f"this run uses {report['meta'].get('encoding')}")
+    regressions = []
+    print(f"{'scenario':>26}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, result in report["scenarios"].items():
+        base = baseline["scenarios"].get(name)
+        if not base or not base.get("median"):
+            print(f"{name:>26}{'-':>12}{result['median']:>12.4f}{'new':>10}")
+            continue
+        change = result["median"] / base["median"] - 1
+        flag = " REGRESSION" if change > threshold else ""
+        print(f"{name:>26}{base['median']:>12.4f}{result['median']:>12.4f}{change:>+10.1%}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线基准测试套件")
+    parser.add_argument("--output", default="bench_report.json", help="JSON报告的路径")
+    parser.add_argument("--compare", help="用来对比的上一次报告")
+    parser.add_argument("--threshold", type=float, default=0.2, help="中位数变慢超过这个比例算退化")
+    parser.add_argument("--rounds", type=int, default=5, help="每个场景跑的轮数")
+    parser.add_argument("--scenarios", help="只跑这些场景, 逗号分隔")
+    parser.add_argument("--seed", type=int, default=0, help="语料的随机种子")
+    parser.add_argument("--fake-encoding", action="store_true", help="不用tiktoken, 用FakeEncoding计算token")
+    args = parser.parse_args()
+
+    server_options = {
+        "latency": float(os.getenv("BENCH_LLM_LATENCY", 0.002)),
+        "truncate_rate": float(os.getenv("BENCH_TRUNCATE_RATE", 0.05)),
+        "error_rate": float(os.getenv("BENCH_ERROR_RATE", 0.02)),
+    }
+    encoding = use_encoding(args.fake_encoding)
+    # 不限流, 退避时间缩短, 测的是本项目的开销而不是配额
+    cfg.LLM_RATE_LIMITS = {}
+    cfg.LLM_BACKOFF_BASE = 0.01
+    selected = set(args.scenarios.split(",")) if args.scenarios else None
+
+    report = {
+        "meta": {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "encoding": encoding,
+            "seed": args.seed,
+            "server": server_options,
+        },
+        "scenarios": {},
+    }
+    with stubs.FakeOpenAIServer(**server_options) as server:
+        server.configure_openai()
+        suite = Suite(build_corpus(args.seed), server)
+        for name, fn in suite.scenarios():
+            if selected and name not in selected:
+                continue
+            result = report["scenarios"][name] = measure(fn, args.rounds, server)
+            print(f"{name:>26}  median {result['median']:.4f}s  {result['ops_per_sec']} ops/s  "
+                  f"{result['llm_calls_per_round']} llm calls/round")
+        report["meta"]["server"]["counters"] = dict(server.counters)
+
+    with open(args.output, "w", encoding="utf-8") as report_file:
+        json.dump(report, report_file, ensure_ascii=False, indent=2)
+    print(f"report saved to {args.output}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as baseline_file:
+            regressions = compare(report, json.load(baseline_file), args.threshold)
+        if regressions:
+            print(f"regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
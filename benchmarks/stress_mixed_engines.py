@@ -0,0 +1,74 @@
+"""
+多线程并发压力测试: 多线程的Flask服务同时处理不同engine的翻译请求, 检查每个请求用到的engine和max_tokens都是自己的
+假OpenAI服务器把收到的engine、max_tokens是否等于按这个engine的上下文算出的回复预算写进译文里, 请求之间如果互相串了配置就会被发现,
+跑完后再检查按engine创建的上下文的max_tokens没有被改动
+运行: python benchmarks/stress_mixed_engines.py
+"""
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import make_server
+
+sys.path.append(os.path.abspath(os.path.join(__file__, "..", "..")))
+
+from benchmarks.corpus import use_encoding
+from config.config import cfg, TranslationContext
+from app import app
+from utils import stubs, utils
+
+ENGINES = ["gpt35", "gpt4-8k", "gpt4-32k"]
+
+
+class EchoConfigServer(stubs.FakeOpenAIServer):
+    def reply(self, body):
+        text = json.loads(stubs.fake_translation(body["messages"][-1]["content"], prefix=""))["result"]
+        # 回复的max_tokens按输入大小预算, 与engine的上下文窗口不同, 这里按收到的engine重新算一遍对比
+        _, budget = utils.output_budget(body["messages"], TranslationContext.create(body.get("engine")))
+        return json.dumps({"result": f"{body.get('engine')}|{body.get('max_tokens') == budget}|{text}"})
+
+
+def request_translate(base_url, index):
+    engine = random.choice(ENGINES)
+    text = f"request {index} with {engine}"
+    payload = json.dumps({"text": text, "engine": engine, "stream_format": "jsonl"}).encode("utf-8")
+    req = urllib.request.Request(f"{base_url}/v1/ai_translate/translate_stream", data=payload,
+                                 headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=60) as response:
+        events = [json.loads(line) for line in response.read().decode("utf-8").splitlines() if line]
+    translated = events[-1].get("translated", events[-1])
+    expected = f"{engine}|True|{text}"
+    return translated == expected, expected, translated
+
+
+if __name__ == '__main__':
+    use_encoding()
+    # 接口内部会新建ES客户端, 这里只需要能构造出来, 不会真的连接
+    cfg.USE_TRANSLATION_MEMORY = False
+    cfg.CACHE_ENABLED = False
+    cfg.ELASTIC_USERNAME, cfg.ELASTIC_PASSWORD = "stress", "stress"
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    request_num = int(os.getenv("STRESS_REQUESTS", 300))
+    with EchoConfigServer(latency=0.02) as fake:
+        fake.configure_openai()
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            results = list(executor.map(lambda index: request_translate(base_url, index), range(request_num)))
+        server.shutdown()
+    failed = [item for item in results if not item[0]]
+    for engine in ENGINES:
+        max_tokens = TranslationContext.create(engine).max_tokens
+        if max_tokens != cfg.ENGINE_TOKENS_MAPPING[engine]:
+            failed.append((False, f"{engine} max_tokens {cfg.ENGINE_TOKENS_MAPPING[engine]}",
+                           f"{engine} max_tokens {max_tokens}"))
+    print(f"requests: {len(results)}, mismatched: {len(failed)}")
+    for _, expected, translated in failed[:10]:
+        print(f"  expected {expected!r}, got {translated!r}")
+    sys.exit(1 if failed else 0)
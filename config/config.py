@@ -1,7 +1,10 @@
 """
 这个文件包含整个应用的配置参数
 """
+import json
 import os
+from dataclasses import dataclass, replace
+
 import openai
 
 
@@ -14,6 +17,9 @@ class Config:
     ELASTIC_PASSWORD = os.getenv("ELASTIC_PASSWORD")
     # 语料库ES索引
     INDEX = ""
+    # 运行时数据(SQLite文件、导入断点)的目录, 默认为项目根目录下的data, 不随启动时的工作目录变化
+    DATA_DIR = os.getenv("TRANSLATION_DATA_DIR") or os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
     # openai密钥
     openai.api_key = os.environ.get("OPENAI_API_KEY")
     # 是否用Azure的openai?
@@ -29,17 +35,45 @@ class Config:
     TEXT_LENGTH_LIMIT = 2000
     # embedding向量维度
     VECTOR_DIM = 1536
+    # embedding模型名
+    EMBEDDING_MODEL = "text-embedding-ada-002"
+    # embedding向量的磁盘缓存目录, 内存映射读取, 进程内只保留键到行号的映射; 设为空字符串时只缓存在内存里
+    EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", os.path.join(DATA_DIR, "embeddings"))
+    # 只缓存在内存里时最多保留的向量条数, 超过时淘汰最久没用过的
+    EMBEDDING_MEMORY_MAX_SIZE = 50000
+    # 一次embedding请求最多的文本条数, Azure的ada-002每次最多16条
+    EMBEDDING_BATCH_SIZE = 16
+    # 一次embedding请求最多的token数
+    EMBEDDING_BATCH_TOKENS = 8000
+    # 同时进行的embedding请求数
+    EMBEDDING_CONCURRENCY = 4
     # 搜索最相似的K条数据返回
     DEFAULT_TOP_K = 1
     # 反馈数据插入数据库的最大尝试次数
     DATA_INSERT_TRY_NUM = 20
+    # 反馈数据插入失败后重试的初始退避时间(秒), 之后每次翻倍并加随机抖动
+    DATA_INSERT_BACKOFF_BASE = 0.2
+    # 反馈数据插入重试的最大退避时间(秒)
+    DATA_INSERT_BACKOFF_MAX = 5.0
+    # 批量导入人工反馈时每批查重和embedding的条数
+    INGEST_BATCH_SIZE = 500
+    # 批量导入时并发写ES的线程数
+    INGEST_BULK_THREADS = 4
+    # 批量导入时每个bulk请求的文档数
+    INGEST_BULK_CHUNK = 500
+    # 批量导入时每处理多少条保存一次断点并报告进度
+    INGEST_CHECKPOINT_EVERY = 5000
+    # HTTP导入接口保存断点的目录
+    INGEST_CHECKPOINT_DIR = os.getenv("INGEST_CHECKPOINT_DIR") or os.path.join(DATA_DIR, "feedback_ingest_checkpoints")
     # 是否要搜索术语对资料
     IS_SEARCH_TERM_DATA = False
-    # 支持的语言
-    SUPPORTED_LANGUAGES = [
-        "English",
-        "Chinese"
-    ]
+    # 支持的语言列表文件, 每项为{"name": 语言名, "code": 语言代码, "aliases": [别名]}, 接口参数可用语言名、代码或别名
+    LANGUAGES_PATH = os.getenv("LANGUAGES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "languages.json"))
+    # 一次请求翻译成多种目标语言时的方式: fanout为每种目标语言并发翻译, 延迟与单目标相同;
+    # joint为每个文本块一个prompt同时翻译成所有目标语言, prompt的token数少得多, 但逐块翻译时回复更长、延迟更高
+    MULTI_TARGET_MODE = "fanout"
+    # 一次请求最多的目标语言数
+    MULTI_TARGET_MAX = 8
     # 不同模型有不同的MAX TOKENS
     ENGINE_TOKENS_MAPPING = {
         "gpt35": 4096,  # gpt-35-turbo
@@ -51,6 +85,170 @@ class Config:
     MAX_TOKENS = 4096
     # 文本token限制, 这是对输入给GPT的文本token数量而言,即每次翻译大概TEXT_TOKEN_LIMIT的量, 这个变量应该至少小于MAX_TOKENS的一半以上, 最好是MAX_TOKENS的1/4
     TEXT_TOKEN_LIMIT = MAX_TOKENS // 4
+    # 译文与原文token数之比的预估, 用于按输入确定回复的max_tokens和给回复预留token, 英译中时中文的token数通常多于英文
+    OUTPUT_TOKEN_RATIO = 2.0
+    # 回复里json格式等固定开销的token数
+    OUTPUT_TOKEN_OVERHEAD = 32
+    # 回复因max_tokens被截断时最多请求继续输出的次数
+    MAX_CONTINUATIONS = 3
+    # 长文本是否默认并行翻译各个文本块
+    PARALLEL_TRANSLATE = False
+    # 并行翻译时的最大并发数
+    TRANSLATE_CONCURRENCY = 8
+    # 逐块翻译时最多带上前几个文本块的原文/译文作为历史
+    HISTORY_MAX_TURNS = 2
+    # 逐块翻译时历史最多占用的token数, 0表示只受上下文窗口限制
+    HISTORY_MAX_TOKENS = 1024
+    # 并行翻译时每个文本块携带的前文窗口大小(前几个文本块的原文/译文作为上下文)
+    PARALLEL_CONTEXT_WINDOW = 2
+    # 是否启用翻译结果缓存
+    CACHE_ENABLED = True
+    # 内存缓存的最大条数
+    CACHE_MAX_SIZE = 10000
+    # 缓存有效期(秒), 0表示永不过期
+    CACHE_TTL = 7 * 24 * 3600
+    # 磁盘缓存的SQLite文件路径, 不配置则只用内存缓存
+    CACHE_DB_PATH = os.getenv("TRANSLATION_CACHE_DB")
+    # prompt版本号, 修改prompt后要更新, 使旧的缓存失效
+    PROMPT_VERSION = "v2"
+    # 相同文本、语言对和engine的并发翻译(整篇和文本块)是否合并为一次, 后到的请求等先到的请求的结果
+    COALESCE_TRANSLATIONS = True
+    # 翻译前是否先用人工反馈的记忆库精确匹配, 命中的部分不再请求GPT
+    USE_TRANSLATION_MEMORY = True
+    # 记忆库相似检索方式: flat/ivf/hnsw为进程内向量索引(hnsw需要安装hnswlib), es为ES的script_score逐条扫描
+    VECTOR_INDEX_TYPE = "flat"
+    # 进程内向量索引与ES同步的间隔(秒)
+    VECTOR_INDEX_SYNC_INTERVAL = 600
+    # 相似记忆作为参考的最低余弦相似度
+    REFERENCE_MIN_SCORE = 0.85
+    # 术语表文件(TMX/CSV/JSONL), 与ES里data_tag为term的术语一起加载到进程内的术语索引
+    GLOSSARY_PATH = os.getenv("GLOSSARY_PATH")
+    # 术语表文件的(源语言, 目标语言)
+    GLOSSARY_LANGS = ("English", "Chinese")
+    # 术语索引与ES同步的间隔(秒), 术语表文件有修改时也会重新加载
+    TERM_INDEX_SYNC_INTERVAL = 600
+    # 进程内新增的术语超过这个数时在后台全量重建术语索引
+    TERM_DELTA_MAX_SIZE = 1000
+    # 每个文本块最多带的术语参考条数
+    TERM_MAX_REFERENCES = 50
+    # 翻译接口默认的文档格式: text为普通文本, markdown/html只翻译其中的文本, 代码块、链接地址、标签等原样保留, auto按内容判断
+    DEFAULT_DOC_FORMAT = "text"
+    # markdown/html的文本单元译文里占位符漏掉或顺序不对时单独重新翻译的次数, 仍然不对时这个单元保留原文
+    PLACEHOLDER_RETRY_NUM = 1
+    # 批量翻译时, token数不超过这个值的短文本会被合并到同一个prompt里翻译
+    BATCH_PACK_ITEM_TOKENS = 200
+    # 批量翻译时一个prompt最多合并的文本条数
+    BATCH_PACK_MAX_ITEMS = 40
+    # 批量翻译一次请求最多的文本条数
+    BATCH_MAX_ITEMS = 5000
+    # 每个engine每分钟的请求数(rpm)和token数(tpm)上限, 按Azure的配额配置, 不在这里的engine不限流
+    LLM_RATE_LIMITS = {
+        "gpt35": {"rpm": 1440, "tpm": 240000},
+        "gpt4-8k": {"rpm": 120, "tpm": 20000},
+        "gpt4-32k": {"rpm": 360, "tpm": 60000},
+    }
+    # 令牌桶的容量相当于多少秒的配额, Azure按1~10秒的窗口检查rpm/tpm, 容量过大会一下子打满配额
+    LLM_RATE_BURST_SECONDS = 10
+    # GPT请求遇到429/5xx/超时的最大重试次数
+    LLM_MAX_RETRIES = 6
+    # 重试的初始退避时间(秒), 之后每次翻倍并加随机抖动
+    LLM_BACKOFF_BASE = 1.0
+    # 重试的最大退避时间(秒)
+    LLM_BACKOFF_MAX = 60.0
+    # GPT后端列表(JSON), 同一engine可以配置多个后端: Azure的多个部署/区域、openai或本地兼容openai接口的服务, 每项的字段:
+    # name 后端名(用于限流、指标和统计, LLM_RATE_LIMITS里可以按后端名单独配置配额), engine ENGINE_TOKENS_MAPPING里的模型名,
+    # deployment Azure的部署名或model openai的模型名, api_base/api_key/api_type/api_version 不配置时用openai的全局配置,
+    # max_tokens 上下文窗口, 默认按engine; 没有配置后端的engine按原来的方式请求
+    LLM_BACKENDS = json.loads(os.getenv("LLM_BACKENDS") or "[]")
+    # engine -> 可以代替它的其他engine, 如{"gpt35": ["gpt4-8k"]}, 这些engine的后端也参与路由
+    LLM_ENGINE_FALLBACKS = {}
+    # 统计每个后端延迟和错误率的最近请求数
+    ENGINE_HEALTH_WINDOW = 100
+    # 后端连续失败多少次后熔断, 熔断期间只在没有其他后端时使用
+    ENGINE_FAILURE_THRESHOLD = 3
+    # 熔断的时间(秒), 之后重新参与路由, 成功一次即恢复
+    ENGINE_COOLDOWN = 30
+    # 随机选一个非最快的健康后端的比例, 使各后端的延迟统计保持更新
+    ENGINE_EXPLORE_RATIO = 0.02
+    # 请求超过后端延迟的这个分位数还没返回时, 向下一个后端发出对冲请求, 先返回的结果生效
+    ENGINE_HEDGE_QUANTILE = 0.95
+    # 是否开启对冲请求, 只在engine有多个后端时生效
+    ENGINE_HEDGE_ENABLED = True
+    # 后端至少有多少次请求的延迟数据才计算对冲的等待时间
+    ENGINE_HEDGE_MIN_SAMPLES = 20
+    # 对冲请求数最多占总请求数的比例, 所有后端都变慢时不会让请求量翻倍
+    ENGINE_HEDGE_MAX_RATIO = 0.1
+    # 开启对冲时同步请求在这个线程池里发出, 应不小于同时进行的GPT请求数
+    ENGINE_HEDGE_THREADS = 128
+    # 同时进行的对冲最多有几个, 同步请求输掉的一方发出后不能取消, 会占着线程和限流配额直到返回
+    ENGINE_HEDGE_MAX_CONCURRENT = 16
+    # 长文档翻译任务的SQLite文件, API进程和worker进程共用
+    JOB_DB_PATH = os.getenv("TRANSLATION_JOB_DB") or os.path.join(DATA_DIR, "translation_jobs.db")
+    # 按文档id保存的上一版文本块和译文, 编辑后重新提交时只翻译改动的部分
+    DOCUMENT_DB_PATH = os.getenv("TRANSLATION_DOCUMENT_DB") or os.path.join(DATA_DIR, "translation_documents.db")
+    # 单独运行worker(python -m modules.translation_jobs)时默认的线程数
+    JOB_WORKERS = 4
+    # API进程里顺带运行的worker线程数, 单独部署worker时设为0
+    JOB_EMBEDDED_WORKERS = int(os.getenv("JOB_EMBEDDED_WORKERS", 2))
+    # worker领取任务的租约(秒), 每翻译完一个文本块续租, 过期未续租视为worker崩溃, 任务可被其他worker接着翻译
+    JOB_LEASE_SECONDS = 600
+    # 任务最多尝试的次数
+    JOB_MAX_ATTEMPTS = 3
+    # 没有任务时worker轮询的间隔(秒)
+    JOB_POLL_INTERVAL = 1.0
+    # 翻译任务的文本最大字符数
+    JOB_TEXT_LENGTH_LIMIT = 2000000
+    # 异步服务(asgi.py)里GPT/embedding请求共用的HTTP连接池大小
+    ASYNC_HTTP_POOL_SIZE = 200
+    # 异步服务里ES客户端的最大连接数
+    ASYNC_ES_MAXSIZE = 50
+    # 异步服务里单个上游HTTP请求的超时时间(秒)
+    ASYNC_REQUEST_TIMEOUT = 120
+    # tiktoken的BPE文件目录, 部署前用python -m modules.warmup --bundle-tiktoken下载好, 离线环境从这里加载编码器
+    TIKTOKEN_CACHE_DIR = os.getenv("TIKTOKEN_CACHE_DIR") or os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tiktoken_cache")
+    # 启动时预先构造初始prompt并计算token数的语言对
+    WARMUP_LANGUAGE_PAIRS = [("English", "Chinese"), ("Chinese", "English")]
 
 
 cfg = Config()
+
+
+@dataclass(frozen=True)
+class TranslationContext:
+    """
+    单次翻译请求的上下文, 创建后不可修改, 代替在cfg上按请求改写engine和token限制, 多线程下各请求互不影响
+    """
+    # 使用的模型名
+    engine: str
+    # 源语言
+    source_lang: str
+    # 目标语言
+    target_lang: str
+    # 是否要搜索术语对资料
+    is_search_term: bool
+    # GPT模型最大token数量
+    max_tokens: int
+    # 每次翻译的文本token限制
+    text_token_limit: int
+    # GPT调度的优先级通道, interactive(在线请求)优先于batch(批量任务)
+    priority: str = "interactive"
+
+    @classmethod
+    def create(cls, engine=None, source_lang="English", target_lang="Chinese", is_search_term=None,
+               priority="interactive"):
+        """
+        按engine计算token限制, 未指定的参数取cfg里的默认值
+        """
+        engine = engine or cfg.AZURE_GPT_ENGINE
+        max_tokens = cfg.ENGINE_TOKENS_MAPPING.get(engine, 4096)
+        is_search_term = cfg.IS_SEARCH_TERM_DATA if is_search_term is None else is_search_term
+        return cls(engine=engine, source_lang=source_lang, target_lang=target_lang,
+                   is_search_term=bool(is_search_term), max_tokens=max_tokens, text_token_limit=max_tokens // 4,
+                   priority=priority)
+
+    def replace(self, **changes):
+        """
+        返回修改了部分字段的新上下文
+        """
+        return replace(self, **changes)
@@ -0,0 +1,35 @@
+"""
+生产环境的gunicorn配置: 预加载应用, fork之前预热tiktoken编码器、语言注册表和初始prompt,
+fork之后每个worker创建自己的ES客户端、翻译缓存和后台线程
+运行: gunicorn -c gunicorn.conf.py
+      GUNICORN_APP=asgi:app gunicorn -c gunicorn.conf.py  (异步服务, 需要安装uvicorn)
+环境变量: GUNICORN_APP 应用, GUNICORN_BIND 监听地址, GUNICORN_WORKERS 进程数, GUNICORN_THREADS Flask每个进程的线程数,
+GUNICORN_TIMEOUT 请求超时(秒), TIKTOKEN_CACHE_DIR 离线部署时的BPE文件目录
+"""
+import multiprocessing
+import os
+
+wsgi_app = os.getenv("GUNICORN_APP", "app:app")
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count()))
+# 翻译请求大部分时间在等GPT, Flask用线程worker; asgi:app用uvicorn的worker
+worker_class = "uvicorn.workers.UvicornWorker" if wsgi_app.startswith("asgi:") else "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 16))
+# 长文本同步翻译可能要几分钟
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 600))
+graceful_timeout = 30
+keepalive = 5
+preload_app = True
+
+
+def when_ready(server):
+    """
+    应用已加载、还没有fork worker时预热, 失败时gunicorn启动失败
+    """
+    from modules.warmup import preload
+    server.log.info(f"preloaded before fork: {preload()}")
+
+
+def post_worker_init(worker):
+    from modules.warmup import worker_init
+    worker_init(job_workers=worker_class == "gthread")
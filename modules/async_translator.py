@@ -0,0 +1,231 @@
+import asyncio
+
+from config.config import cfg, TranslationContext
+from modules.memory_index import get_memory_index
+from modules.translator import AITranslatorModule
+from utils import utils
+from utils.async_clients import get_async_clients
+from utils.cache import get_translation_cache
+from utils.single_flight import get_async_single_flight
+
+
+class AsyncAITranslatorModule(AITranslatorModule):
+    """
+    AITranslatorModule的异步版本, GPT/embedding/ES请求走共享的异步客户端, 切分、打包、prompt构造和缓存沿用同步版本
+    """
+
+    def __init__(self, clients=None, cache=None, memory_index=None, ctx=None, term_index=None):
+        """
+        :param clients: AsyncClients, 默认为进程内共享的异步客户端
+        :param cache: 翻译缓存, 默认为进程内共享的缓存
+        :param memory_index: 记忆库向量索引, 默认为进程内共享的索引
+        :param term_index: 术语索引, 默认为进程内共享的索引
+        :param ctx: TranslationContext, 本次请求的上下文, 默认按cfg创建
+        """
+        # 不调用父类的__init__, 避免构造同步的ES客户端
+        self.clients = clients or get_async_clients()
+        self.es = self.clients.elastic(cfg.INDEX)
+        self.cache = cache if cache is not None else get_translation_cache()
+        self.memory_index = memory_index
+        self.term_index = term_index
+        self.ctx = ctx or TranslationContext.create()
+        self.history = None
+
+    async def translate(self, query: str, source_lang: str = "English", target_lang: str = "Chinese", parallel=None):
+        """
+        翻译主函数
+        :param query: 待翻译的文本
+        :param source_lang: 源语言
+        :param target_lang: 目标语言
+        :param parallel: 是否并发翻译各个文本块, 默认取cfg.PARALLEL_TRANSLATE
+        :return: 翻译结果
+        """
+        self.use_languages(source_lang, target_lang)
+        cache_key = self.cache_key(query)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return cached
+        translated_text, _ = await get_async_single_flight().run(
+            self.flight_key(query, "document"), lambda: self.translate_document(query, cache_key, parallel), "document")
+        return translated_text
+
+    async def translate_document(self, query, cache_key, parallel=None):
+        """
+        切分并翻译整篇文本, 结果写入缓存
+        :param query: 待翻译的文本
+        :param cache_key: 整篇文本的缓存键
+        :param parallel: 是否并发翻译各个文本块, 默认取cfg.PARALLEL_TRANSLATE
+        :return: 翻译结果
+        """
+        chunks, translations, references = await self.prepare_chunks(query)
+        pending = [index for index in range(len(chunks)) if index not in translations]
+        parallel = cfg.PARALLEL_TRANSLATE if parallel is None else parallel
+        if parallel and len(pending) > 1:
+            translated_text = await self.parallel_translate(chunks, translations, references)
+        else:
+            self.reset_history()
+            translated_text = ""
+            for index, chunk in enumerate(chunks):
+                if index in translations:
+                    translation_item = translations[index]
+                    self.history.add(chunk, translation_item)
+                else:
+                    translation_item = await self.part_translate(chunk, references.get(index))
+                translated_text = f"{translated_text}{translation_item}"
+
+        if translated_text:
+            self.cache.set(cache_key, translated_text)
+        return translated_text
+
+    async def prepare_chunks(self, query):
+        """
+        切分文本, 用记忆库精确匹配, 把未命中的句子打包成文本块, 需要时检索翻译参考
+        :param query: 待翻译的文本
+        :return: (文本块列表, dict 已有译文的文本块索引 -> 译文, dict 文本块索引 -> 翻译参考)
+        """
+        segments = utils.split_segments(query, self.ctx.text_token_limit)
+        memories = await self.search_memories([segment.text for segment in segments])
+        chunks, translations = self.plan_chunks(segments, memories)
+        pending = [index for index in range(len(chunks)) if index not in translations]
+        references = await self.search_references(chunks, pending)
+        return chunks, translations, references
+
+    async def search_memories(self, text_list):
+        """
+        用人工反馈的uid在记忆库里精确匹配, 所有句子只发一次mget请求
+        :param text_list: 句子列表
+        :return: dict, 命中的句子索引 -> 人工译文
+        """
+        if not cfg.USE_TRANSLATION_MEMORY or not text_list:
+            return {}
+        uids = [utils.feedback_uid(text.strip(), self.source_lang, self.target_lang) for text in text_list]
+        try:
+            sources = await self.es.mget_sources(uids)
+        except Exception as err:
+            print(f"search translation memory went wrong! detail: {err}")
+            return {}
+        return {index: source["target"] for index, source in enumerate(sources) if source and source.get("target")}
+
+    async def search_references(self, chunks, indexes):
+        """
+        找出文本块里的术语, 检索与文本块相似的记忆, 作为翻译参考, 只在需要搜索术语时启用
+        :param chunks: 文本块列表
+        :param indexes: 需要检索的文本块索引
+        :return: dict, 文本块索引 -> 参考列表[{原文: 译文}]
+        """
+        if not self.ctx.is_search_term or not indexes:
+            return {}
+        # 首次匹配会从ES全量加载术语, 放到线程里避免阻塞事件循环
+        terms = await asyncio.to_thread(self.search_terms, chunks, indexes)
+        try:
+            vectors = await self.clients.embedding([chunks[index] for index in indexes])
+            if cfg.VECTOR_INDEX_TYPE == "es":
+                results = await asyncio.gather(*[
+                    self.es.es_search(self.format_should_query([], "memory", vector), cfg.DEFAULT_TOP_K)
+                    for vector in vectors])
+                hits = [[(None, source) for source in sources] for sources in results]
+            else:
+                # 首次检索会从ES全量加载索引, 放到线程里避免阻塞事件循环
+                memory_index = self.memory_index or get_memory_index()
+                hits = await asyncio.to_thread(memory_index.search, self.source_lang, self.target_lang, vectors)
+        except Exception as err:
+            print(f"search references went wrong! detail: {err}")
+            return terms
+        return self.merge_references(terms, self.collect_references(indexes, hits))
+
+    async def parallel_translate(self, chunks, translations=None, references=None):
+        """
+        并发翻译多个文本块, 再按原顺序拼接, 并发数不超过cfg.TRANSLATE_CONCURRENCY
+        :param chunks: 文本块列表
+        :param translations: dict, 已有译文的文本块, 索引 -> 译文, 这些文本块不再翻译
+        :param references: dict, 文本块索引 -> 翻译参考
+        :return: 翻译结果
+        """
+        translations = {} if translations is None else translations
+        references = references or {}
+        pending = [index for index in range(len(chunks)) if index not in translations]
+        semaphore = asyncio.Semaphore(max(1, cfg.TRANSLATE_CONCURRENCY))
+
+        async def run(index):
+            async with semaphore:
+                await self.chunk_translate(index, chunks, translations, references.get(index))
+
+        await asyncio.gather(*[run(index) for index in pending])
+        return "".join(f"{translations[index]}" for index in range(len(chunks)))
+
+    async def chunk_translate(self, index, chunks, translations, reference=None):
+        """
+        独立翻译一个文本块, 上下文构造同AITranslatorModule.chunk_translate
+        :param index: 文本块索引
+        :param chunks: 全部文本块
+        :param translations: dict, 已完成的翻译结果, 索引 -> 译文
+        :param reference: 该文本块的翻译参考
+        :return: 翻译结果
+        """
+        cache_key = self.cache_key(chunks[index])
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            translations[index] = cached
+            return cached
+        translations[index], _ = await get_async_single_flight().run(
+            self.flight_key(chunks[index], "chunk"),
+            lambda: self.translate_chunk(index, chunks, translations, reference, cache_key))
+        return translations[index]
+
+    async def translate_chunk(self, index, chunks, translations, reference, cache_key):
+        """
+        chunk_translate里实际请求GPT的部分, 结果写入缓存
+        :return: 翻译结果
+        """
+        message = self.construct_chunk_message(index, chunks, translations, reference)
+        pieces = self.overflow_pieces(message, chunks[index])
+        if pieces:
+            translation_item = ""
+            for piece in pieces:
+                message = self.construct_chunk_message(index, chunks, translations, reference, piece)
+                translation = await self.clients.gpt_request(message, ctx=self.ctx)
+                translation_item = f"{translation_item}{self.get_translate_result(translation)}"
+        else:
+            translation = await self.clients.gpt_request(message, ctx=self.ctx)
+            translation_item = self.get_translate_result(translation)
+        if translation_item:
+            self.cache.set(cache_key, translation_item)
+        return translation_item
+
+    async def part_translate(self, translate_text, reference=None):
+        """
+        带着历史对话翻译一个文本块
+        :param translate_text: str
+        :param reference: 该文本块的翻译参考
+        :return: 翻译结果
+        """
+        cache_key = self.cache_key(translate_text)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            self.history.add(translate_text, cached)
+            return cached
+        translation_item, joined = await get_async_single_flight().run(
+            self.flight_key(translate_text, "chunk"), lambda: self.translate_part(translate_text, reference, cache_key))
+        if joined:
+            self.history.add(translate_text, translation_item)
+        return translation_item
+
+    async def translate_part(self, translate_text, reference, cache_key):
+        """
+        part_translate里实际请求GPT的部分, 结果记入历史并写入缓存
+        :return: 翻译结果
+        """
+        message, prompt_tokens = self.history.build(self.format_query(translate_text, reference),
+                                                    reserve=self.output_reserve(translate_text))
+        pieces = self.overflow_pieces(message, translate_text, prompt_tokens)
+        if pieces:
+            translation_item = ""
+            for piece in pieces:
+                translation_item = f"{translation_item}{await self.part_translate(piece, reference)}"
+        else:
+            translation = await self.clients.gpt_request(message, ctx=self.ctx)
+            translation_item = self.get_translate_result(translation)
+            self.history.add(translate_text, translation_item)
+        if translation_item:
+            self.cache.set(cache_key, translation_item)
+        return translation_item
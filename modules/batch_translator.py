@@ -0,0 +1,149 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from config.config import cfg, TranslationContext
+from modules.translator import AITranslatorModule
+from utils import metrics, utils
+from utils.cache import get_translation_cache
+from utils.languages import get_language_registry
+
+
+class BatchTranslatorModule:
+    def __init__(self, cache=None, es_client=None, ctx=None, priority="batch"):
+        """
+        :param cache: 翻译缓存, 默认为进程内共享的缓存
+        :param es_client: 可传入已有的ES客户端
+        :param ctx: TranslationContext, 本次请求的engine和是否搜索术语, 语言对以每一项为准
+        :param priority: GPT调度的优先级通道, 在线请求内部复用批量翻译时传interactive
+        """
+        self.es = utils.Elastic(cfg.INDEX, client=es_client)
+        self.cache = cache if cache is not None else get_translation_cache()
+        # 批量翻译默认走batch通道, GPT配额紧张时让在线翻译请求先用
+        self.ctx = (ctx or TranslationContext.create()).replace(priority=priority)
+        self.translator = self.new_translator()
+
+    def new_translator(self):
+        return AITranslatorModule(cache=self.cache, es_client=self.es.es, ctx=self.ctx)
+
+    def translate_batch(self, items):
+        """
+        批量翻译, 相同的输入只翻译一次, 短文本合并成一个prompt翻译, 长文本并发翻译
+        :param items: list, 每项为{"text": 待翻译文本, "source_lang": 源语言, "target_lang": 目标语言}
+        :return: 与items一一对应的结果列表, 失败的项带error, 不影响其他项
+        """
+        results = []
+        # (text, source_lang, target_lang) -> 输入中的索引列表
+        groups = {}
+        for index, item in enumerate(items):
+            item = item if isinstance(item, dict) else {}
+            text, source_lang, target_lang = item.get("text"), item.get("source_lang"), item.get("target_lang")
+            results.append({"text": text, "source_lang": source_lang, "target_lang": target_lang,
+                             "translated": None, "error": None})
+            try:
+                assert text and isinstance(text, str), "text is required and must be a string"
+                source_lang = get_language_registry().require(source_lang, "source_lang")
+                target_lang = get_language_registry().require(target_lang, "target_lang")
+            except AssertionError as e:
+                results[index]["error"] = str(e)
+                continue
+            groups.setdefault((text, source_lang, target_lang), []).append(index)
+
+        translated = self.lookup(list(groups))
+        pending = [key for key in groups if key not in translated]
+        tokens = dict(zip(pending, utils.token_usage_batch([key[0] for key in pending])))
+        short_keys = [key for key in pending if tokens[key] <= cfg.BATCH_PACK_ITEM_TOKENS]
+        long_keys = [key for key in pending if tokens[key] > cfg.BATCH_PACK_ITEM_TOKENS]
+        with ThreadPoolExecutor(max_workers=cfg.TRANSLATE_CONCURRENCY) as executor:
+            futures = [executor.submit(metrics.propagate(self.translate_pack), pack) for pack in self.pack_keys(short_keys, tokens)]
+            futures += [executor.submit(metrics.propagate(self.translate_one), key) for key in long_keys]
+            for future in futures:
+                translated.update(future.result())
+
+        for key, indexes in groups.items():
+            for index in indexes:
+                if isinstance(translated.get(key), Exception):
+                    results[index]["error"] = f"Translate went wrong, DETAIL: ```{translated[key]}```"
+                else:
+                    results[index]["translated"] = translated.get(key)
+        return results
+
+    def lookup(self, keys):
+        """
+        先查缓存, 再用一次mget查记忆库
+        :param keys: list, (text, source_lang, target_lang)列表
+        :return: dict, 已有译文的key -> 译文
+        """
+        found = {}
+        for key in keys:
+            cached = self.cache.get(self.translator.cache_key(*key))
+            if cached is not None:
+                found[key] = cached
+        rest = [key for key in keys if key not in found]
+        if not cfg.USE_TRANSLATION_MEMORY or not rest:
+            return found
+        try:
+            sources = self.es.mget_sources([utils.feedback_uid(text.strip(), source_lang, target_lang)
+                                            for text, source_lang, target_lang in rest])
+        except Exception as err:
+            print(f"search translation memory went wrong! detail: {err}")
+            return found
+        for key, source in zip(rest, sources):
+            if source and source.get("target"):
+                found[key] = source["target"]
+        return found
+
+    def pack_keys(self, keys, tokens):
+        """
+        把同一语言对的短文本按text_token_limit和BATCH_PACK_MAX_ITEMS打包
+        :param keys: list, 短文本的key列表
+        :param tokens: dict, key -> token数
+        :return: 每个包的key列表
+        """
+        by_pair = {}
+        for key in keys:
+            by_pair.setdefault(key[1:], []).append(key)
+        packs = []
+        for pair_keys in by_pair.values():
+            pack, pack_tokens = [], 0
+            for key in pair_keys:
+                if pack and (pack_tokens + tokens[key] > self.ctx.text_token_limit or len(pack) >= cfg.BATCH_PACK_MAX_ITEMS):
+                    packs.append(pack)
+                    pack, pack_tokens = [], 0
+                pack.append(key)
+                pack_tokens += tokens[key]
+            if pack:
+                packs.append(pack)
+        return packs
+
+    def translate_pack(self, keys):
+        """
+        一个prompt翻译一包短文本, 返回条数不对或失败时逐条翻译
+        :param keys: 同一语言对的key列表
+        :return: dict, key -> 译文或异常
+        """
+        if len(keys) == 1:
+            return self.translate_one(keys[0])
+        _, source_lang, target_lang = keys[0]
+        try:
+            translator = self.new_translator()
+            translations = translator.pack_translate([key[0] for key in keys], source_lang, target_lang)
+        except Exception as err:
+            print(f"pack translate went wrong, fall back to one by one! detail: {err}")
+            result = {}
+            for key in keys:
+                result.update(self.translate_one(key))
+            return result
+        for key, translation in zip(keys, translations):
+            self.cache.set(self.translator.cache_key(*key), translation)
+        return dict(zip(keys, translations))
+
+    def translate_one(self, key):
+        """
+        单独翻译一条文本
+        :param key: (text, source_lang, target_lang)
+        :return: dict, key -> 译文或异常
+        """
+        try:
+            translator = self.new_translator()
+            return {key: translator.translate(*key)}
+        except Exception as err:
+            return {key: err}
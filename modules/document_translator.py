@@ -0,0 +1,69 @@
+from config.config import cfg, TranslationContext
+from modules.batch_translator import BatchTranslatorModule
+from modules.translator import AITranslatorModule
+from utils import metrics
+from utils.cache import NullCache
+from utils.doc_format import parse_document, placeholders_intact
+
+
+class DocumentTranslatorModule:
+    def __init__(self, cache=None, es_client=None, ctx=None):
+        """
+        :param cache: 翻译缓存, 默认为进程内共享的缓存
+        :param es_client: 可传入已有的ES客户端
+        :param ctx: TranslationContext, 本次请求的上下文, 默认按cfg创建
+        """
+        self.ctx = ctx or TranslationContext.create()
+        # 文本单元复用批量翻译: 相同的单元只翻译一次, 短单元合并到一个prompt, 长单元照常切分成文本块翻译
+        self.batch = BatchTranslatorModule(cache=cache, es_client=es_client, ctx=self.ctx, priority=self.ctx.priority)
+
+    def translate(self, query: str, source_lang: str = "English", target_lang: str = "Chinese", doc_format=None):
+        """
+        格式感知的翻译: 只把Markdown/HTML里的文本送去翻译, 代码块、链接地址、图片、标签等原样保留
+        :param query: 待翻译的文档
+        :param source_lang: 源语言
+        :param target_lang: 目标语言
+        :param doc_format: text/markdown/html/auto, 默认cfg.DEFAULT_DOC_FORMAT
+        :return: 翻译结果
+        """
+        document = parse_document(query, doc_format or cfg.DEFAULT_DOC_FORMAT)
+        if document is None:
+            return self.batch.new_translator().translate(query, source_lang, target_lang)
+        units = document.units()
+        results = self.batch.translate_batch([{"text": unit.text, "source_lang": source_lang,
+                                               "target_lang": target_lang} for unit in units])
+        errors = [result["error"] for result in results if result["error"]]
+        if errors:
+            raise Exception(errors[0])
+        translations = [result["translated"] for result in results]
+        for index, unit in enumerate(units):
+            if not placeholders_intact(translations[index], unit.placeholders):
+                translations[index] = self.retranslate(unit, source_lang, target_lang)
+        return document.render(translations)
+
+    def retranslate(self, unit, source_lang, target_lang):
+        """
+        占位符漏掉或顺序不对的文本单元单独重新翻译, 最多cfg.PLACEHOLDER_RETRY_NUM次, 仍然不对时保留原文,
+        不把代码和链接挪到别处
+        :param unit: 文本单元
+        :param source_lang: 源语言
+        :param target_lang: 目标语言
+        :return: 占位符完整的译文或原文
+        """
+        key = self.batch.translator.cache_key(unit.text, source_lang, target_lang)
+        # 不查缓存, 缓存里就是刚才占位符不对的译文
+        translator = AITranslatorModule(cache=NullCache(), es_client=self.batch.es.es, ctx=self.ctx)
+        for _ in range(cfg.PLACEHOLDER_RETRY_NUM):
+            try:
+                translated = translator.translate(unit.text, source_lang, target_lang)
+            except Exception as err:
+                print(f"retranslate unit with placeholders went wrong! detail: {err}")
+                break
+            if placeholders_intact(translated, unit.placeholders):
+                self.batch.cache.set(key, translated)
+                metrics.PLACEHOLDER_REPAIRS.inc(outcome="retried")
+                return translated
+        # 占位符不对的译文不能留在缓存里, 否则后面的请求都会命中它再重译一遍
+        self.batch.cache.delete(key)
+        metrics.PLACEHOLDER_REPAIRS.inc(outcome="kept_source")
+        return unit.text
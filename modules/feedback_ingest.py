@@ -0,0 +1,276 @@
+"""
+人工反馈(翻译记忆)批量导入: 逐条读取TMX/CSV/JSONL, 按批查重和embedding, 用helpers.parallel_bulk并发写入ES,
+内存占用与文件大小无关, 每条写入失败单独报告, 定期保存断点, 中断后可以从断点继续
+运行: python -m modules.feedback_ingest memory.tmx --source-lang English --target-lang Chinese
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import time
+import xml.etree.ElementTree as ET
+from collections import deque
+
+from elasticsearch7 import helpers
+
+from config.config import cfg
+from modules.human_feedback import HumanFeedbackModule
+from utils import utils
+from utils.languages import get_language_registry
+
+XML_LANG = "{http://www.w3.org/XML/1998/namespace}lang"
+FORMATS = ["tmx", "csv", "jsonl"]
+
+
+def language_code(lang):
+    """
+    先按完整的语言代码在注册表里找, 找不到时逐个去掉最后一段再找(zh-Hant-TW -> zh-Hant -> zh),
+    zh-TW、zh-Hant-HK不会与zh-CN混在一起
+    :param lang: 语言名(如English)或语言代码(如en-US)
+    :return: 注册表里的语言代码(如zh-Hant), 都找不到时为小写的主语言代码
+    """
+    registry = get_language_registry()
+    subtags = lang.strip().replace("_", "-").split("-")
+    for end in range(len(subtags), 0, -1):
+        name = registry.resolve("-".join(subtags[:end]))
+        if name:
+            return registry.code(name)
+    return subtags[0].lower()
+
+
+def read_tmx(stream, source_lang, target_lang):
+    """
+    逐个翻译单元读取TMX, 读完的元素马上清掉
+    :param stream: 二进制文件流
+    :param source_lang: 源语言
+    :param target_lang: 目标语言
+    :return: {"source", "target"}或{"error"}的迭代器
+    """
+    source_code, target_code = language_code(source_lang), language_code(target_lang)
+    root = None
+    for event, elem in ET.iterparse(stream, events=("start", "end")):
+        if root is None:
+            root = elem
+        if event != "end" or elem.tag != "tu":
+            continue
+        segments = {}
+        for tuv in elem.iter("tuv"):
+            seg = tuv.find("seg")
+            lang = tuv.get(XML_LANG) or tuv.get("lang") or ""
+            if seg is not None:
+                segments[language_code(lang)] = "".join(seg.itertext())
+        if source_code in segments and target_code in segments:
+            yield {"source": segments[source_code], "target": segments[target_code]}
+        else:
+            yield {"error": f"tu has no {source_code}/{target_code} tuv, found: {list(segments)}"}
+        root.clear()
+
+
+def read_csv(stream):
+    """
+    逐行读取CSV, 有source/target表头时按表头取列, 否则取前两列
+    :param stream: 文本文件流
+    :return: {"source", "target"}或{"error"}的迭代器
+    """
+    reader = csv.reader(stream)
+    columns = (0, 1)
+    for position, row in enumerate(reader):
+        header = [cell.strip().lower() for cell in row]
+        if position == 0 and "source" in header and "target" in header:
+            columns = (header.index("source"), header.index("target"))
+            continue
+        if len(row) <= max(columns):
+            yield {"error": f"expect at least {max(columns) + 1} columns, got {len(row)}"}
+            continue
+        yield {"source": row[columns[0]], "target": row[columns[1]]}
+
+
+def read_jsonl(stream):
+    """
+    逐行读取JSONL, 每行为{"source": ..., "target": ...}, 也兼容反馈接口的need_translate/translation
+    :param stream: 文本文件流
+    :return: {"source", "target"}或{"error"}的迭代器
+    """
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+            yield {"source": item.get("source", item.get("need_translate")),
+                   "target": item.get("target", item.get("translation"))}
+        except (ValueError, AttributeError) as err:
+            yield {"error": f"invalid json line: {err}"}
+
+
+def read_pairs(stream, data_format, source_lang, target_lang):
+    """
+    按格式读取(原文, 译文)
+    :param stream: 二进制文件流
+    :param data_format: tmx/csv/jsonl
+    :param source_lang: 源语言
+    :param target_lang: 目标语言
+    :return: {"source", "target"}或{"error"}的迭代器
+    """
+    if data_format == "tmx":
+        return read_tmx(stream, source_lang, target_lang)
+    text_stream = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    if data_format == "csv":
+        return read_csv(text_stream)
+    if data_format == "jsonl":
+        return read_jsonl(text_stream)
+    raise ValueError(f"format should be in {FORMATS}")
+
+
+class FeedbackIngestor:
+    def __init__(self, es_client=None, checkpoint_path=None, batch_size=None, data_tag="memory"):
+        """
+        :param es_client: 可传入已有的ES客户端(如utils.stubs.FakeElasticsearch)
+        :param checkpoint_path: 断点文件路径, 为空则不保存断点
+        :param batch_size: 每批查重和embedding的条数, 默认cfg.INGEST_BATCH_SIZE
+        :param data_tag: memory(翻译记忆)或term(术语)
+        """
+        self.feedback = HumanFeedbackModule(es_client=es_client)
+        self.data_tag = data_tag
+        self.checkpoint_path = checkpoint_path
+        self.batch_size = batch_size or cfg.INGEST_BATCH_SIZE
+        self.stats = {"read": 0, "resumed": 0, "invalid": 0, "unchanged": 0, "inserted": 0, "updated": 0,
+                      "failed": 0}
+        self.position = 0
+        self.start = time.time()
+
+    def load_checkpoint(self):
+        """
+        :return: 上次已处理的记录数, 没有断点时为0
+        """
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return 0
+        with open(self.checkpoint_path) as checkpoint_file:
+            return json.load(checkpoint_file).get("position", 0)
+
+    def save_checkpoint(self):
+        if not self.checkpoint_path:
+            return
+        temp_path = f"{self.checkpoint_path}.tmp"
+        with open(temp_path, "w") as checkpoint_file:
+            json.dump({"position": self.position, "stats": self.stats, "updated_at": time.time()}, checkpoint_file)
+        os.replace(temp_path, self.checkpoint_path)
+
+    def progress(self, event="progress"):
+        elapsed = time.time() - self.start
+        return {"event": event, "position": self.position, **self.stats, "elapsed": round(elapsed, 3),
+                "pairs_per_sec": round(self.stats["read"] / elapsed, 1) if elapsed else 0.0}
+
+    def flush(self, batch, source_lang, target_lang, pending):
+        """
+        一批记录查重、embedding后产出ES bulk数据; 无效记录、跳过的条数、每条数据和批次结束的位置按顺序记入pending,
+        parallel_bulk按顺序返回结果, 结果回来时据此对应到原始记录
+        """
+        valid = []
+        for position, record in batch:
+            source, target = record.get("source"), record.get("target")
+            if "error" in record or not isinstance(source, str) or not isinstance(target, str) \
+                    or not source.strip() or not target.strip():
+                pending.append(("invalid", position, record.get("error") or "source and target must be non-empty strings"))
+            else:
+                valid.append((position, source, target))
+        # 同一批里重复的原文以最后一条为准
+        positions = {utils.feedback_uid(source, source_lang, target_lang, self.data_tag): position
+                     for position, source, target in valid}
+        # 导入的向量只写入ES, 不留在进程内的embedding缓存里, 内存占用与文件大小无关
+        es_data = self.feedback.build_es_data([(source, target) for _, source, target in valid], source_lang,
+                                              target_lang, self.data_tag, cache_vectors=False)
+        pending.append(("unchanged", len(valid) - len(es_data)))
+        for item in es_data:
+            pending.append(("doc", positions[item["_id"]], item["_id"], "_source" in item))
+            yield item
+        pending.append(("position", batch[-1][0] + 1))
+
+    def actions(self, records, source_lang, target_lang, resume_from, pending):
+        """
+        跳过断点之前的记录, 按cfg.INGEST_BATCH_SIZE分批产出ES bulk数据
+        """
+        batch = []
+        for position, record in enumerate(records):
+            if position < resume_from:
+                continue
+            batch.append((position, record))
+            if len(batch) >= self.batch_size:
+                yield from self.flush(batch, source_lang, target_lang, pending)
+                batch = []
+        if batch:
+            yield from self.flush(batch, source_lang, target_lang, pending)
+
+    def ingest(self, records, source_lang, target_lang, resume=True):
+        """
+        导入人工反馈, 新的和更新了译文的记忆在服务端下次同步向量索引时生效
+        :param records: read_pairs的结果
+        :param source_lang: 源语言
+        :param target_lang: 目标语言
+        :param resume: 是否从断点继续
+        :return: 事件dict的生成器, event为error(单条失败)/progress(保存断点时)/done(全部完成)
+        """
+        resume_from = self.load_checkpoint() if resume else 0
+        self.position = resume_from
+        self.stats["resumed"] = resume_from
+        self.start = time.time()
+        pending = deque()
+        saved_at = self.position
+
+        def drain():
+            # 处理pending队首不对应ES结果的记录
+            while pending and pending[0][0] != "doc":
+                kind, *item = pending.popleft()
+                if kind == "unchanged":
+                    self.stats["unchanged"] += item[0]
+                elif kind == "invalid":
+                    self.stats["invalid"] += 1
+                    yield {"event": "error", "position": item[0], "error": item[1]}
+                else:
+                    self.position = item[0]
+                    self.stats["read"] = self.position - resume_from
+
+        results = helpers.parallel_bulk(
+            self.feedback.es.es, self.actions(records, source_lang, target_lang, resume_from, pending),
+            thread_count=cfg.INGEST_BULK_THREADS, chunk_size=cfg.INGEST_BULK_CHUNK,
+            raise_on_error=False, raise_on_exception=False)
+        for ok, result in results:
+            yield from drain()
+            _, position, uid, is_new = pending.popleft()
+            if ok:
+                self.stats["inserted" if is_new else "updated"] += 1
+            else:
+                self.stats["failed"] += 1
+                error = next(iter(result.values()), {}).get("error")
+                yield {"event": "error", "position": position, "uid": uid, "error": str(error)}
+            yield from drain()
+            if self.position - saved_at >= cfg.INGEST_CHECKPOINT_EVERY:
+                saved_at = self.position
+                self.save_checkpoint()
+                yield self.progress()
+        yield from drain()
+        self.save_checkpoint()
+        yield self.progress("done")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量导入人工反馈(翻译记忆)")
+    parser.add_argument("path", help="TMX/CSV/JSONL文件路径")
+    parser.add_argument("--format", choices=FORMATS, help="文件格式, 默认按扩展名判断")
+    parser.add_argument("--source-lang", default="English")
+    parser.add_argument("--target-lang", default="Chinese")
+    parser.add_argument("--checkpoint", help="断点文件路径, 默认为<path>.checkpoint.json")
+    parser.add_argument("--restart", action="store_true", help="忽略断点从头导入")
+    parser.add_argument("--data-tag", choices=["memory", "term"], default="memory", help="导入翻译记忆还是术语")
+    args = parser.parse_args()
+    data_format = args.format or os.path.splitext(args.path)[1].lstrip(".").lower()
+    ingestor = FeedbackIngestor(checkpoint_path=args.checkpoint or f"{args.path}.checkpoint.json",
+                                data_tag=args.data_tag)
+    with open(args.path, "rb") as stream:
+        records = read_pairs(stream, data_format, args.source_lang, args.target_lang)
+        for event in ingestor.ingest(records, args.source_lang, args.target_lang, resume=not args.restart):
+            print(json.dumps(event, ensure_ascii=False), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,36 +1,100 @@
 from utils import utils
 from config.config import cfg
+from modules.memory_index import get_memory_index
+from modules.term_index import get_term_index
+from utils.embedding_service import get_embedding_service
 
 
 class HumanFeedbackModule:
-    def __init__(self):
-        self.es = utils.Elastic(cfg.INDEX)
+    def __init__(self, es_client=None):
+        self.es = utils.Elastic(cfg.INDEX, client=es_client)
 
-    def save_feedback(self, need_translate: str, translation: str, source_lang: str, target_lang: str):
+    def save_feedback(self, need_translate: str, translation: str, source_lang: str, target_lang: str,
+                      data_tag: str = "memory"):
         """
         :param need_translate: 需要翻译的文本
         :param translation: 翻译结果
         :param source_lang: 源语言
         :param target_lang: 目标语言
+        :param data_tag: memory(翻译记忆)或term(术语)
+        :return: 写入ES的数据, 新增的是完整文档, 已存在但译文变了的是只更新target的update操作
         """
-        whole_es_data = []
-        source_vector = utils.embedding(need_translate)
         if all([isinstance(need_translate, list), isinstance(translation, list),
                 len(need_translate) == len(translation)]):
-            for index, item in enumerate(need_translate):
-                source_data = self.construct_source_data(item, translation[index], source_lang, target_lang,
-                                                                 source_vector[index])
-                es_data = utils.format_es_data(source_data, source_data.get("uid"))
-                whole_es_data.append(es_data)
+            pairs = list(zip(need_translate, translation))
         elif isinstance(need_translate, str):
-            source_data = self.construct_source_data(need_translate, translation, source_lang, target_lang,
-                                                     source_vector[0])
-            es_data = utils.format_es_data(source_data, source_data.get("uid"))
-            whole_es_data.append(es_data)
-        self.es.insert_into_es(whole_es_data, batch=True)
-        print(f"save success, insert_uid: {[item['_source'].get('uid') for item in whole_es_data]}")
+            pairs = [(need_translate, translation)]
+        else:
+            pairs = []
+        whole_es_data = self.build_es_data(pairs, source_lang, target_lang, data_tag)
+        if whole_es_data:
+            self.es.insert_into_es(whole_es_data, batch=True)
+        if data_tag == "term":
+            # 新增和更新了译文的术语都马上生效
+            get_term_index().add([{"source": source, "target": target, "source_lang": source_lang,
+                                   "target_lang": target_lang, "data_tag": data_tag} for source, target in pairs])
+        elif cfg.VECTOR_INDEX_TYPE != "es":
+            # 新的记忆马上加入进程内向量索引, 更新了译文的等下次同步; es方式直接检索ES, 没有进程内索引
+            get_memory_index().add([item["_source"] for item in whole_es_data if "_source" in item])
+        print(f"save success, insert_uid: {[item['_id'] for item in whole_es_data]}")
+        return whole_es_data
+
+    def build_es_data(self, pairs, source_lang, target_lang, data_tag="memory", cache_vectors=True):
+        """
+        把(原文, 译文)列表构造成ES写入数据, 同一批里重复的原文以最后一条为准,
+        只给索引里还没有的原文算向量, 已存在但译文变了的只更新target, 没变的跳过
+        :param pairs: [(原文, 译文)]
+        :param source_lang: 源语言
+        :param target_lang: 目标语言
+        :param data_tag: memory(翻译记忆)或term(术语), 术语按原文精确匹配, 不算向量
+        :param cache_vectors: 新算的向量是否写入embedding缓存, 批量导入时为False, 向量已经存在ES里
+        :return: 写入ES的数据列表
+        """
+        latest = {utils.feedback_uid(source, source_lang, target_lang, data_tag): (source, target)
+                  for source, target in pairs}
+        existing = self.existing_targets(list(latest))
+        new_items = [(uid, source, target) for uid, (source, target) in latest.items() if uid not in existing]
+        if data_tag == "memory":
+            source_vectors = get_embedding_service().embed([source for _, source, _ in new_items], cache=cache_vectors)
+        else:
+            source_vectors = [None] * len(new_items)
+        whole_es_data = []
+        for (uid, source, target), source_vector in zip(new_items, source_vectors):
+            source_data = self.construct_source_data(source, target, source_lang, target_lang, source_vector, data_tag)
+            whole_es_data.append(utils.format_es_data(source_data, uid))
+        for uid, (source, target) in latest.items():
+            if uid in existing and existing[uid] != target:
+                whole_es_data.append(self.format_update_data(uid, {"target": target}))
         return whole_es_data
 
+    def existing_targets(self, uids):
+        """
+        查询已经在索引里的人工反馈
+        :param uids: uid列表
+        :return: dict, 已存在的uid -> 译文
+        """
+        try:
+            sources = self.es.mget_sources(uids)
+        except Exception as err:
+            print(f"search existing feedback went wrong! detail: {err}")
+            return {}
+        return {uid: source.get("target") for uid, source in zip(uids, sources) if source}
+
+    @staticmethod
+    def format_update_data(doc_id, doc):
+        """
+        构造只更新部分字段的bulk操作
+        :param doc_id: 文档id
+        :param doc: 要更新的字段
+        :return: dict, es bulk数据
+        """
+        return {
+            "_op_type": "update",
+            "_index": cfg.INDEX,
+            "_id": doc_id,
+            "doc": doc,
+        }
+
     @staticmethod
     def construct_source_data(need_translate, translation, source_lang, target_lang, source_vector, data_tag="memory"):
         """
@@ -50,6 +114,6 @@ class HumanFeedbackModule:
             "target_lang": target_lang,
             "data_tag": data_tag,
             "source_vector": source_vector,
-            "uid": utils.md5_hash(f"{need_translate}{source_lang}{target_lang}".lower()),
+            "uid": utils.feedback_uid(need_translate, source_lang, target_lang, data_tag),
         }
         return source_data
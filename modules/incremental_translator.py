@@ -0,0 +1,219 @@
+"""
+编辑后重新提交的文档的增量翻译: 按文档id保存上一版的文本块, 每个文本块记录它包含的句子片段的哈希和译文;
+重新提交时把新的切分结果与上一版按句子哈希做diff, 句子全部未变且仍然连续的文本块直接复用译文,
+改动或新增的句子重新打包成文本块翻译, 复用的文本块作为它们的上下文, GPT请求数和token数随改动的大小增长, 不随文档大小增长
+"""
+import difflib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from config.config import cfg, TranslationContext
+from modules.translation_jobs import _Transaction
+from modules.translator import AITranslatorModule
+from utils import metrics, utils
+
+
+class DocumentStore:
+    def __init__(self, db_path=None):
+        """
+        :param db_path: SQLite文件路径, 默认cfg.DOCUMENT_DB_PATH
+        """
+        self.db_path = db_path or cfg.DOCUMENT_DB_PATH
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        with self.transaction() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS translation_documents ("
+                       "doc_id TEXT NOT NULL, source_lang TEXT NOT NULL, target_lang TEXT NOT NULL, "
+                       "engine TEXT NOT NULL, prompt_version TEXT NOT NULL, version INTEGER NOT NULL, "
+                       "updated_at REAL NOT NULL, PRIMARY KEY (doc_id, source_lang, target_lang, engine))")
+            db.execute("CREATE TABLE IF NOT EXISTS translation_document_chunks ("
+                       "doc_id TEXT NOT NULL, source_lang TEXT NOT NULL, target_lang TEXT NOT NULL, "
+                       "engine TEXT NOT NULL, idx INTEGER NOT NULL, hashes TEXT NOT NULL, translated TEXT NOT NULL, "
+                       "PRIMARY KEY (doc_id, source_lang, target_lang, engine, idx))")
+
+    def transaction(self):
+        """
+        每个线程一个连接, WAL模式下读不阻塞写
+        """
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            self.local.db = db
+        return _Transaction(db)
+
+    def load(self, doc_id, source_lang, target_lang, engine):
+        """
+        :return: (版本号, [(句子哈希列表, 译文)]), 没有保存过或prompt版本已变时为(0, [])
+        """
+        key = (doc_id, source_lang, target_lang, engine)
+        with self.transaction() as db:
+            row = db.execute("SELECT version, prompt_version FROM translation_documents WHERE doc_id = ? "
+                             "AND source_lang = ? AND target_lang = ? AND engine = ?", key).fetchone()
+            if row is None:
+                return 0, []
+            if row["prompt_version"] != cfg.PROMPT_VERSION:
+                return row["version"], []
+            rows = db.execute("SELECT hashes, translated FROM translation_document_chunks WHERE doc_id = ? "
+                              "AND source_lang = ? AND target_lang = ? AND engine = ? ORDER BY idx", key).fetchall()
+        return row["version"], [(json.loads(item["hashes"]), item["translated"]) for item in rows]
+
+    def save(self, doc_id, source_lang, target_lang, engine, chunks):
+        """
+        用新版本的文本块替换上一版
+        :param chunks: [(句子哈希列表, 译文)]
+        :return: 新的版本号
+        """
+        key = (doc_id, source_lang, target_lang, engine)
+        with self.transaction() as db:
+            row = db.execute("SELECT version FROM translation_documents WHERE doc_id = ? AND source_lang = ? "
+                             "AND target_lang = ? AND engine = ?", key).fetchone()
+            version = (row["version"] if row else 0) + 1
+            db.execute("INSERT OR REPLACE INTO translation_documents (doc_id, source_lang, target_lang, engine, "
+                       "prompt_version, version, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (*key, cfg.PROMPT_VERSION, version, time.time()))
+            db.execute("DELETE FROM translation_document_chunks WHERE doc_id = ? AND source_lang = ? "
+                       "AND target_lang = ? AND engine = ?", key)
+            db.executemany("INSERT INTO translation_document_chunks (doc_id, source_lang, target_lang, engine, idx, "
+                           "hashes, translated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           [(*key, index, json.dumps(hashes), translated)
+                            for index, (hashes, translated) in enumerate(chunks)])
+        return version
+
+
+def match_chunks(stored, hashes):
+    """
+    按句子哈希diff上一版和新版, 找出可以复用的文本块
+    :param stored: 上一版的[(句子哈希列表, 译文)]
+    :param hashes: 新版每个句子片段的哈希
+    :return: dict, 新版里文本块开始的句子索引 -> (句子数, 译文)
+    """
+    old_hashes = [item for chunk_hashes, _ in stored for item in chunk_hashes]
+    matcher = difflib.SequenceMatcher(None, old_hashes, hashes, autojunk=False)
+    blocks = [block for block in matcher.get_matching_blocks() if block.size]
+    reused, start, block_index = {}, 0, 0
+    for chunk_hashes, translated in stored:
+        end = start + len(chunk_hashes)
+        while block_index < len(blocks) and blocks[block_index].a + blocks[block_index].size < end:
+            block_index += 1
+        if block_index < len(blocks) and blocks[block_index].a <= start:
+            block = blocks[block_index]
+            reused[block.b + start - block.a] = (len(chunk_hashes), translated)
+        start = end
+    return reused
+
+
+def chunk_members(chunks, segments):
+    """
+    文本块由连续的句子片段原样拼接而成, 按长度还原每个文本块包含的片段数
+    :return: 与chunks一一对应的片段数列表
+    """
+    counts, position = [], 0
+    for chunk in chunks:
+        size, start = 0, position
+        while position < len(segments) and size < len(chunk):
+            size += len(segments[position].text)
+            position += 1
+        counts.append(position - start)
+    return counts
+
+
+class IncrementalTranslatorModule:
+    def __init__(self, cache=None, es_client=None, ctx=None, store=None):
+        """
+        :param cache: 翻译缓存, 默认为进程内共享的缓存
+        :param es_client: 可传入已有的ES客户端
+        :param ctx: TranslationContext, 本次请求的上下文, 默认按cfg创建
+        :param store: DocumentStore, 默认为进程内共享的
+        """
+        self.translator = AITranslatorModule(cache=cache, es_client=es_client, ctx=ctx or TranslationContext.create())
+        self.store = store or get_document_store()
+
+    def translate(self, doc_id, query: str, source_lang: str = "English", target_lang: str = "Chinese", parallel=None):
+        """
+        翻译文档的新版本, 只翻译与上一版相比改动或新增的部分
+        :param doc_id: 文档id
+        :param query: 新版本的全文
+        :param source_lang: 源语言
+        :param target_lang: 目标语言
+        :param parallel: 是否并行翻译各个文本块, 默认取cfg.PARALLEL_TRANSLATE
+        :return: (译文, dict 版本号和复用/翻译的文本块数)
+        """
+        translator = self.translator
+        translator.use_languages(source_lang, target_lang)
+        engine = translator.key_engine()
+        segments = utils.split_segments(query, translator.ctx.text_token_limit)
+        hashes = [utils.md5_hash(segment.text) for segment in segments]
+        _, stored = self.store.load(doc_id, source_lang, target_lang, engine)
+        reused = match_chunks(stored, hashes)
+
+        chunks, chunk_hashes, translations = [], [], {}
+        dirty, index, reused_chunks = [], 0, 0
+        while index < len(segments):
+            if index not in reused:
+                dirty.append(index)
+                index += 1
+                continue
+            self.plan_dirty(segments, hashes, dirty, chunks, chunk_hashes, translations)
+            dirty = []
+            count, translated = reused[index]
+            translations[len(chunks)] = translated
+            chunks.append("".join(segment.text for segment in segments[index:index + count]))
+            chunk_hashes.append(hashes[index:index + count])
+            reused_chunks += 1
+            index += count
+        self.plan_dirty(segments, hashes, dirty, chunks, chunk_hashes, translations)
+
+        pending = [item for item in range(len(chunks)) if item not in translations]
+        references = translator.search_references(chunks, pending)
+        translated_text = translator.translate_chunks(chunks, translations, references, parallel)
+        version = self.store.save(doc_id, source_lang, target_lang, engine,
+                                  [(chunk_hashes[item], translations[item]) for item in range(len(chunks))])
+        if translated_text:
+            translator.cache.set(translator.cache_key(query), translated_text)
+        metrics.INCREMENTAL_CHUNKS.inc(reused_chunks, kind="reused")
+        metrics.INCREMENTAL_CHUNKS.inc(len(pending), kind="translated")
+        return translated_text, {"version": version, "total_chunks": len(chunks), "reused_chunks": reused_chunks,
+                                 "translated_chunks": len(pending)}
+
+    def plan_dirty(self, segments, hashes, dirty, chunks, chunk_hashes, translations):
+        """
+        改动或新增的一段连续句子重新查记忆库、打包成文本块, 追加到chunks
+        :param segments: 新版的全部句子片段
+        :param hashes: 新版每个句子片段的哈希
+        :param dirty: 这一段句子的索引
+        :param chunks: 文本块列表
+        :param chunk_hashes: 与chunks一一对应的句子哈希列表
+        :param translations: dict, 已有译文的文本块索引 -> 译文
+        """
+        if not dirty:
+            return
+        run = [segments[index] for index in dirty]
+        run_chunks, run_translations = self.translator.plan_chunks(run)
+        start = dirty[0]
+        for offset, count in enumerate(chunk_members(run_chunks, run)):
+            if offset in run_translations:
+                translations[len(chunks)] = run_translations[offset]
+            chunks.append(run_chunks[offset])
+            chunk_hashes.append(hashes[start:start + count])
+            start += count
+
+
+_document_store = None
+_document_store_lock = threading.Lock()
+
+
+def get_document_store():
+    """
+    获取进程内共享的DocumentStore
+    """
+    global _document_store
+    if _document_store is None:
+        with _document_store_lock:
+            if _document_store is None:
+                _document_store = DocumentStore()
+    return _document_store
@@ -0,0 +1,145 @@
+"""
+记忆库的进程内向量检索, 从ES的memory数据加载并定期同步, 代替逐条扫描的script_score查询
+"""
+import threading
+import time
+
+from config.config import cfg
+from utils import metrics, utils
+from utils.vector_index import build_index
+
+
+class TranslationMemoryIndex:
+    def __init__(self, es_client=None, index_type=None):
+        """
+        :param es_client: 可传入已有的ES客户端
+        :param index_type: 向量索引类型flat/ivf/hnsw, 默认cfg.VECTOR_INDEX_TYPE
+        """
+        self.es_client = es_client
+        self.index_type = index_type or cfg.VECTOR_INDEX_TYPE
+        # (source_lang, target_lang) -> 向量索引
+        self.indexes = {}
+        self.loaded_at = 0
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.loading = False
+        # 全量加载扫描ES期间add的记忆, 扫描结果里可能没有, 建好新索引后补进去
+        self.scanning = False
+        self.added = []
+
+    def load(self):
+        """
+        从ES全量加载memory数据, 建好新索引后整体替换
+        """
+        with self.lock:
+            self.scanning, self.added = True, []
+        try:
+            indexes = {}
+            batches = {}
+            es = utils.Elastic(cfg.INDEX, client=self.es_client)
+            for doc_id, source in es.scan_sources({"term": {"data_tag": "memory"}}):
+                if not source.get("source_vector"):
+                    continue
+                batch = batches.setdefault((source.get("source_lang"), source.get("target_lang")), ([], [], []))
+                batch[0].append(doc_id)
+                batch[1].append(source["source_vector"])
+                batch[2].append(self.payload(source))
+            for pair, (ids, vectors, payloads) in batches.items():
+                indexes[pair] = build_index(self.index_type, cfg.VECTOR_DIM)
+                indexes[pair].add(ids, vectors, payloads)
+            with self.lock:
+                # 同一个id已经扫描到时覆盖, 不会重复
+                for source in self.added:
+                    self.index_for(indexes, source).add(
+                        [source.get("uid")], [source["source_vector"]], [self.payload(source)])
+                self.indexes = indexes
+                self.loaded_at = time.time()
+        finally:
+            with self.lock:
+                self.scanning, self.added = False, []
+        print(f"translation memory index loaded: { {f'{k[0]}->{k[1]}': len(v) for k, v in indexes.items()} }")
+
+    def maybe_sync(self):
+        """
+        首次使用时同步加载, 之后超过cfg.VECTOR_INDEX_SYNC_INTERVAL秒在后台线程重新加载
+        """
+        if not self.loaded_at:
+            with self.load_lock:
+                if not self.loaded_at:
+                    self.load()
+            return
+        if time.time() - self.loaded_at < cfg.VECTOR_INDEX_SYNC_INTERVAL or self.loading:
+            return
+        with self.lock:
+            if self.loading:
+                return
+            self.loading = True
+        threading.Thread(target=self._background_load, daemon=True).start()
+
+    def _background_load(self):
+        try:
+            self.load()
+        except Exception as err:
+            print(f"reload translation memory index went wrong! detail: {err}")
+        finally:
+            self.loading = False
+
+    def add(self, sources):
+        """
+        新的人工反馈写入ES后同步加入索引, 不用等下次全量同步
+        :param sources: construct_source_data构造的数据列表
+        """
+        for source in sources:
+            if source.get("data_tag") != "memory" or not source.get("source_vector"):
+                continue
+            with self.lock:
+                if self.scanning:
+                    self.added.append(source)
+                index = self.index_for(self.indexes, source)
+            index.add([source.get("uid")], [source["source_vector"]], [self.payload(source)])
+
+    def index_for(self, indexes, source):
+        """
+        在锁内调用, 取source的语言对的索引, 没有时新建
+        """
+        pair = (source.get("source_lang"), source.get("target_lang"))
+        index = indexes.get(pair)
+        if index is None:
+            index = indexes[pair] = build_index(self.index_type, cfg.VECTOR_DIM)
+        return index
+
+    @metrics.timed("vector_search")
+    def search(self, source_lang, target_lang, vectors, top_k=None):
+        """
+        批量检索相似的记忆
+        :param source_lang: 源语言
+        :param target_lang: 目标语言
+        :param vectors: 查询向量列表
+        :param top_k: 每个查询返回条数, 默认cfg.DEFAULT_TOP_K
+        :return: 每个查询一个列表, 元素为(余弦相似度, {"source", "target"})
+        """
+        self.maybe_sync()
+        index = self.indexes.get((source_lang, target_lang))
+        if index is None:
+            return [[] for _ in vectors]
+        return index.search(vectors, top_k or cfg.DEFAULT_TOP_K)
+
+    @staticmethod
+    def payload(source):
+        return {"source": source.get("source"), "target": source.get("target"), "uid": source.get("uid")}
+
+
+_memory_index = None
+_memory_index_lock = threading.Lock()
+
+
+def get_memory_index():
+    """
+    获取进程内共享的记忆库向量索引
+    """
+    global _memory_index
+    if _memory_index is None:
+        with _memory_index_lock:
+            if _memory_index is None:
+                _memory_index = TranslationMemoryIndex()
+    return _memory_index
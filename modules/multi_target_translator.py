@@ -0,0 +1,289 @@
+"""
+一次请求翻译成多种目标语言: 切分、token计数和记忆库精确匹配只做一次;
+joint方式每个文本块只发一个prompt, 要求按目标语言返回json对象, 原文和初始prompt只计一次token;
+fanout方式每种目标语言各自并发翻译, 复用切分结果和记忆库匹配结果, 与单独请求的译文和缓存完全一致
+"""
+import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from config.config import cfg, TranslationContext
+from modules.translator import AITranslatorModule
+from utils import metrics, utils
+from utils.cache import get_translation_cache
+from utils.message_history import MessageHistory
+from utils.single_flight import get_single_flight
+
+MULTI_TARGET_MODES = ["joint", "fanout"]
+
+
+@lru_cache(maxsize=64)
+def joint_prompt(source_lang, target_langs):
+    """
+    同时翻译成多种目标语言的初始prompt
+    :param source_lang: 源语言
+    :param target_langs: tuple, 目标语言
+    :return: (system消息, user消息)
+    """
+    languages = ", ".join(target_langs)
+    response_format = json.dumps({"result": {target_lang: "" for target_lang in target_langs}})
+    system_message = {"role": "system",
+                      "content": f"I want you to act as a translator, spell corrector and improver, you are good at translating any languages to and from each other. Now, I give you a {source_lang} sentence, please translate this sentence into each of these languages: {languages}, and answer with the corrected and improved versions. I want you to translate with prettier and more elegant high-level words and sentences of each language, but make them more professional. You should only respond in JSON format as described below, the result object must contain one translation for every language above, keyed by the language name \nResponse Format: \n ```{response_format}``` \nEnsure the response can be parsed by Python json.loads"}
+    query_message = {"role": "user",
+                     "content": f"Please translate this sentence into {languages}: "}
+    return system_message, query_message
+
+
+class MultiTargetTranslatorModule:
+    def __init__(self, cache=None, es_client=None, ctx=None):
+        """
+        :param cache: 翻译缓存, 默认为进程内共享的缓存
+        :param es_client: 可传入已有的ES客户端
+        :param ctx: TranslationContext, 本次请求的上下文, 目标语言以translate的参数为准
+        """
+        self.es = utils.Elastic(cfg.INDEX, client=es_client)
+        self.cache = cache if cache is not None else get_translation_cache()
+        self.ctx = ctx or TranslationContext.create()
+        # 目标语言 -> 该语言的单目标翻译器, 缓存键、记忆库检索和解析回复都复用它
+        self.translators = {}
+
+    def translate(self, query: str, source_lang: str = "English", target_langs=("Chinese",), mode=None,
+                  parallel=None):
+        """
+        翻译成多种目标语言, 已缓存的目标语言直接返回, 只剩一种时按单目标翻译
+        :param query: 待翻译的文本
+        :param source_lang: 源语言
+        :param target_langs: 目标语言列表
+        :param mode: joint/fanout, 默认cfg.MULTI_TARGET_MODE
+        :param parallel: 是否并行翻译各个文本块, 默认取cfg.PARALLEL_TRANSLATE
+        :return: dict, 目标语言 -> 译文
+        """
+        mode = mode or cfg.MULTI_TARGET_MODE
+        assert mode in MULTI_TARGET_MODES, f"multi_target_mode must be one of {MULTI_TARGET_MODES}"
+        self.ctx = self.ctx.replace(source_lang=source_lang)
+        self.translators = {
+            target_lang: AITranslatorModule(cache=self.cache, es_client=self.es.es,
+                                            ctx=self.ctx.replace(target_lang=target_lang))
+            for target_lang in dict.fromkeys(target_langs)}
+        results = {}
+        for target_lang, translator in self.translators.items():
+            cached = self.cache.get(translator.cache_key(query))
+            if cached is not None:
+                results[target_lang] = cached
+        pending = [target_lang for target_lang in self.translators if target_lang not in results]
+        if len(pending) == 1:
+            results[pending[0]] = self.translators[pending[0]].translate(query, source_lang, pending[0], parallel)
+        elif pending and mode == "fanout":
+            results.update(self.translate_fanout(query, pending, parallel))
+        elif pending:
+            results.update(self.translate_joint(query, pending, parallel))
+        return {target_lang: results[target_lang] for target_lang in self.translators}
+
+    def search_memories(self, text_list, target_langs):
+        """
+        所有目标语言的记忆库精确匹配合并成一次mget请求
+        :param text_list: 句子列表
+        :param target_langs: 目标语言列表
+        :return: dict, 目标语言 -> {句子索引: 人工译文}
+        """
+        memories = {target_lang: {} for target_lang in target_langs}
+        if not cfg.USE_TRANSLATION_MEMORY or not text_list:
+            return memories
+        uids = [utils.feedback_uid(text.strip(), self.ctx.source_lang, target_lang)
+                for target_lang in target_langs for text in text_list]
+        try:
+            sources = self.es.mget_sources(uids)
+        except Exception as err:
+            print(f"search translation memory went wrong! detail: {err}")
+            return memories
+        for position, source in enumerate(sources):
+            if source and source.get("target"):
+                memories[target_langs[position // len(text_list)]][position % len(text_list)] = source["target"]
+        return memories
+
+    def translate_fanout(self, query, target_langs, parallel=None):
+        """
+        每种目标语言并发翻译, 共用切分结果和记忆库匹配结果
+        :param query: 待翻译的文本
+        :param target_langs: 未命中缓存的目标语言
+        :param parallel: 是否并行翻译各个文本块
+        :return: dict, 目标语言 -> 译文
+        """
+        segments = utils.split_segments(query, self.ctx.text_token_limit)
+        memories = self.search_memories([segment.text for segment in segments], target_langs)
+
+        def translate_one(target_lang):
+            translator = self.translators[target_lang]
+            cache_key = translator.cache_key(query)
+            translated_text, _ = get_single_flight().run(
+                translator.flight_key(query, "document"),
+                lambda: translator.translate_document(query, cache_key, parallel, segments, memories[target_lang]),
+                "document")
+            return translated_text
+
+        with ThreadPoolExecutor(max_workers=len(target_langs)) as executor:
+            return dict(zip(target_langs, executor.map(metrics.propagate(translate_one), target_langs)))
+
+    def plan_joint_chunks(self, segments, memories, target_langs, limit):
+        """
+        命中记忆库的句子单独成块, 连续未命中的句子打包成文本块
+        :param segments: 句子片段列表
+        :param memories: dict, 目标语言 -> {句子索引: 人工译文}
+        :param target_langs: 目标语言列表
+        :param limit: 文本块的token限制
+        :return: (文本块列表, 与文本块一一对应的已有译文列表, 每项为dict 目标语言 -> 译文)
+        """
+        chunks, known, pending = [], [], []
+        for index, segment in enumerate(segments):
+            hits = {target_lang: memories[target_lang][index] for target_lang in target_langs
+                    if index in memories[target_lang]}
+            if not hits:
+                pending.append(segment)
+                continue
+            packed = utils.pack_segments(pending, limit)
+            chunks.extend(packed)
+            known.extend({} for _ in packed)
+            pending = []
+            chunks.append(segment.text)
+            known.append(hits)
+        packed = utils.pack_segments(pending, limit)
+        chunks.extend(packed)
+        known.extend({} for _ in packed)
+        # 单个文本块之前按目标语言翻译过的也不用再翻译
+        for chunk, chunk_known in zip(chunks, known):
+            for target_lang in target_langs:
+                if target_lang not in chunk_known:
+                    cached = self.cache.get(self.translators[target_lang].cache_key(chunk))
+                    if cached is not None:
+                        chunk_known[target_lang] = cached
+        return chunks, known
+
+    def translate_joint(self, query, target_langs, parallel=None):
+        """
+        每个文本块一个prompt同时翻译成所有目标语言, 回复的token数随目标语言数增长, 文本块按目标语言数缩小
+        :param query: 待翻译的文本
+        :param target_langs: 未命中缓存的目标语言
+        :param parallel: 是否并行翻译各个文本块
+        :return: dict, 目标语言 -> 译文
+        """
+        ctx = self.ctx.replace(target_lang=target_langs[0],
+                               text_token_limit=self.joint_token_limit(len(target_langs)))
+        segments = utils.split_segments(query, ctx.text_token_limit)
+        memories = self.search_memories([segment.text for segment in segments], target_langs)
+        chunks, known = self.plan_joint_chunks(segments, memories, target_langs, ctx.text_token_limit)
+        pending = [index for index in range(len(chunks)) if len(known[index]) < len(target_langs)]
+        references = self.search_references(chunks, pending, target_langs)
+        prefix = list(joint_prompt(self.ctx.source_lang, tuple(target_langs)))
+        parallel = cfg.PARALLEL_TRANSLATE if parallel is None else parallel
+        results = [dict(item) for item in known]
+        if parallel and len(pending) > 1:
+            max_workers = max(1, min(cfg.TRANSLATE_CONCURRENCY, len(pending)))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {index: executor.submit(metrics.propagate(self.joint_chunk_translate), prefix, chunks, index,
+                                                  target_langs, references.get(index), ctx)
+                           for index in pending}
+                for index, future in futures.items():
+                    results[index] = {**future.result(), **known[index]}
+        else:
+            history = MessageHistory(prefix, ctx)
+            for index, chunk in enumerate(chunks):
+                if index in pending:
+                    message, prompt_tokens = history.build(
+                        self.format_query(chunk, references.get(index)),
+                        reserve=self.output_reserve(chunk, len(target_langs)))
+                    results[index] = {**self.joint_request(message, prompt_tokens, chunk, target_langs,
+                                                           references.get(index), ctx), **known[index]}
+                history.add(chunk, results[index])
+
+        translations = {}
+        for target_lang in target_langs:
+            translations[target_lang] = "".join(f"{result[target_lang]}" for result in results)
+            if translations[target_lang]:
+                self.cache.set(self.translators[target_lang].cache_key(query), translations[target_lang])
+        return translations
+
+    def search_references(self, chunks, indexes, target_langs):
+        """
+        每种目标语言各自检索翻译参考
+        :return: dict, 文本块索引 -> {目标语言: 参考列表}
+        """
+        if not self.ctx.is_search_term or not indexes:
+            return {}
+        references = {}
+        for target_lang in target_langs:
+            for index, reference in self.translators[target_lang].search_references(chunks, indexes).items():
+                references.setdefault(index, {})[target_lang] = reference
+        return references
+
+    def joint_chunk_translate(self, prefix, chunks, index, target_langs, reference, ctx):
+        """
+        并行翻译时独立翻译一个文本块, 前cfg.PARALLEL_CONTEXT_WINDOW个文本块的原文作为上下文
+        :return: dict, 目标语言 -> 译文
+        """
+        message = list(prefix)
+        for prev in range(max(0, index - cfg.PARALLEL_CONTEXT_WINDOW), index):
+            message.append({"role": "user",
+                            "content": f"This is the preceding text, for context only, do not translate it: ```{chunks[prev]}```"})
+        message.append({"role": "user", "content": self.format_query(chunks[index], reference)})
+        reserve = self.output_reserve(chunks[index], len(target_langs))
+        utils.delete_oldest_history_message(message, ctx, reserve=reserve)
+        return self.joint_request(message, utils.prompt_token_usage(message, ctx), chunks[index], target_langs,
+                                  reference, ctx)
+
+    def joint_request(self, message, prompt_tokens, chunk, target_langs, reference, ctx):
+        """
+        请求GPT同时翻译成所有目标语言, 回复缺了某种语言时单独翻译这个文本块, 结果按目标语言写入文本块缓存
+        :param message: GPT请求的message
+        :param prompt_tokens: message的token数
+        :param chunk: 待翻译的文本块
+        :param target_langs: 目标语言列表
+        :param reference: dict, 目标语言 -> 翻译参考
+        :param ctx: 文本块缩小后的上下文
+        :return: dict, 目标语言 -> 译文
+        """
+        max_tokens = max(1, min(ctx.max_tokens - prompt_tokens, self.output_reserve(chunk, len(target_langs))))
+        translation = utils.gpt_request(message, ctx=ctx, max_tokens=max_tokens)
+        results = {}
+        for target_lang in target_langs:
+            translator = self.translators[target_lang]
+            try:
+                result = translator.get_translate_result(translation)
+            except Exception as err:
+                print(f"parse multi-target translation went wrong! detail: {err}")
+                result = None
+            if not isinstance(result, str) or not result:
+                translator.reset_history()
+                result = translator.part_translate(chunk, (reference or {}).get(target_lang))
+            else:
+                self.cache.set(translator.cache_key(chunk), result)
+            results[target_lang] = result
+        return results
+
+    def joint_token_limit(self, count):
+        """
+        文本块的原文加上所有目标语言的预估译文, 与单目标翻译时占用的上下文窗口相同
+        :param count: 目标语言数
+        :return: 文本块的token限制
+        """
+        ratio = cfg.OUTPUT_TOKEN_RATIO
+        return max(1, int(self.ctx.text_token_limit * (1 + ratio) / (1 + ratio * count)))
+
+    @staticmethod
+    def output_reserve(chunk, count):
+        """
+        :param chunk: 待翻译文本
+        :param count: 目标语言数
+        :return: 回复预留的token数, 每种目标语言一份译文
+        """
+        return utils.expected_output_tokens(utils.token_usage(chunk)) * count
+
+    @staticmethod
+    def format_query(translate_text, reference=None):
+        """
+        :param translate_text: 待翻译文本
+        :param reference: dict, 目标语言 -> 翻译参考
+        :return: 消息内容
+        """
+        if not reference:
+            return f"```{translate_text}```"
+        return f"Here are some standard terminology-translation references for each target language that can be used to improve your translation: ```\n{str(reference)}\n```\nPlease translate this sentence: ```{translate_text}```"
@@ -0,0 +1,326 @@
+"""
+术语表的进程内匹配: 从ES里data_tag为term的数据和cfg.GLOSSARY_PATH术语文件加载术语对, 每个语言对建一个Aho-Corasick自动机,
+一次线性扫描找出文本块里出现的所有术语, 只把命中的术语作为翻译参考, 代替逐个实体的multi_match查询
+安装了pyahocorasick时用它建自动机, 否则用纯Python实现
+"""
+import os
+import threading
+import time
+
+from config.config import cfg
+from utils import metrics, utils
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+def normalize(text):
+    """
+    匹配前统一转小写, 保证转换后每个字符的位置不变
+    """
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        return lowered
+    # 个别字符转小写后会变成多个字符, 这些字符保持原样
+    return "".join(char.lower() if len(char.lower()) == 1 else char for char in text)
+
+
+def is_word_char(char):
+    # 字母数字算单词字符, CJK等不用空格分词的文字不算, 术语两边不要求边界
+    return char.isalnum() and ord(char) < 0x2E80
+
+
+class Automaton:
+    def __init__(self, keys):
+        """
+        纯Python的Aho-Corasick自动机, 所有转移存在一个dict里, 键为(节点 << 21 | 字符码), 比每个节点一个dict省内存
+        :param keys: 关键词列表
+        """
+        self.goto = {}
+        # 节点i是第几个关键词的结尾, 不是结尾为-1
+        self.output = [-1]
+        parents, chars, depths = [0], [0], [0]
+        for key_id, key in enumerate(keys):
+            node = 0
+            for char in key:
+                code = node << 21 | ord(char)
+                child = self.goto.get(code)
+                if child is None:
+                    child = len(self.output)
+                    self.goto[code] = child
+                    self.output.append(-1)
+                    parents.append(node)
+                    chars.append(ord(char))
+                    depths.append(depths[node] + 1)
+                node = child
+            self.output[node] = key_id
+        # 按深度顺序计算失败指针, 父节点的失败指针总是先算好
+        self.fail = [0] * len(self.output)
+        # 沿失败指针能到达的最近的关键词结尾节点
+        self.next_output = [0] * len(self.output)
+        for node in sorted(range(1, len(self.output)), key=depths.__getitem__):
+            if depths[node] == 1:
+                continue
+            fail = self.fail[parents[node]]
+            while fail and (fail << 21 | chars[node]) not in self.goto:
+                fail = self.fail[fail]
+            fail = self.goto.get(fail << 21 | chars[node], 0)
+            self.fail[node] = fail
+            self.next_output[node] = fail if self.output[fail] >= 0 else self.next_output[fail]
+
+    def __len__(self):
+        return len(self.output)
+
+    def iter(self, text):
+        """
+        :param text: 已经normalize的文本
+        :return: (关键词结尾的下标, 关键词序号)的迭代器
+        """
+        goto, fail, output, next_output = self.goto, self.fail, self.output, self.next_output
+        node = 0
+        for end, char in enumerate(text):
+            code = ord(char)
+            child = goto.get(node << 21 | code)
+            while child is None and node:
+                node = fail[node]
+                child = goto.get(node << 21 | code)
+            node = child or 0
+            hit = node if output[node] >= 0 else next_output[node]
+            while hit:
+                yield end, output[hit]
+                hit = next_output[hit]
+
+
+class TermMatcher:
+    def __init__(self, terms):
+        """
+        :param terms: dict, normalize后的原文 -> (原文, 译文)
+        """
+        self.keys = list(terms)
+        self.terms = [terms[key] for key in self.keys]
+        if ahocorasick is not None:
+            self.automaton = ahocorasick.Automaton()
+            for key_id, key in enumerate(self.keys):
+                self.automaton.add_word(key, key_id)
+            if self.keys:
+                self.automaton.make_automaton()
+        else:
+            self.automaton = Automaton(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def candidates(self, text, normalized):
+        """
+        :param text: 原文本
+        :param normalized: normalize后的文本
+        :return: 两边满足单词边界的命中[(开始下标, 结束下标, 原文, 译文)]
+        """
+        if not self.keys:
+            return []
+        hits = []
+        for end, key_id in self.automaton.iter(normalized):
+            start = end - len(self.keys[key_id]) + 1
+            end += 1
+            if is_word_char(text[start]) and start > 0 and is_word_char(text[start - 1]):
+                continue
+            if is_word_char(text[end - 1]) and end < len(text) and is_word_char(text[end]):
+                continue
+            hits.append((start, end, *self.terms[key_id]))
+        return hits
+
+
+def select_terms(hits, limit=None):
+    """
+    重叠的命中取最靠左、同一位置取最长的, 按出现顺序去重
+    :param hits: [(开始下标, 结束下标, 原文, 译文)], 同一位置同样长度的排在前面的优先
+    :param limit: 最多返回的条数
+    :return: 参考列表[{原文: 译文}]
+    """
+    reference, seen, covered = [], set(), 0
+    for start, end, source, target in sorted(hits, key=lambda hit: (hit[0], hit[0] - hit[1])):
+        if start < covered:
+            continue
+        covered = end
+        if source in seen:
+            continue
+        seen.add(source)
+        reference.append({source: target})
+        if limit and len(reference) >= limit:
+            break
+    return reference
+
+
+class TerminologyIndex:
+    def __init__(self, es_client=None, glossary_path=None):
+        """
+        :param es_client: 可传入已有的ES客户端
+        :param glossary_path: 术语表文件(TMX/CSV/JSONL), 默认cfg.GLOSSARY_PATH
+        """
+        self.es_client = es_client
+        self.glossary_path = glossary_path or cfg.GLOSSARY_PATH
+        # (source_lang, target_lang) -> 全量加载的TermMatcher
+        self.matchers = {}
+        # 上次全量加载之后新增的术语, 单独建一个小自动机, 不用重建全量的
+        self.added = {}
+        self.delta = {}
+        # 每次add加1, (语言对, normalize后的原文) -> 加入时的序号, 全量加载时只清掉开始扫描之前加入的术语
+        self.generation = 0
+        self.added_generations = {}
+        self.loaded_at = 0
+        self.glossary_mtime = None
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.loading = False
+
+    def load(self):
+        """
+        从ES和术语表文件全量加载术语, 建好新自动机后整体替换
+        """
+        terms = {}
+        with self.lock:
+            start = self.generation
+        glossary_mtime = self.glossary_mtime_now()
+        if self.glossary_path:
+            for pair, source, target in self.read_glossary():
+                self.put(terms, pair, source, target)
+        es = utils.Elastic(cfg.INDEX, client=self.es_client)
+        for _, source in es.scan_sources({"term": {"data_tag": "term"}}):
+            self.put(terms, (source.get("source_lang"), source.get("target_lang")), source.get("source"),
+                     source.get("target"))
+        matchers = {pair: TermMatcher(pair_terms) for pair, pair_terms in terms.items()}
+        with self.lock:
+            self.matchers = matchers
+            # 开始扫描之后add的术语可能不在扫描结果里, 继续留在增量自动机里
+            self.added_generations = {item: generation for item, generation in self.added_generations.items()
+                                      if generation > start}
+            added = {}
+            for pair, key in self.added_generations:
+                added.setdefault(pair, {})[key] = self.added[pair][key]
+            self.added = added
+            self.delta = {pair: TermMatcher(pair_terms) for pair, pair_terms in added.items()}
+            self.glossary_mtime = glossary_mtime
+            self.loaded_at = time.time()
+        print(f"terminology index loaded: { {f'{k[0]}->{k[1]}': len(v) for k, v in matchers.items()} }")
+
+    def read_glossary(self):
+        """
+        :return: (语言对, 原文, 译文)的迭代器
+        """
+        from modules.feedback_ingest import read_pairs
+        source_lang, target_lang = cfg.GLOSSARY_LANGS
+        data_format = os.path.splitext(self.glossary_path)[1].lstrip(".").lower()
+        with open(self.glossary_path, "rb") as stream:
+            for record in read_pairs(stream, data_format, source_lang, target_lang):
+                if "error" not in record:
+                    yield (source_lang, target_lang), record.get("source"), record.get("target")
+
+    def glossary_mtime_now(self):
+        if not self.glossary_path or not os.path.exists(self.glossary_path):
+            return None
+        return os.path.getmtime(self.glossary_path)
+
+    @staticmethod
+    def put(terms, pair, source, target):
+        """
+        :return: normalize后的原文, 术语无效时为None
+        """
+        if not isinstance(source, str) or not isinstance(target, str) or not source.strip() or not target.strip():
+            return None
+        source = source.strip()
+        key = normalize(source)
+        terms.setdefault(pair, {})[key] = (source, target.strip())
+        return key
+
+    def maybe_sync(self):
+        """
+        首次使用时同步加载, 之后超过cfg.TERM_INDEX_SYNC_INTERVAL秒或术语表文件有修改时在后台线程重新加载
+        """
+        if not self.loaded_at:
+            with self.load_lock:
+                if not self.loaded_at:
+                    self.load()
+            return
+        expired = time.time() - self.loaded_at >= cfg.TERM_INDEX_SYNC_INTERVAL
+        if not expired and self.glossary_mtime_now() == self.glossary_mtime:
+            return
+        self.reload_in_background()
+
+    def reload_in_background(self):
+        with self.lock:
+            if self.loading:
+                return
+            self.loading = True
+        threading.Thread(target=self._background_load, daemon=True).start()
+
+    def _background_load(self):
+        try:
+            self.load()
+        except Exception as err:
+            print(f"reload terminology index went wrong! detail: {err}")
+        finally:
+            self.loading = False
+
+    def add(self, sources):
+        """
+        新的术语写入ES后马上生效: 只重建新增术语的小自动机, 新增的多了再在后台全量重建
+        :param sources: construct_source_data构造的数据列表
+        """
+        changed = set()
+        with self.lock:
+            self.generation += 1
+            for source in sources:
+                if source.get("data_tag") != "term":
+                    continue
+                pair = (source.get("source_lang"), source.get("target_lang"))
+                key = self.put(self.added, pair, source.get("source"), source.get("target"))
+                if key is None:
+                    continue
+                self.added_generations[(pair, key)] = self.generation
+                changed.add(pair)
+            for pair in changed:
+                self.delta[pair] = TermMatcher(self.added[pair])
+            total = sum(len(terms) for terms in self.added.values())
+        if total > cfg.TERM_DELTA_MAX_SIZE:
+            self.reload_in_background()
+
+    @metrics.timed("term_match")
+    def match(self, source_lang, target_lang, texts, limit=None):
+        """
+        找出每段文本里出现的术语
+        :param source_lang: 源语言
+        :param target_lang: 目标语言
+        :param texts: 文本列表
+        :param limit: 每段文本最多返回的条数, 默认cfg.TERM_MAX_REFERENCES
+        :return: 与texts一一对应的参考列表[{原文: 译文}]
+        """
+        self.maybe_sync()
+        pair = (source_lang, target_lang)
+        matchers = [matcher for matcher in (self.delta.get(pair), self.matchers.get(pair)) if matcher]
+        if not matchers:
+            return [[] for _ in texts]
+        references = []
+        for text in texts:
+            normalized = normalize(text)
+            # 新增的术语排在前面, 和全量里同一位置同样长度的术语重复时以新增的为准
+            hits = [hit for matcher in matchers for hit in matcher.candidates(text, normalized)]
+            references.append(select_terms(hits, limit or cfg.TERM_MAX_REFERENCES))
+        return references
+
+
+_term_index = None
+_term_index_lock = threading.Lock()
+
+
+def get_term_index():
+    """
+    获取进程内共享的术语索引
+    """
+    global _term_index
+    if _term_index is None:
+        with _term_index_lock:
+            if _term_index is None:
+                _term_index = TerminologyIndex()
+    return _term_index
@@ -0,0 +1,346 @@
+"""
+长文档的异步翻译任务: 任务和每个文本块的译文存在SQLite里, worker领取任务后逐块翻译并保存进度,
+worker崩溃后租约过期, 其他worker领取时从已完成的文本块继续, 不从头翻译
+worker可以嵌在API进程里, 也可以单独运行: python -m modules.translation_jobs --workers 4
+"""
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from config.config import cfg, TranslationContext
+from modules.translator import AITranslatorModule
+
+
+class JobStore:
+    def __init__(self, db_path=None):
+        """
+        :param db_path: SQLite文件路径, 默认cfg.JOB_DB_PATH, API进程和worker进程用同一个文件
+        """
+        self.db_path = db_path or cfg.JOB_DB_PATH
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        with self.transaction() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS translation_jobs ("
+                       "id TEXT PRIMARY KEY, status TEXT NOT NULL, text TEXT NOT NULL, options TEXT NOT NULL, "
+                       "total_chunks INTEGER, done_chunks INTEGER NOT NULL DEFAULT 0, "
+                       "resumed_chunks INTEGER NOT NULL DEFAULT 0, translated TEXT, error TEXT, "
+                       "worker TEXT, lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0, "
+                       "created_at REAL NOT NULL, started_at REAL, finished_at REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS translation_jobs_status ON translation_jobs (status, created_at)")
+            db.execute("CREATE TABLE IF NOT EXISTS translation_job_chunks ("
+                       "job_id TEXT NOT NULL, idx INTEGER NOT NULL, text TEXT NOT NULL, translated TEXT, "
+                       "PRIMARY KEY (job_id, idx))")
+
+    def transaction(self):
+        """
+        每个线程一个连接, WAL模式下读不阻塞写
+        """
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            self.local.db = db
+        return _Transaction(db)
+
+    def submit(self, text, ctx):
+        """
+        :param text: 待翻译的文本
+        :param ctx: TranslationContext
+        :return: 任务id
+        """
+        job_id = uuid.uuid4().hex
+        options = {"engine": ctx.engine, "source_lang": ctx.source_lang, "target_lang": ctx.target_lang,
+                   "is_search_term": ctx.is_search_term}
+        with self.transaction() as db:
+            db.execute("INSERT INTO translation_jobs (id, status, text, options, created_at) VALUES (?, ?, ?, ?, ?)",
+                       (job_id, "queued", text, json.dumps(options), time.time()))
+        return job_id
+
+    def claim(self, worker):
+        """
+        领取最早排队的任务, 或租约已过期(worker崩溃)的运行中任务
+        :param worker: worker标识
+        :return: 任务dict, 没有可领取的任务时返回None
+        """
+        now = time.time()
+        with self.transaction() as db:
+            while True:
+                row = db.execute("SELECT * FROM translation_jobs WHERE status = 'queued' "
+                                 "OR (status = 'running' AND lease_until < ?) ORDER BY created_at LIMIT 1",
+                                 (now,)).fetchone()
+                if row is None:
+                    return None
+                if row["status"] == "queued" or row["attempts"] < cfg.JOB_MAX_ATTEMPTS:
+                    break
+                # 每次领取都让worker崩溃的任务不再重试
+                db.execute("UPDATE translation_jobs SET status = 'failed', error = ?, lease_until = NULL, "
+                           "finished_at = ? WHERE id = ?", ("worker lease expired too many times", now, row["id"]))
+            db.execute("UPDATE translation_jobs SET status = 'running', worker = ?, lease_until = ?, "
+                       "attempts = attempts + 1, started_at = ?, resumed_chunks = done_chunks WHERE id = ?",
+                       (worker, now + cfg.JOB_LEASE_SECONDS, now, row["id"]))
+        job = dict(row)
+        job["attempts"] += 1
+        return job
+
+    def chunks(self, job_id):
+        """
+        :return: [(文本块, 译文)], 未翻译的译文为None
+        """
+        with self.transaction() as db:
+            rows = db.execute("SELECT text, translated FROM translation_job_chunks WHERE job_id = ? ORDER BY idx",
+                              (job_id,)).fetchall()
+        return [(row["text"], row["translated"]) for row in rows]
+
+    def set_chunks(self, job_id, worker, chunks, translations):
+        """
+        保存切分结果, 之后重试都用同一份切分
+        :param chunks: 文本块列表
+        :param translations: dict, 已有译文的文本块(如记忆库命中)
+        """
+        with self.transaction() as db:
+            self._check_owner(db, job_id, worker)
+            db.executemany("INSERT OR IGNORE INTO translation_job_chunks (job_id, idx, text, translated) "
+                           "VALUES (?, ?, ?, ?)",
+                           [(job_id, index, chunk, translations.get(index)) for index, chunk in enumerate(chunks)])
+            db.execute("UPDATE translation_jobs SET total_chunks = ?, done_chunks = ?, resumed_chunks = ? "
+                       "WHERE id = ?", (len(chunks), len(translations), len(translations), job_id))
+
+    def save_chunk(self, job_id, worker, index, translated):
+        """
+        保存一个文本块的译文并续租
+        """
+        with self.transaction() as db:
+            self._check_owner(db, job_id, worker)
+            db.execute("UPDATE translation_job_chunks SET translated = ? WHERE job_id = ? AND idx = ?",
+                       (translated, job_id, index))
+            db.execute("UPDATE translation_jobs SET done_chunks = done_chunks + 1, lease_until = ? WHERE id = ?",
+                       (time.time() + cfg.JOB_LEASE_SECONDS, job_id))
+
+    def finish(self, job_id, worker, translated):
+        with self.transaction() as db:
+            self._check_owner(db, job_id, worker)
+            db.execute("UPDATE translation_jobs SET status = 'done', translated = ?, finished_at = ?, "
+                       "lease_until = NULL WHERE id = ?", (translated, time.time(), job_id))
+
+    def fail(self, job_id, worker, error):
+        """
+        出错时重新排队, 超过cfg.JOB_MAX_ATTEMPTS次后标记为失败
+        """
+        with self.transaction() as db:
+            row = self._check_owner(db, job_id, worker)
+            status = "failed" if row["attempts"] >= cfg.JOB_MAX_ATTEMPTS else "queued"
+            db.execute("UPDATE translation_jobs SET status = ?, error = ?, lease_until = NULL, finished_at = ? "
+                       "WHERE id = ?", (status, error, time.time() if status == "failed" else None, job_id))
+
+    @staticmethod
+    def _check_owner(db, job_id, worker):
+        # 租约过期后任务可能已被别的worker领走, 原来的worker不能再写
+        row = db.execute("SELECT * FROM translation_jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or row["worker"] != worker or row["status"] != "running":
+            raise LeaseLost(f"job {job_id} is no longer owned by {worker}")
+        return row
+
+    def get(self, job_id):
+        """
+        :param job_id: 任务id
+        :return: 任务状态dict, 包括进度百分比和预计剩余时间, 任务不存在时返回None
+        """
+        with self.transaction() as db:
+            row = db.execute("SELECT * FROM translation_jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        total, done = job["total_chunks"], job["done_chunks"]
+        eta = None
+        if job["status"] == "running" and total and job["started_at"]:
+            # 按本次领取之后翻译的文本块的速度估算
+            translated = done - job["resumed_chunks"]
+            if translated > 0:
+                eta = round((time.time() - job["started_at"]) / translated * (total - done), 1)
+        return {
+            "job_id": job["id"],
+            "status": job["status"],
+            "progress": round(done / total * 100, 1) if total else (100.0 if job["status"] == "done" else 0.0),
+            "done_chunks": done,
+            "total_chunks": total,
+            "eta_seconds": eta,
+            "attempts": job["attempts"],
+            "error": job["error"],
+            "created_at": job["created_at"],
+            "started_at": job["started_at"],
+            "finished_at": job["finished_at"],
+            "translated": job["translated"],
+            **json.loads(job["options"]),
+        }
+
+
+class _Transaction:
+    """
+    BEGIN IMMEDIATE开始的事务, 领取任务时多个进程不会拿到同一个任务
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, *exc_info):
+        self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class JobWorker:
+    def __init__(self, store=None, worker=None, translator_factory=None):
+        """
+        :param store: JobStore, 默认按cfg.JOB_DB_PATH创建
+        :param worker: worker标识, 默认为主机名-进程号-随机串
+        :param translator_factory: 按TranslationContext创建翻译器的函数, 默认AITranslatorModule
+        """
+        self.store = store or JobStore()
+        self.worker = worker or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.translator_factory = translator_factory or (lambda ctx: AITranslatorModule(ctx=ctx))
+
+    def run_once(self):
+        """
+        领取并完成一个任务
+        :return: 是否领到了任务
+        """
+        job = self.store.claim(self.worker)
+        if job is None:
+            return False
+        try:
+            self.process(job)
+        except LeaseLost as err:
+            print(f"translation job {job['id']} lost: {err}")
+        except Exception as err:
+            print(f"translation job {job['id']} went wrong! detail: {err}")
+            try:
+                self.store.fail(job["id"], self.worker, str(err))
+            except LeaseLost:
+                pass
+        return True
+
+    def process(self, job):
+        """
+        逐块翻译并保存进度, 已完成的文本块直接作为历史, 不再翻译
+        """
+        options = json.loads(job["options"])
+        # 任务走batch通道, GPT配额紧张时让在线翻译请求先用
+        ctx = TranslationContext.create(options["engine"], options["source_lang"], options["target_lang"],
+                                        options["is_search_term"], priority="batch")
+        translator = self.translator_factory(ctx)
+        saved = self.store.chunks(job["id"])
+        if saved:
+            chunks = [chunk for chunk, _ in saved]
+            translations = {index: translated for index, (_, translated) in enumerate(saved) if translated is not None}
+            pending = [index for index in range(len(chunks)) if index not in translations]
+            references = translator.search_references(chunks, pending)
+        else:
+            chunks, translations, references = translator.prepare_chunks(job["text"])
+            self.store.set_chunks(job["id"], self.worker, chunks, translations)
+        translator.reset_history()
+        for index, chunk in enumerate(chunks):
+            if index in translations:
+                translator.history.add(chunk, translations[index])
+                continue
+            translations[index] = translator.part_translate(chunk, references.get(index))
+            self.store.save_chunk(job["id"], self.worker, index, translations[index])
+        translated = "".join(f"{translations[index]}" for index in range(len(chunks)))
+        if translated:
+            translator.cache.set(translator.cache_key(job["text"]), translated)
+        self.store.finish(job["id"], self.worker, translated)
+
+    def run_forever(self, stop=None):
+        """
+        循环领取任务, 没有任务时等cfg.JOB_POLL_INTERVAL秒
+        :param stop: threading.Event, 设置后退出
+        """
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                busy = self.run_once()
+            except Exception as err:
+                print(f"translation job worker went wrong! detail: {err}")
+                busy = False
+            if not busy:
+                stop.wait(cfg.JOB_POLL_INTERVAL)
+
+
+class JobWorkerPool:
+    def __init__(self, workers=None, store=None):
+        """
+        :param workers: worker线程数, 默认cfg.JOB_WORKERS
+        :param store: JobStore, 各线程共用
+        """
+        self.size = cfg.JOB_WORKERS if workers is None else workers
+        self.store = store or JobStore()
+        self.stop_event = threading.Event()
+        self.threads = []
+
+    def start(self):
+        for _ in range(self.size):
+            thread = threading.Thread(target=JobWorker(self.store).run_forever, args=(self.stop_event,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join(timeout)
+
+
+_job_store = None
+_job_store_lock = threading.Lock()
+_embedded_pool = None
+
+
+def get_job_store():
+    """
+    获取进程内共享的任务存储
+    """
+    global _job_store
+    if _job_store is None:
+        with _job_store_lock:
+            if _job_store is None:
+                _job_store = JobStore()
+    return _job_store
+
+
+def start_embedded_workers():
+    """
+    在API进程里启动cfg.JOB_EMBEDDED_WORKERS个worker线程, 单独部署worker时配置为0
+    """
+    global _embedded_pool
+    with _job_store_lock:
+        if _embedded_pool is None and cfg.JOB_EMBEDDED_WORKERS > 0:
+            _embedded_pool = JobWorkerPool(cfg.JOB_EMBEDDED_WORKERS, JobStore()).start()
+    return _embedded_pool
+
+
+def main():
+    parser = argparse.ArgumentParser(description="运行长文档翻译任务的worker")
+    parser.add_argument("--workers", type=int, default=cfg.JOB_WORKERS, help="worker线程数")
+    args = parser.parse_args()
+    pool = JobWorkerPool(args.workers, get_job_store()).start()
+    print(f"translation job workers started: {args.workers}, db: {pool.store.db_path}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pool.stop()
+
+
+if __name__ == '__main__':
+    main()
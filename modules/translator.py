@@ -1,110 +1,603 @@
-from config.config import cfg
-from utils import utils
+from config.config import cfg, TranslationContext
+from utils import metrics, utils
+from utils.cache import get_translation_cache, TranslationCache
+from utils.doc_format import PLACEHOLDER
+from utils.languages import get_language_registry
+from utils.embedding_service import get_embedding_service
+from utils.message_history import MessageHistory
+from utils.single_flight import get_single_flight
+from modules.memory_index import get_memory_index
+from modules.term_index import get_term_index
 import json
 import ast
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+
+@lru_cache(maxsize=64)
+def init_prompt(source_lang, target_lang):
+    """
+    初始prompt只和语言对有关, 每个语言对只构造一次
+    :param source_lang: 源语言
+    :param target_lang: 目标语言
+    :return: (system消息, user消息)
+    """
+    response_format = json.dumps({"result": ""})
+    system_message = {"role": "system",
+                      "content": f"I want you to act as a translator, spell corrector and improver, you are good at translating any languages to and from each other. Now, I give you a {source_lang} sentence, please translate this sentence into {target_lang}, and answer with the corrected and improved version. I want you to translate with prettier and more elegant high-level {target_lang} words and sentences, but make them more professional. You should only respond in JSON format as described below \nResponse Format: \n ```{response_format}``` \nEnsure the response can be parsed by Python json.loads"}
+    query_message = {"role": "user",
+                     "content": f"Please translate this sentence into {target_lang}: "}
+    return system_message, query_message
+
+
+# Markdown/HTML的文本单元里代码、链接和标签换成了{{n}}占位符, 只在待翻译文本有占位符时加这句, 不改变固定的prompt前缀
+PLACEHOLDER_INSTRUCTION = ("The text contains placeholders like {{0}} that stand for code, links and markup. Keep every "
+                           "placeholder unchanged, exactly once each, and in the same order as in the text.")
 
 
 class AITranslatorModule:
-    def __init__(self):
-        self.es = utils.Elastic(cfg.INDEX)
-        self.message = []
-        self.source_lang = "English"
-        self.target_lang = "Chinese"
+    def __init__(self, cache=None, es_client=None, memory_index=None, ctx=None, term_index=None):
+        """
+        :param cache: 翻译缓存, 默认为进程内共享的缓存
+        :param es_client: 可传入已有的ES客户端
+        :param memory_index: 记忆库向量索引, 默认为进程内共享的索引
+        :param term_index: 术语索引, 默认为进程内共享的索引
+        :param ctx: TranslationContext, 本次请求的上下文(engine, token限制, 是否搜索术语), 默认按cfg创建
+        """
+        self.es = utils.Elastic(cfg.INDEX, client=es_client)
+        self.cache = cache if cache is not None else get_translation_cache()
+        self.memory_index = memory_index
+        self.term_index = term_index
+        self.ctx = ctx or TranslationContext.create()
+        self.history = None
+
+    @property
+    def source_lang(self):
+        return self.ctx.source_lang
+
+    @property
+    def target_lang(self):
+        return self.ctx.target_lang
 
-    def translate(self, query: str, source_lang: str = "English", target_lang: str = "Chinese"):
+    def use_languages(self, source_lang, target_lang):
+        """
+        切换本次翻译的语言对
+        :param source_lang: 源语言
+        :param target_lang: 目标语言
+        """
+        self.ctx = self.ctx.replace(source_lang=source_lang, target_lang=target_lang)
+
+    def translate(self, query: str, source_lang: str = "English", target_lang: str = "Chinese", parallel=None):
         """
         翻译主函数
         :param query: 待翻译的文本
         :param source_lang: 源语言
         :param target_lang: 目标语言
+        :param parallel: 是否并行翻译各个文本块, 默认取cfg.PARALLEL_TRANSLATE
         :return: 翻译结果
         """
-        self.source_lang = source_lang
-        self.target_lang = target_lang
-        cfg.MAX_TOKENS = cfg.ENGINE_TOKENS_MAPPING.get(cfg.AZURE_GPT_ENGINE, 4096)
-        cfg.TEXT_TOKEN_LIMIT = cfg.MAX_TOKENS // 4
-        text_list = utils.cut_text_as_short_as_possible(query)
-        # 这种情况是句子长度不达限制，没有进行切分
-        if len(text_list) == 1:
-            # translate directly
-            self.construct_init_message()
-            self.add_message(f"```{text_list[0]}```", role="user")
-            translation = utils.gpt_request(self.message)
-            translated_text = self.get_translate_result(translation)
-        # 这种情况是句子长度达到限制，进行切分
-        else:
-            self.construct_init_message()
-            translate_text = ""
-            translated_text = ""
-            while text_list:
-                translate_text = f"{translate_text}{text_list.pop(0)}"
-                translate_token = utils.token_usage(translate_text)
-                if translate_token >= cfg.TEXT_TOKEN_LIMIT:
-                    translation_item = self.part_translate(translate_text)
-                    translated_text = f"{translated_text}{translation_item}"
-                    translate_text = ""
-            # 最后一段小于cfg.TEXT_TOKEN_LIMIT长度的文本
-            if translate_text:
-                translation_item = self.part_translate(translate_text)
-                translated_text = f"{translated_text}{translation_item}"
+        self.use_languages(source_lang, target_lang)
+        # 整篇文本命中缓存则直接返回
+        cache_key = self.cache_key(query)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return cached
+        # 同样的文本正在被其他请求翻译时等它的结果
+        translated_text, _ = get_single_flight().run(
+            self.flight_key(query, "document"), lambda: self.translate_document(query, cache_key, parallel), "document")
+        return translated_text
 
+    def translate_document(self, query, cache_key, parallel=None, segments=None, memories=None):
+        """
+        切分并翻译整篇文本, 结果写入缓存
+        :param query: 待翻译的文本
+        :param cache_key: 整篇文本的缓存键
+        :param parallel: 是否并行翻译各个文本块, 默认取cfg.PARALLEL_TRANSLATE
+        :param segments: 已切分好的句子片段, 默认在这里切分
+        :param memories: 已查好的记忆库匹配结果, 默认在这里查询
+        :return: 翻译结果
+        """
+        chunks, translations, references = self.prepare_chunks(query, segments, memories)
+        translated_text = self.translate_chunks(chunks, translations, references, parallel)
+        if translated_text:
+            self.cache.set(cache_key, translated_text)
+        return translated_text
+
+    def translate_chunks(self, chunks, translations, references=None, parallel=None):
+        """
+        翻译还没有译文的文本块, 已有译文的文本块作为前后文本块的上下文
+        :param chunks: 文本块列表
+        :param translations: dict, 已有译文的文本块索引 -> 译文, 翻译完的文本块也写入这里
+        :param references: dict, 文本块索引 -> 翻译参考
+        :param parallel: 是否并行翻译各个文本块, 默认取cfg.PARALLEL_TRANSLATE
+        :return: 拼接后的译文
+        """
+        references = references or {}
+        pending = [index for index in range(len(chunks)) if index not in translations]
+        parallel = cfg.PARALLEL_TRANSLATE if parallel is None else parallel
+        if parallel and len(pending) > 1:
+            return self.parallel_translate(chunks, translations, references)
+        self.reset_history()
+        translated_text = ""
+        for index, chunk in enumerate(chunks):
+            if index in translations:
+                # 命中记忆库的文本块也记入历史, 作为后续文本块的上下文
+                self.history.add(chunk, translations[index])
+            else:
+                translations[index] = self.part_translate(chunk, references.get(index))
+            translated_text = f"{translated_text}{translations[index]}"
         return translated_text
 
-    def part_translate(self, translate_text):
+    def translate_stream(self, query: str, source_lang: str = "English", target_lang: str = "Chinese",
+                         token_deltas=False):
+        """
+        流式翻译, 每翻译完一个文本块就产出一个事件, 不用等整篇翻译完
+        :param query: 待翻译的文本
+        :param source_lang: 源语言
+        :param target_lang: 目标语言
+        :param token_deltas: 是否同时产出GPT流式返回的增量文本
+        :return: 事件dict的生成器, event为delta(增量文本)/chunk(一个文本块的译文)/done(全部完成)
+        """
+        start = time.time()
+        self.use_languages(source_lang, target_lang)
+        cache_key = self.cache_key(query)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            chunks, translations, references = [query], {0: cached}, {}
+        else:
+            chunks, translations, references = self.prepare_chunks(query)
+        self.reset_history()
+        translated_text = ""
+        for index, chunk in enumerate(chunks):
+            chunk_start = time.time()
+            from_memory = index in translations
+            if from_memory:
+                translation_item = translations[index]
+                self.history.add(chunk, translation_item)
+            elif token_deltas:
+                translation_item = yield from self.part_translate_stream(chunk, references.get(index), index)
+            else:
+                translation_item = self.part_translate(chunk, references.get(index))
+            translated_text = f"{translated_text}{translation_item}"
+            yield {
+                "event": "chunk",
+                "index": index,
+                "total": len(chunks),
+                "text": chunk,
+                "translated": translation_item,
+                "from_memory": from_memory,
+                "chunk_time_cost": round(time.time() - chunk_start, 3),
+                "elapsed": round(time.time() - start, 3),
+            }
+        if translated_text and cached is None:
+            self.cache.set(cache_key, translated_text)
+        yield {"event": "done", "translated": translated_text, "time_cost": round(time.time() - start, 3)}
+
+    def prepare_chunks(self, query, segments=None, memories=None):
+        """
+        切分文本, 用记忆库精确匹配, 把未命中的句子按text_token_limit打包成文本块, 需要时检索翻译参考
+        :param query: 待翻译的文本
+        :param segments: 已切分好的句子片段(多目标语言翻译时共用), 默认在这里切分
+        :param memories: 已查好的记忆库匹配结果, 默认在这里查询
+        :return: (文本块列表, dict 已有译文的文本块索引 -> 译文, dict 文本块索引 -> 翻译参考)
+        """
+        segments = utils.split_segments(query, self.ctx.text_token_limit) if segments is None else segments
+        chunks, translations = self.plan_chunks(segments, memories)
+        pending = [index for index in range(len(chunks)) if index not in translations]
+        # 需要搜索术语/记忆时, 一次性embedding所有待翻译文本块并检索相似记忆作为参考
+        references = self.search_references(chunks, pending)
+        return chunks, translations, references
+
+    def cache_key(self, text, source_lang=None, target_lang=None):
+        """
+        当前语言对和模型下的缓存键, 带参考检索的结果与不带的分开缓存
+        :param text: 待翻译文本
+        :param source_lang: 源语言, 默认为当前的源语言
+        :param target_lang: 目标语言, 默认为当前的目标语言
+        :return: 缓存键
+        """
+        return self.cache.make_key(text, source_lang or self.source_lang, target_lang or self.target_lang,
+                                   self.key_engine())
+
+    def key_engine(self):
+        return f"{self.ctx.engine}+search" if self.ctx.is_search_term else self.ctx.engine
+
+    def flight_key(self, text, level):
+        """
+        合并相同并发翻译的键, 组成与缓存键相同, 关闭缓存时也生效; 整篇和文本块分开, 单个文本块的整篇文本不会等待自己
+        :param text: 待翻译文本
+        :param level: document/chunk
+        :return: (层级, 键)
+        """
+        return level, TranslationCache.make_key(text, self.source_lang, self.target_lang, self.key_engine())
+
+    @metrics.timed("chunk_packing")
+    def plan_chunks(self, segments, memories=None):
+        """
+        先用记忆库精确匹配每个句子, 再把连续未命中的句子打包成文本块
+        :param segments: utils.split_segments切分出的句子片段列表
+        :param memories: dict, 已查好的记忆库匹配结果(句子索引 -> 人工译文), 默认在这里查询
+        :return: (文本块列表, dict 已命中记忆库的文本块索引 -> 译文)
+        """
+        memories = self.search_memories([segment.text for segment in segments]) if memories is None else memories
+        chunks, translations, pending = [], {}, []
+        for index, segment in enumerate(segments):
+            if index not in memories:
+                pending.append(segment)
+                continue
+            chunks.extend(utils.pack_segments(pending, self.ctx.text_token_limit))
+            pending = []
+            translations[len(chunks)] = memories[index]
+            chunks.append(segment.text)
+        chunks.extend(utils.pack_segments(pending, self.ctx.text_token_limit))
+        return chunks, translations
+
+    def search_memories(self, text_list):
+        """
+        用人工反馈的uid在记忆库里精确匹配, 所有句子只发一次mget请求
+        :param text_list: 句子列表
+        :return: dict, 命中的句子索引 -> 人工译文
+        """
+        if not cfg.USE_TRANSLATION_MEMORY or not text_list:
+            return {}
+        uids = [utils.feedback_uid(text.strip(), self.source_lang, self.target_lang) for text in text_list]
+        try:
+            sources = self.es.mget_sources(uids)
+        except Exception as err:
+            print(f"search translation memory went wrong! detail: {err}")
+            return {}
+        return {index: source["target"] for index, source in enumerate(sources) if source and source.get("target")}
+
+    def search_references(self, chunks, indexes):
+        """
+        找出文本块里的术语, 检索与文本块相似的记忆, 作为翻译参考, 只在需要搜索术语时启用
+        :param chunks: 文本块列表
+        :param indexes: 需要检索的文本块索引
+        :return: dict, 文本块索引 -> 参考列表[{原文: 译文}]
+        """
+        if not self.ctx.is_search_term or not indexes:
+            return {}
+        terms = self.search_terms(chunks, indexes)
+        try:
+            vectors = get_embedding_service().embed([chunks[index] for index in indexes])
+            if cfg.VECTOR_INDEX_TYPE == "es":
+                hits = [[(None, source) for source in
+                         self.es.es_search(self.format_should_query([], "memory", vector), cfg.DEFAULT_TOP_K)]
+                        for vector in vectors]
+            else:
+                memory_index = self.memory_index or get_memory_index()
+                hits = memory_index.search(self.source_lang, self.target_lang, vectors)
+        except Exception as err:
+            print(f"search references went wrong! detail: {err}")
+            return terms
+        return self.merge_references(terms, self.collect_references(indexes, hits))
+
+    def search_terms(self, chunks, indexes):
+        """
+        用术语索引一次扫描找出每个文本块里出现的术语
+        :param chunks: 文本块列表
+        :param indexes: 需要检索的文本块索引
+        :return: dict, 文本块索引 -> 术语列表[{原文: 译文}]
+        """
+        try:
+            term_index = self.term_index or get_term_index()
+            matches = term_index.match(self.source_lang, self.target_lang, [chunks[index] for index in indexes])
+        except Exception as err:
+            print(f"search terms went wrong! detail: {err}")
+            return {}
+        return {index: reference for index, reference in zip(indexes, matches) if reference}
+
+    @staticmethod
+    def merge_references(terms, references):
+        """
+        术语排在相似记忆前面
+        :param terms: dict, 文本块索引 -> 术语列表
+        :param references: dict, 文本块索引 -> 相似记忆列表
+        :return: 合并后的references
+        """
+        for index, reference in terms.items():
+            references[index] = reference + references.get(index, [])
+        return references
+
+    def collect_references(self, indexes, hits):
+        """
+        过滤掉相似度过低的检索结果, 整理成每个文本块的参考列表
+        :param indexes: 检索的文本块索引
+        :param hits: 与indexes一一对应的检索结果[(相似度, _source)], 相似度为None时不过滤
+        :return: dict, 文本块索引 -> 参考列表[{原文: 译文}]
+        """
+        references = {}
+        for index, chunk_hits in zip(indexes, hits):
+            reference = [{item.get("source"): item.get("target")} for score, item in chunk_hits
+                         if score is None or score >= cfg.REFERENCE_MIN_SCORE]
+            if reference:
+                references[index] = reference
+        return references
+
+    def parallel_translate(self, chunks, translations=None, references=None):
+        """
+        并发翻译多个文本块, 再按原顺序拼接
+        :param chunks: 文本块列表
+        :param translations: dict, 已有译文的文本块(如记忆库命中), 索引 -> 译文, 这些文本块不再翻译
+        :param references: dict, 文本块索引 -> 翻译参考
+        :return: 翻译结果
+        """
+        translations = {} if translations is None else translations
+        references = references or {}
+        pending = [index for index in range(len(chunks)) if index not in translations]
+        max_workers = max(1, min(cfg.TRANSLATE_CONCURRENCY, len(pending)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(metrics.propagate(self.chunk_translate), index, chunks, translations, references.get(index))
+                       for index in pending]
+            for future in futures:
+                future.result()
+        return "".join(f"{translations[index]}" for index in range(len(chunks)))
+
+    def chunk_translate(self, index, chunks, translations, reference=None):
+        """
+        独立翻译一个文本块, 用前cfg.PARALLEL_CONTEXT_WINDOW个文本块作为上下文,
+        已翻译完的前文带上原文/译文对, 未翻译完的只带原文
+        :param index: 文本块索引
+        :param chunks: 全部文本块
+        :param translations: dict, 已完成的翻译结果, 索引 -> 译文
+        :param reference: 该文本块的翻译参考
+        :return: 翻译结果
+        """
+        cache_key = self.cache_key(chunks[index])
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            translations[index] = cached
+            return cached
+        translations[index], _ = get_single_flight().run(
+            self.flight_key(chunks[index], "chunk"),
+            lambda: self.translate_chunk(index, chunks, translations, reference, cache_key))
+        return translations[index]
+
+    def translate_chunk(self, index, chunks, translations, reference, cache_key):
+        """
+        chunk_translate里实际请求GPT的部分, 结果写入缓存
+        :return: 翻译结果
+        """
+        message = self.construct_chunk_message(index, chunks, translations, reference)
+        pieces = self.overflow_pieces(message, chunks[index])
+        if pieces:
+            translation_item = ""
+            for piece in pieces:
+                message = self.construct_chunk_message(index, chunks, translations, reference, piece)
+                translation = utils.gpt_request(message, ctx=self.ctx)
+                translation_item = f"{translation_item}{self.get_translate_result(translation)}"
+        else:
+            translation = utils.gpt_request(message, ctx=self.ctx)
+            translation_item = self.get_translate_result(translation)
+        if translation_item:
+            self.cache.set(cache_key, translation_item)
+        return translation_item
+
+    def construct_chunk_message(self, index, chunks, translations, reference=None, translate_text=None):
+        """
+        构造独立翻译一个文本块的message, 带上前cfg.PARALLEL_CONTEXT_WINDOW个文本块作为上下文
+        :param index: 文本块索引
+        :param chunks: 全部文本块
+        :param translations: dict, 已完成的翻译结果, 索引 -> 译文
+        :param reference: 该文本块的翻译参考
+        :param translate_text: 实际要翻译的文本, 文本块被切小时为其中的一段, 默认为整个文本块
+        :return: GPT请求的message
+        """
+        translate_text = chunks[index] if translate_text is None else translate_text
+        message = self.construct_init_message(message=[])
+        for prev in range(max(0, index - cfg.PARALLEL_CONTEXT_WINDOW), index):
+            if prev in translations:
+                message.append({"role": "user", "content": f"```{chunks[prev]}```"})
+                message.append({"role": "assistant",
+                                "content": json.dumps({"result": translations[prev]}, ensure_ascii=False)})
+            else:
+                message.append({"role": "user",
+                                "content": f"This is the preceding text, for context only, do not translate it: ```{chunks[prev]}```"})
+        message.append({"role": "user", "content": self.format_query(translate_text, reference)})
+        utils.delete_oldest_history_message(message, self.ctx, reserve=self.output_reserve(translate_text))
+        return message
+
+    def output_reserve(self, translate_text):
+        """
+        按原文预估回复需要的token数, 删除历史消息时预留出来
+        :param translate_text: 待翻译文本
+        :return: 预留的token数
+        """
+        return utils.expected_output_tokens(utils.token_usage(translate_text))
+
+    def overflow_pieces(self, message, translate_text, prompt_tokens=None):
+        """
+        预估回复会超出上下文窗口时, 把文本块按一半的token限制切小分别翻译, 而不是等回复被截断再请求续写
+        :param message: 已删减过历史的GPT请求message
+        :param translate_text: 待翻译文本
+        :param prompt_tokens: message的token数, 已知时不再重新计算
+        :return: 切小后的文本列表, 不会超出或无法再切时返回None
+        """
+        text_tokens = utils.token_usage(translate_text)
+        if prompt_tokens is None:
+            prompt_tokens = utils.prompt_token_usage(message, self.ctx)
+        if prompt_tokens + utils.expected_output_tokens(text_tokens) <= self.ctx.max_tokens:
+            return None
+        limit = max(1, text_tokens // 2)
+        pieces = utils.pack_segments(utils.split_segments(translate_text, limit), limit)
+        return pieces if len(pieces) > 1 else None
+
+    def part_translate(self, translate_text, reference=None):
         """
         在这里进行一块一块文本的翻译
         :param translate_text: str
+        :param reference: 该文本块的翻译参考
         :return: 翻译结果
         """
-        self.add_message(f"```{translate_text}```", role="user")
-        # 删除最久远的历史消息直到小于GPT的token限制
-        utils.delete_oldest_history_message(self.message)
-        translation = utils.gpt_request(self.message)
-        self.add_message(translation, role="assistant")
+        cache_key = self.cache_key(translate_text)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            # 命中缓存也要把结果记入历史, 保持后续文本块的上下文
+            self.history.add(translate_text, cached)
+            return cached
+        translation_item, joined = get_single_flight().run(
+            self.flight_key(translate_text, "chunk"), lambda: self.translate_part(translate_text, reference, cache_key))
+        if joined:
+            self.history.add(translate_text, translation_item)
+        return translation_item
+
+    def translate_part(self, translate_text, reference, cache_key):
+        """
+        part_translate里实际请求GPT的部分, 结果记入历史并写入缓存
+        :return: 翻译结果
+        """
+        # 丢弃最久远的历史直到给回复留够token
+        message, prompt_tokens = self.history.build(self.format_query(translate_text, reference),
+                                                    reserve=self.output_reserve(translate_text))
+        pieces = self.overflow_pieces(message, translate_text, prompt_tokens)
+        if pieces:
+            # 切小的文本各自带着历史翻译
+            translation_item = "".join(f"{self.part_translate(piece, reference)}" for piece in pieces)
+        else:
+            translation = utils.gpt_request(message, ctx=self.ctx)
+            translation_item = self.get_translate_result(translation)
+            self.history.add(translate_text, translation_item)
+        if translation_item:
+            self.cache.set(cache_key, translation_item)
+        return translation_item
+
+    def part_translate_stream(self, translate_text, reference=None, index=0):
+        """
+        流式翻译一个文本块, 边收到GPT的输出边产出增量译文
+        :param translate_text: str
+        :param reference: 该文本块的翻译参考
+        :param index: 文本块索引
+        :return: 产出delta事件, 生成器的返回值为该文本块的翻译结果
+        """
+        cache_key = self.cache_key(translate_text)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            self.history.add(translate_text, cached)
+            yield {"event": "delta", "index": index, "delta": cached}
+            return cached
+        message, prompt_tokens = self.history.build(self.format_query(translate_text, reference),
+                                                    reserve=self.output_reserve(translate_text))
+        pieces = self.overflow_pieces(message, translate_text, prompt_tokens)
+        if pieces:
+            translation_item = ""
+            for piece in pieces:
+                piece_item = yield from self.part_translate_stream(piece, reference, index)
+                translation_item = f"{translation_item}{piece_item}"
+            if translation_item:
+                self.cache.set(cache_key, translation_item)
+            return translation_item
+        parser = utils.ResultStreamParser()
+        translation = ""
+        for delta in utils.gpt_request_stream(message, self.ctx):
+            translation = f"{translation}{delta}"
+            text = parser.feed(delta)
+            if text:
+                yield {"event": "delta", "index": index, "delta": text}
         translation_item = self.get_translate_result(translation)
+        self.history.add(translate_text, translation_item)
+        if translation_item:
+            self.cache.set(cache_key, translation_item)
         return translation_item
 
+    @metrics.timed("json_parse")
     def get_translate_result(self, translation):
         """
         获取翻译结果, 从GPT返回的答案中匹配json，并获取值，如果值不是预期的字符串，刚继续loads并获取里面的target_lang键对应的值，如果都不成功，则直接返回GPT的答案
+        result是字符串时用增量解析器一次扫描取出, 续写拼接或被截断导致json不完整时也能取到
+        批量翻译时result是数组, 也兼容GPT直接返回一个json数组的情况
         :param translation: GPT返回的答案
-        :return: 翻译结果
+        :return: 翻译结果, 批量翻译时为列表
         """
-        json_string = utils.json_regex(translation)
-        result = json.loads(json_string).get("result")
+        parser = utils.ResultStreamParser()
+        result = parser.feed(translation)
+        if not parser.in_value:
+            json_string = utils.json_regex(translation)
+            if not json_string and (array_string := utils.json_array_regex(translation)):
+                return json.loads(array_string)
+            result = json.loads(json_string).get("result")
+            if isinstance(result, list):
+                return result
+            if isinstance(result, dict):
+                # 多目标语言翻译时result是以语言名为键的对象, GPT用了语言代码或别名作键时也能取到
+                return {get_language_registry().resolve(key) or key: value
+                        for key, value in result.items()}.get(self.target_lang)
         try:
             inner_result = ast.literal_eval(result)
             return inner_result.get(self.target_lang)
         except Exception as e:
             return result
 
-    def construct_init_message(self, reference=None):
+    def construct_init_message(self, reference=None, message=None):
         """
         构造GPT请求的message
-        :param query: 待翻译的文本
         :param reference: 术语库记忆库匹配结果
+        :param message: 要写入的message列表, 默认为新的列表
         :return: GPT请求的message
         """
-        response_format = json.dumps({"result": ""})
-        system_message = {"role": "system",
-                          "content": f"I want you to act as a translator, spell corrector and improver, you are good at translating any languages to and from each other. Now, I give you a {self.source_lang} sentence, please translate this sentence into {self.target_lang}, and answer with the corrected and improved version. I want you to translate with prettier and more elegant high-level {self.target_lang} words and sentences, but make them more professional. You should only respond in JSON format as described below \nResponse Format: \n ```{response_format}``` \nEnsure the response can be parsed by Python json.loads"}
-        self.message.append(system_message)
+        message = [] if message is None else message
+        system_message, query_message = init_prompt(self.source_lang, self.target_lang)
+        message.append(system_message)
         if reference:
             reference_message = {"role": "user",
                              "content": f"Here are some standard terminology-translation references that can be used to improve your translation: ```\n{str(reference)}\n```\nPlease translate this sentence into {self.target_lang}: "}
-            self.message.append(reference_message)
+            message.append(reference_message)
         else:
-            query_message = {"role": "user",
-                             "content": f"Please translate this sentence into {self.target_lang}: "}
-            self.message.append(query_message)
+            message.append(query_message)
+        return message
 
-    def add_message(self, content, role="user"):
+    def reset_history(self):
         """
-        添加message
-        :param content: message内容
-        :param role: message角色, 默认为user
+        开始逐块翻译一篇文本, 以初始prompt为前缀新建对话历史
         """
-        self.message.append({"role": role, "content": content})
+        self.history = MessageHistory(self.construct_init_message(), self.ctx)
+        return self.history
+
+    def construct_batch_message(self, count, message=None, placeholders=False):
+        """
+        构造批量翻译的message, 一次翻译多条短文本, 要求按json数组原样顺序返回
+        :param count: 文本条数
+        :param message: 要写入的message列表, 默认为新的列表
+        :param placeholders: 文本里是否有{{n}}占位符
+        :return: GPT请求的message
+        """
+        message = [] if message is None else message
+        instruction = f" {PLACEHOLDER_INSTRUCTION}" if placeholders else ""
+        response_format = json.dumps({"result": ["translation 1", "translation 2"]})
+        system_message = {"role": "system",
+                          "content": f"I want you to act as a translator, spell corrector and improver, you are good at translating any languages to and from each other. Now, I give you a JSON array of {count} {self.source_lang} texts, please translate each text into {self.target_lang} independently, and answer with the corrected and improved versions. I want you to translate with prettier and more elegant high-level {self.target_lang} words and sentences, but make them more professional. You should only respond in JSON format as described below, the result array must contain exactly {count} translations in the same order as the input{instruction} \nResponse Format: \n ```{response_format}``` \nEnsure the response can be parsed by Python json.loads"}
+        message.append(system_message)
+        return message
+
+    def pack_translate(self, texts, source_lang, target_lang):
+        """
+        把多条短文本放进一个prompt一次翻译
+        :param texts: 待翻译的文本列表
+        :param source_lang: 源语言
+        :param target_lang: 目标语言
+        :return: 与texts一一对应的译文列表, 返回条数不对时抛出ValueError
+        """
+        self.use_languages(source_lang, target_lang)
+        message = self.construct_batch_message(len(texts), message=[],
+                                               placeholders=any(PLACEHOLDER.search(text) for text in texts))
+        message.append({"role": "user", "content": f"```{json.dumps(texts, ensure_ascii=False)}```"})
+        translation = utils.gpt_request(message, ctx=self.ctx)
+        result = self.get_translate_result(translation)
+        if not isinstance(result, list) or len(result) != len(texts):
+            raise ValueError(f"expect {len(texts)} translations, got: {result}")
+        return [str(item) for item in result]
+
+    def format_query(self, translate_text, reference=None):
+        """
+        构造待翻译文本的user消息, 有参考时把参考放在文本前面, 文本里有占位符时说明要原样保留
+        :param translate_text: 待翻译文本
+        :param reference: 翻译参考
+        :return: 消息内容
+        """
+        instruction = f"{PLACEHOLDER_INSTRUCTION}\n" if PLACEHOLDER.search(translate_text) else ""
+        if not reference:
+            return f"{instruction}```{translate_text}```"
+        return f"Here are some standard terminology-translation references that can be used to improve your translation: ```\n{str(reference)}\n```\n{instruction}Please translate this sentence into {self.target_lang}: ```{translate_text}```"
 
     def format_should_query(self, should_match, data_type, query_vector):
         """
@@ -144,22 +637,3 @@ class AITranslatorModule:
             }
             should_query.append(script_query)
         return should_query
-
-    def entities_search(self, entities, top_k):
-        """
-        在es中搜索实体信息,不使用向量搜索
-        :param entities: entities,实体列表
-        :param top_k: top_k,返回条数
-        :return: 匹配的实体数据
-        """
-        should = []
-        for item in entities:
-            match = {
-                "multi_match": {
-                    "query": item,
-                    "minimum_should_match": "100%"
-                }
-            }
-            should.append(match)
-        response = self.es.es_search(should)
-        return response
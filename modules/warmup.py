@@ -0,0 +1,115 @@
+"""
+启动预热: fork之前在master进程里加载与进程无关的只读状态(tiktoken编码器、语言注册表、初始prompt和它们的token数),
+worker继承这些内存, 第一个请求不再付这些开销; ES连接池、SQLite连接和后台线程不能跨fork共享, 在每个worker fork之后再创建
+运行: python -m modules.warmup [--bundle-tiktoken DIR]
+"""
+import argparse
+import os
+import threading
+import time
+
+from config.config import cfg
+from modules.memory_index import get_memory_index
+from modules.term_index import get_term_index
+from modules.translation_jobs import start_embedded_workers
+from modules.translator import init_prompt
+from utils import utils
+from utils.cache import get_translation_cache
+from utils.languages import get_language_registry
+from utils.message_history import cached_message_tokens
+
+
+def encoding_models():
+    """
+    :return: 计算token时用到的tiktoken模型名
+    """
+    return ["gpt-3.5-turbo", *dict.fromkeys(utils.MESSAGE_TOKEN_MODELS.values())]
+
+
+def warm_encoders():
+    for model in encoding_models():
+        utils.get_encoding(model).encode("warm up")
+
+
+def warm_prompts():
+    """
+    构造cfg.WARMUP_LANGUAGE_PAIRS的初始prompt, 并按每个engine计算一次token数
+    """
+    for source_lang, target_lang in cfg.WARMUP_LANGUAGE_PAIRS:
+        for item in init_prompt(source_lang, target_lang):
+            for engine in cfg.ENGINE_TOKENS_MAPPING:
+                cached_message_tokens(item["role"], item["content"], engine)
+
+
+def warm_text_processing():
+    """
+    走一遍切分和回复解析, 让正则和解析器的首次开销发生在启动时
+    """
+    utils.split_segments("Warm up the segmenter. 预热切分器。" * 4, 4)
+    utils.json_regex('Result: {"result": "warm up"}')
+    utils.json_array_regex('Result: ["warm", "up"]')
+    utils.ResultStreamParser().feed('{"result": "warm up"}')
+
+
+def preload():
+    """
+    fork之前调用, 任何一步失败都直接抛出, 让启动失败而不是等到第一个请求
+    :return: dict, 每一步的耗时(秒)
+    """
+    timings = {}
+    for name, step in [("languages", get_language_registry), ("encoders", warm_encoders),
+                       ("prompts", warm_prompts), ("text_processing", warm_text_processing)]:
+        start = time.perf_counter()
+        step()
+        timings[name] = round(time.perf_counter() - start, 4)
+    return timings
+
+
+def worker_init(job_workers=True):
+    """
+    fork之后在每个worker进程里调用: 创建进程自己的ES客户端和翻译缓存, 启动翻译任务的worker线程,
+    需要搜索术语时在后台加载术语索引和记忆库向量索引
+    :param job_workers: 是否启动翻译任务的worker线程, 只有Flask应用需要
+    """
+    utils.get_es_client()
+    get_translation_cache()
+    if job_workers:
+        start_embedded_workers()
+    if cfg.IS_SEARCH_TERM_DATA:
+        threading.Thread(target=load_indexes, daemon=True).start()
+
+
+def load_indexes():
+    try:
+        get_term_index().maybe_sync()
+        if cfg.VECTOR_INDEX_TYPE != "es":
+            get_memory_index().maybe_sync()
+    except Exception as err:
+        print(f"preload indexes went wrong! detail: {err}")
+
+
+def bundle_tiktoken(cache_dir):
+    """
+    下载计算token用到的BPE文件到cache_dir, 部署时把这个目录放到cfg.TIKTOKEN_CACHE_DIR, 离线也能加载编码器
+    :param cache_dir: 目录
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    cfg.TIKTOKEN_CACHE_DIR = cache_dir
+    for model in encoding_models():
+        utils.get_encoding(model)
+    return sorted(os.listdir(cache_dir))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="预热翻译服务, 或下载tiktoken的BPE文件用于离线部署")
+    parser.add_argument("--bundle-tiktoken", metavar="DIR", help="把BPE文件下载到这个目录")
+    args = parser.parse_args()
+    if args.bundle_tiktoken:
+        files = bundle_tiktoken(args.bundle_tiktoken)
+        print(f"tiktoken cache bundled into {args.bundle_tiktoken}: {files}")
+        return
+    print(f"warm up finished: {preload()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""
+异步服务(asgi.py)使用的长连接客户端: GPT和embedding请求共用一个aiohttp连接池, ES使用AsyncElasticsearch
+客户端在服务启动时创建、关闭时释放, 不随请求新建, 一个worker可以同时挂起几百个翻译请求
+"""
+import threading
+
+import aiohttp
+import openai
+from elasticsearch7 import AsyncElasticsearch
+
+from config.config import cfg, TranslationContext
+from utils import metrics, utils
+from utils.embedding_service import get_embedding_service
+from utils.engine_router import get_engine_router
+from utils.rate_limiter import get_llm_scheduler
+
+
+class AsyncClients:
+    def __init__(self, es_client=None):
+        """
+        :param es_client: 可传入已有的异步ES客户端, 默认第一次使用时按cfg新建
+        """
+        self.session = None
+        self._es = es_client
+
+    @property
+    def es(self):
+        if self._es is None:
+            self._es = AsyncElasticsearch(cfg.ELASTIC_SERVER, http_auth=(cfg.ELASTIC_USERNAME, cfg.ELASTIC_PASSWORD),
+                                          maxsize=cfg.ASYNC_ES_MAXSIZE)
+        return self._es
+
+    async def start(self):
+        """
+        创建共享的HTTP连接池, 需要在事件循环里调用
+        """
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=cfg.ASYNC_HTTP_POOL_SIZE)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self
+
+    async def close(self):
+        """
+        关闭连接池和ES客户端
+        """
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        if self._es is not None and hasattr(self._es, "close"):
+            await self._es.close()
+            self._es = None
+
+    def elastic(self, index):
+        """
+        :param index: 索引名
+        :return: 使用共享ES客户端的AsyncElastic
+        """
+        return AsyncElastic(index, self.es)
+
+    async def _openai_call(self, resource, engine, tokens, priority="interactive", **kwargs):
+        """
+        经过GPT调度器排队后发出openai库的异步请求, 使用共享连接池
+        :param resource: openai.ChatCompletion/openai.Embedding
+        :param engine: 用于限流的模型名
+        :param tokens: 预估的token数
+        :param priority: interactive或batch
+        """
+        await self.start()
+        return await get_llm_scheduler().acall(lambda: self._openai_request(resource, **kwargs), engine, tokens,
+                                               priority)
+
+    async def _openai_request(self, resource, **kwargs):
+        """
+        用共享连接池发出openai库的异步请求, aiosession是ContextVar, 只对当前task生效
+        """
+        token = openai.aiosession.set(self.session)
+        try:
+            return await resource.acreate(request_timeout=cfg.ASYNC_REQUEST_TIMEOUT, **kwargs)
+        finally:
+            openai.aiosession.reset(token)
+
+    async def chat_completion(self, message, ctx=None, max_tokens=None, **kwargs):
+        """
+        异步调用ChatCompletion, 参数和后端路由与utils.chat_completion一致
+        :param message: list, 输入message
+        :param ctx: TranslationContext, 本次请求的上下文, 默认按cfg创建
+        :param max_tokens: 回复的max_tokens, 默认按输入的token数计算
+        :param kwargs: 其他ChatCompletion参数
+        :return: ChatCompletion的返回
+        """
+        ctx = ctx or TranslationContext.create()
+        prompt_tokens, budget = utils.output_budget(message, ctx)
+        max_tokens = max_tokens or budget
+        await self.start()
+        return await get_engine_router().acall(
+            lambda backend: self._openai_request(
+                openai.ChatCompletion,
+                **backend.request_params(),
+                messages=message,
+                temperature=0.5,
+                max_tokens=max_tokens,
+                frequency_penalty=0.0,
+                presence_penalty=0.0,
+                **kwargs
+            ),
+            ctx.engine, prompt_tokens + max_tokens, ctx.priority, stream=bool(kwargs.get("stream"))
+        )
+
+    async def gpt_request(self, message, ctx=None):
+        """
+        异步gpt请求, 续写方式与utils.gpt_request一致, 不修改传入的message
+        :param message: list, 输入message
+        :param ctx: TranslationContext, 本次请求的上下文
+        :return: str, 回复文本
+        """
+        contents = []
+        max_tokens = None
+        for _ in range(cfg.MAX_CONTINUATIONS + 1):
+            response = await self.chat_completion(message, ctx, max_tokens=max_tokens)
+            choice = response['choices'][0]
+            contents.append(choice.get("message").get("content"))
+            if choice.get("finish_reason") != "length":
+                break
+            message, max_tokens = utils.continue_message(message, contents[-1], ctx)
+        return "".join(contents)
+
+    async def embedding(self, sentence):
+        """
+        异步获取文本的embedding, 经过embedding服务的缓存、去重和分批
+        :param sentence: str/list, 输入文本
+        :return: embedding列表
+        """
+        return await get_embedding_service().aembed(sentence, self.embed_batch)
+
+    async def embed_batch(self, texts):
+        """
+        一次请求获取一批文本的embedding
+        :param texts: 文本列表
+        :return: embedding列表
+        """
+        tokens = sum(utils.token_usage_batch(texts))
+        response = await self._openai_call(openai.Embedding, cfg.EMBEDDING_MODEL, tokens,
+                                           input=texts, engine=cfg.EMBEDDING_MODEL)
+        return [dict(item).get('embedding') for item in response['data']]
+
+
+class AsyncElastic:
+    def __init__(self, index, client):
+        """
+        utils.Elastic的异步版本
+        :param index: 索引名
+        :param client: 异步ES客户端
+        """
+        self.es = client
+        self.index_name = index
+
+    @metrics.timed("es_search")
+    async def es_search(self, should_query, top_k=3):
+        if not should_query:
+            return []
+        response = await self.es.search(
+            index=self.index_name,
+            query={
+                "bool": {
+                    "should": should_query,
+                    "minimum_should_match": 1
+                }
+            },
+            size=top_k
+        )
+        return [item["_source"] for item in response["hits"]["hits"]]
+
+    @metrics.timed("es_mget")
+    async def mget_sources(self, ids):
+        """
+        按id批量精确查询, 一次请求取回所有文档, 不返回向量字段
+        :param ids: list, 文档id列表
+        :return: 与ids一一对应的_source列表, 不存在的为None
+        """
+        if not ids:
+            return []
+        response = await self.es.mget(index=self.index_name, body={"ids": ids}, _source_excludes=["source_vector"])
+        return [item.get("_source") if item.get("found") else None for item in response["docs"]]
+
+
+_async_clients = None
+_async_clients_lock = threading.Lock()
+
+
+def get_async_clients():
+    """
+    获取进程内共享的异步客户端
+    """
+    global _async_clients
+    if _async_clients is None:
+        with _async_clients_lock:
+            if _async_clients is None:
+                _async_clients = AsyncClients()
+    return _async_clients
@@ -0,0 +1,174 @@
+"""
+翻译结果缓存: 进程内LRU层 + 可选的SQLite磁盘层
+"""
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from config.config import cfg
+from utils import metrics, utils
+
+
+class TranslationCache:
+    def __init__(self, max_size=None, ttl=None, db_path=None):
+        """
+        :param max_size: 内存层最多缓存的条数, 默认cfg.CACHE_MAX_SIZE
+        :param ttl: 缓存有效期(秒), 默认cfg.CACHE_TTL, 0表示永不过期
+        :param db_path: SQLite文件路径, 默认cfg.CACHE_DB_PATH, 为空则不启用磁盘层
+        """
+        self.max_size = cfg.CACHE_MAX_SIZE if max_size is None else max_size
+        self.ttl = cfg.CACHE_TTL if ttl is None else ttl
+        self.db_path = cfg.CACHE_DB_PATH if db_path is None else db_path
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "expirations": 0,
+                         "sets": 0}
+        self.db = None
+        if self.db_path:
+            self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS translation_cache "
+                            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expire_at REAL NOT NULL)")
+            self.db.commit()
+
+    @staticmethod
+    def make_key(text, source_lang, target_lang, engine):
+        """
+        生成缓存键, 文本做NFC规范化并去掉首尾空白
+        :param text: 待翻译文本
+        :param source_lang: 源语言
+        :param target_lang: 目标语言
+        :param engine: 模型名
+        :return: md5缓存键
+        """
+        normalized = unicodedata.normalize("NFC", text).strip()
+        return utils.md5_hash(f"{cfg.PROMPT_VERSION}\x1f{engine}\x1f{source_lang}\x1f{target_lang}\x1f{normalized}")
+
+    @metrics.timed("cache_lookup")
+    def get(self, key):
+        """
+        读取缓存, 先查内存层再查磁盘层, 磁盘层命中后回填内存层
+        :param key: 缓存键
+        :return: 缓存的翻译结果, 未命中返回None
+        """
+        now = time.time()
+        with self.lock:
+            item = self.memory.get(key)
+            if item is not None:
+                value, expire_at = item
+                if expire_at and expire_at <= now:
+                    del self.memory[key]
+                    self.counters["expirations"] += 1
+                else:
+                    self.memory.move_to_end(key)
+                    self.counters["hits"] += 1
+                    self.counters["memory_hits"] += 1
+                    return value
+            if self.db is not None:
+                row = self.db.execute("SELECT value, expire_at FROM translation_cache WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    value, expire_at = row
+                    if expire_at and expire_at <= now:
+                        self.db.execute("DELETE FROM translation_cache WHERE key = ?", (key,))
+                        self.db.commit()
+                        self.counters["expirations"] += 1
+                    else:
+                        self._set_memory(key, value, expire_at)
+                        self.counters["hits"] += 1
+                        self.counters["disk_hits"] += 1
+                        return value
+            self.counters["misses"] += 1
+            return None
+
+    def set(self, key, value):
+        """
+        写入缓存
+        :param key: 缓存键
+        :param value: 翻译结果
+        """
+        expire_at = time.time() + self.ttl if self.ttl else 0
+        with self.lock:
+            self._set_memory(key, value, expire_at)
+            self.counters["sets"] += 1
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO translation_cache (key, value, expire_at) VALUES (?, ?, ?)",
+                                (key, value, expire_at))
+                self.db.commit()
+
+    def _set_memory(self, key, value, expire_at):
+        self.memory[key] = (value, expire_at)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def delete(self, key):
+        """
+        删除一条缓存, 内存层和磁盘层都删
+        :param key: 缓存键
+        """
+        with self.lock:
+            self.memory.pop(key, None)
+            if self.db is not None:
+                self.db.execute("DELETE FROM translation_cache WHERE key = ?", (key,))
+                self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            if self.db is not None:
+                self.db.execute("DELETE FROM translation_cache")
+                self.db.commit()
+
+    def stats(self):
+        """
+        :return: 命中/未命中/淘汰等计数
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            stats["memory_size"] = len(self.memory)
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+class NullCache:
+    """
+    关闭缓存时使用, 接口与TranslationCache一致
+    """
+
+    @staticmethod
+    def make_key(text, source_lang, target_lang, engine):
+        return None
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+_translation_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_translation_cache():
+    """
+    获取进程内共享的翻译缓存
+    """
+    global _translation_cache
+    if _translation_cache is None:
+        with _cache_lock:
+            if _translation_cache is None:
+                _translation_cache = TranslationCache() if cfg.CACHE_ENABLED else NullCache()
+    return _translation_cache
@@ -0,0 +1,258 @@
+"""
+Markdown/HTML文档的格式感知切分: 把文档拆成原样保留的骨架(代码块、标签、图片、链接地址、标题/列表前缀等)和需要翻译的文本单元,
+文本单元里的行内代码、URL、标签等用{{n}}占位符代替, 只把文本单元送去翻译, 翻译后按占位符还原, 再拼回原来的文档结构
+"""
+import re
+from collections import namedtuple
+
+# 支持的文档格式, text为普通文本, 不做切分
+DOC_FORMATS = ("text", "markdown", "html", "auto")
+
+# GPT偶尔会在占位符里加空格或换成全角括号
+PLACEHOLDER = re.compile(r"[{｛]{2}\s*(\d+)\s*[}｝]{2}")
+# 至少包含一个字母(包括CJK等文字)的文本才需要翻译
+LETTER = re.compile(r"[^\W\d_]")
+
+URL = r"(?:https?|ftp)://[^\s<>()\[\]{}\"'`]+|www\.[^\s<>()\[\]{}\"'`]+"
+ENTITY = r"&(?:#\d+|#[xX][0-9a-fA-F]+|[A-Za-z][A-Za-z0-9]*);"
+HTML_TAG = r"<!--[\s\S]*?-->|</?[A-Za-z][^<>]*>"
+# 原文里本来就有的{{n}}也要保护起来, 否则还原时会和占位符混淆
+TEMPLATE = r"[{｛]{2}[^{}\n]*[}｝]{2}"
+
+# 链接地址里允许有一层括号, 如维基百科的链接
+LINK_TARGET = r"\((?:[^()\n]|\([^()\n]*\))*\)"
+
+MARKDOWN_INLINE = re.compile("|".join([
+    r"(?P<tick>`+)[\s\S]*?(?P=tick)",
+    rf"!\[[^\]\n]*\](?:{LINK_TARGET}|\[[^\]\n]*\])?",
+    rf"\]{LINK_TARGET}|\]\[[^\]\n]*\]",
+    HTML_TAG, URL, ENTITY, TEMPLATE,
+]))
+HTML_INLINE = re.compile("|".join([URL, ENTITY, TEMPLATE]))
+
+MD_FENCE = re.compile(r"^[ \t]{0,3}(`{3,}|~{3,})")
+MD_RULE = re.compile(r"^[ \t]*(?:[-*_=][ \t]*){3,}$")
+MD_LINK_DEF = re.compile(r"^[ \t]{0,3}\[[^\]]+\]:[ \t]*\S+")
+MD_TABLE_DELIMITER = re.compile(r"^[ \t]*\|?(?:[ \t]*:?-+:?[ \t]*\|)+[ \t]*(?::?-+:?)?[ \t]*$")
+# 标题、引用、列表(含任务列表)的行首标记, 可以嵌套
+MD_PREFIX = re.compile(r"^[ \t]*(?:>[ \t]?|#{1,6}[ \t]+|(?:[-*+]|\d{1,9}[.)])[ \t]+(?:\[[ xX]\][ \t]+)?)+")
+
+# HTML的词法单元: raw为整段原样保留的元素和注释, code为行内代码, tag为其他标签
+HTML_TOKEN = re.compile(r"(?P<raw><(?P<raw_tag>script|style|pre|textarea|svg|math)\b[^>]*>[\s\S]*?</(?P=raw_tag)\s*>"
+                        r"|<!--[\s\S]*?-->|<!\[CDATA\[[\s\S]*?\]\]>|<![^>]*>|<\?[\s\S]*?\?>)"
+                        r"|(?P<code><(?P<code_tag>code|kbd|samp|var)\b[^>]*>[\s\S]*?</(?P=code_tag)\s*>)"
+                        r"|</?(?P<tag>[A-Za-z][\w:-]*)[^<>]*>", re.I)
+# 这些标签的前后是文本单元的边界, 其他标签(a/b/em/span等)在文本单元内部用占位符代替
+HTML_BLOCK_TAGS = {
+    "address", "article", "aside", "blockquote", "body", "br", "caption", "dd", "details", "div", "dl", "dt",
+    "fieldset", "figcaption", "figure", "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6", "head", "header", "hr",
+    "html", "iframe", "li", "link", "main", "meta", "nav", "noscript", "ol", "option", "p", "section", "select",
+    "summary", "table", "tbody", "td", "tfoot", "th", "thead", "title", "tr", "ul", "video", "audio", "canvas",
+}
+
+DETECT_HTML = re.compile(r"<(?:html|body|p|div|span|a|h[1-6]|ul|ol|li|table|tr|td|br|img|strong|em|b|i|pre|code)\b"
+                         r"[^<>]*>", re.I)
+DETECT_MARKDOWN = re.compile(r"^[ \t]{0,3}(?:#{1,6}[ \t]|>|[-*+][ \t]|\d{1,9}[.)][ \t]|`{3}|~{3}|\|)|\*\*[^*\n]+\*\*"
+                             r"|!\[[^\]\n]*\]|\[[^\]\n]+\]\([^)\n]*\)|`[^`\n]+`", re.M)
+
+
+class Unit(namedtuple("Unit", ["text", "placeholders"])):
+    """
+    需要翻译的文本单元, text里的{{n}}对应placeholders[n]的原文
+    """
+
+
+class Document:
+    def __init__(self, parts, doc_format):
+        """
+        :param parts: 按顺序排列的原样保留的字符串和需要翻译的Unit
+        :param doc_format: 文档格式
+        """
+        self.parts = parts
+        self.doc_format = doc_format
+
+    def units(self):
+        """
+        :return: 需要翻译的文本单元列表
+        """
+        return [part for part in self.parts if isinstance(part, Unit)]
+
+    def render(self, translations):
+        """
+        用译文替换文本单元, 拼回原来的文档结构
+        :param translations: 与units()一一对应的译文列表
+        :return: 翻译后的文档
+        """
+        translations = iter(translations)
+        return "".join(restore(next(translations), part.placeholders) if isinstance(part, Unit) else part
+                       for part in self.parts)
+
+
+def placeholders_intact(translated, placeholders):
+    """
+    译文里每个占位符恰好出现一次且顺序与原文相同; 漏掉或打乱时代码和链接会放错位置, 成对的标签也可能错开
+    :param translated: 文本单元的译文
+    :param placeholders: 占位符对应的原文列表
+    :return: bool
+    """
+    return [int(match.group(1)) for match in PLACEHOLDER.finditer(translated)] == list(range(len(placeholders)))
+
+
+def restore(translated, placeholders):
+    """
+    把译文里的占位符还原成原文, 调用前先用placeholders_intact检查译文
+    :param translated: 文本单元的译文
+    :param placeholders: 占位符对应的原文列表
+    :return: 还原后的译文
+    """
+
+    def replace(match):
+        index = int(match.group(1))
+        return placeholders[index] if index < len(placeholders) else match.group(0)
+
+    return PLACEHOLDER.sub(replace, translated)
+
+
+def build_parts(pieces, pattern):
+    """
+    把一段连续的内容构造成文本单元, 首尾的空白和受保护内容放到单元外面原样保留
+    :param pieces: [(内容, 是否受保护)]
+    :param pattern: 在未受保护的内容里需要保护的行内格式
+    :return: 原样保留的字符串和Unit组成的列表
+    """
+    expanded = []
+    for text, protected in pieces:
+        if protected:
+            expanded.append((text, True))
+            continue
+        position = 0
+        for match in pattern.finditer(text):
+            expanded.append((text[position:match.start()], False))
+            expanded.append((match.group(0), True))
+            position = match.end()
+        expanded.append((text[position:], False))
+    expanded = [(text, protected) for text, protected in expanded if text]
+    content = [index for index, (text, protected) in enumerate(expanded) if not protected and text.strip()]
+    if not content or not any(LETTER.search(text) for text, protected in expanded if not protected):
+        return ["".join(text for text, _ in expanded)] if expanded else []
+    first, last = content[0], content[-1]
+    head_text, tail_text = expanded[first][0], expanded[last][0]
+    head = "".join(text for text, _ in expanded[:first]) + head_text[:len(head_text) - len(head_text.lstrip())]
+    tail = tail_text[len(tail_text.rstrip()):] + "".join(text for text, _ in expanded[last + 1:])
+    middle = list(expanded[first:last + 1])
+    if first == last:
+        middle[0] = (head_text.strip(), False)
+    else:
+        middle[0] = (head_text.lstrip(), False)
+        middle[-1] = (tail_text.rstrip(), False)
+    body, placeholders = [], []
+    for text, protected in middle:
+        if protected:
+            body.append(f"{{{{{len(placeholders)}}}}}")
+            placeholders.append(text)
+        else:
+            body.append(text)
+    return [part for part in (head, Unit("".join(body), placeholders), tail) if part]
+
+
+def parse_markdown(text):
+    """
+    按行解析Markdown: 代码块、分隔线、链接定义、表格分隔行原样保留, 标题/引用/列表的行首标记原样保留,
+    连续的正文行作为一个文本单元, 表格的每个单元格是一个文本单元
+    :param text: Markdown文本
+    :return: Document
+    """
+    parts, paragraph, fence = [], [], None
+
+    def flush():
+        if paragraph:
+            parts.extend(build_parts([("".join(paragraph), False)], MARKDOWN_INLINE))
+            paragraph.clear()
+
+    for line in text.splitlines(keepends=True):
+        stripped = line.strip()
+        if fence:
+            parts.append(line)
+            if stripped.startswith(fence) and not stripped.strip(fence[0]):
+                fence = None
+            continue
+        match = MD_FENCE.match(line)
+        if match:
+            flush()
+            fence = match.group(1)
+            parts.append(line)
+            continue
+        if not stripped or MD_RULE.match(line) or MD_LINK_DEF.match(line) or MD_TABLE_DELIMITER.match(line):
+            flush()
+            parts.append(line)
+            continue
+        if stripped.startswith("|"):
+            flush()
+            for cell in re.split(r"(?<!\\)(\|)", line):
+                parts.extend([cell] if cell == "|" else build_parts([(cell, False)], MARKDOWN_INLINE))
+            continue
+        prefix = MD_PREFIX.match(line)
+        if prefix and prefix.group(0):
+            flush()
+            parts.append(prefix.group(0))
+            parts.extend(build_parts([(line[prefix.end():], False)], MARKDOWN_INLINE))
+            continue
+        paragraph.append(line)
+    flush()
+    return Document(parts, "markdown")
+
+
+def parse_html(text):
+    """
+    解析HTML: script/style/pre等元素和注释整段原样保留, 块级标签作为文本单元的边界,
+    文本单元内部的行内标签、code、实体和URL用占位符代替
+    :param text: HTML文本
+    :return: Document
+    """
+    parts, inline = [], []
+
+    def flush():
+        if inline:
+            parts.extend(build_parts(inline, HTML_INLINE))
+            inline.clear()
+
+    position = 0
+    for match in HTML_TOKEN.finditer(text):
+        if match.start() > position:
+            inline.append((text[position:match.start()], False))
+        position = match.end()
+        if match.group("raw") or (match.group("tag") or "").lower() in HTML_BLOCK_TAGS:
+            flush()
+            parts.append(match.group(0))
+        else:
+            inline.append((match.group(0), True))
+    if position < len(text):
+        inline.append((text[position:], False))
+    flush()
+    return Document(parts, "html")
+
+
+def detect_format(text):
+    """
+    :param text: 待翻译的文本
+    :return: html/markdown/text
+    """
+    if DETECT_HTML.search(text):
+        return "html"
+    if DETECT_MARKDOWN.search(text):
+        return "markdown"
+    return "text"
+
+
+def parse_document(text, doc_format="auto"):
+    """
+    :param text: 待翻译的文本
+    :param doc_format: DOC_FORMATS之一, auto时按内容判断
+    :return: Document, 普通文本返回None
+    """
+    doc_format = detect_format(text) if doc_format == "auto" else doc_format
+    if doc_format == "markdown":
+        return parse_markdown(text)
+    if doc_format == "html":
+        return parse_html(text)
+    return None
@@ -0,0 +1,295 @@
+"""
+embedding服务: 按内容hash去重, 向量缓存为float32数组(默认存到磁盘并内存映射读取), 同样的文本只embedding一次,
+未命中的文本按条数和token数切成批次并发请求
+"""
+import asyncio
+import contextlib
+import os
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from config.config import cfg
+from utils import metrics, utils
+
+
+class EmbeddingStore:
+    def __init__(self, dim, path=None, max_size=None):
+        """
+        :param dim: 向量维度
+        :param path: 磁盘缓存目录, 为空时只缓存在内存里;
+                     目录里vectors-<dim>.f32按行存float32向量, keys-<dim>.txt第i行是第i个向量的键, 多个进程可共用同一目录
+        :param max_size: 只缓存在内存里时最多保留的向量条数, 默认cfg.EMBEDDING_MEMORY_MAX_SIZE, 超过时淘汰最久没用过的
+        """
+        self.dim = dim
+        self.path = path
+        self.max_size = max_size or cfg.EMBEDDING_MEMORY_MAX_SIZE
+        # 内存缓存按使用顺序排列, 最久没用过的在前
+        self.rows = {} if path else OrderedDict()
+        self.size = 0
+        self.lock = threading.RLock()
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self.keys_offset = 0
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self.vectors_path = os.path.join(path, f"vectors-{dim}.f32")
+            self.keys_path = os.path.join(path, f"keys-{dim}.txt")
+            for file_path in (self.vectors_path, self.keys_path):
+                open(file_path, "ab").close()
+            with self._file_lock():
+                self._refresh()
+                # 向量先于键写入, 上次写到一半退出时去掉没有键的向量
+                with open(self.vectors_path, "r+b") as vectors_file:
+                    vectors_file.truncate(self.size * self.row_bytes)
+
+    @property
+    def row_bytes(self):
+        return self.dim * 4
+
+    def __len__(self):
+        return self.size
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        """
+        多个进程追加同一组文件时用文件锁互斥
+        """
+        with open(self.keys_path, "rb") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """
+        读入其他进程追加的键, 重新映射向量文件
+        """
+        with open(self.keys_path, "rb") as keys_file:
+            keys_file.seek(self.keys_offset)
+            data = keys_file.read()
+        # 只读完整的行
+        data = data[:data.rfind(b"\n") + 1]
+        for key in data.decode("ascii").splitlines():
+            self.rows.setdefault(key, self.size)
+            self.size += 1
+        self.keys_offset += len(data)
+        if self.size:
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(self.size, self.dim))
+
+    def get_many(self, keys):
+        """
+        :param keys: 键列表
+        :return: dict, 命中的键 -> float32向量
+        """
+        with self.lock:
+            rows = {key: self.rows[key] for key in keys if key in self.rows}
+            if not self.path:
+                for key in rows:
+                    self.rows.move_to_end(key)
+            elif len(rows) < len(keys):
+                with self._file_lock():
+                    self._refresh()
+                rows.update({key: self.rows[key] for key in keys if key in self.rows})
+            return {key: np.array(self.vectors[row]) for key, row in rows.items()}
+
+    def put_many(self, keys, vectors):
+        """
+        写入向量, 已有的键跳过
+        :param keys: 键列表
+        :param vectors: 与keys一一对应的向量
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        with self.lock:
+            if not self.path:
+                self._put_memory(keys, vectors)
+                return
+            with self._file_lock():
+                self._refresh()
+                new = self._new_indexes(keys)
+                if not new:
+                    return
+                with open(self.vectors_path, "ab") as vectors_file:
+                    vectors_file.write(vectors[new].tobytes())
+                with open(self.keys_path, "ab") as keys_file:
+                    keys_file.write("".join(f"{keys[index]}\n" for index in new).encode("ascii"))
+                self._refresh()
+
+    def _new_indexes(self, keys):
+        """
+        :return: 不在缓存里的键的下标, 重复的键只取第一个
+        """
+        seen = set()
+        new = []
+        for index, key in enumerate(keys):
+            if key not in self.rows and key not in seen:
+                seen.add(key)
+                new.append(index)
+        return new
+
+    def _put_memory(self, keys, vectors):
+        """
+        写入内存缓存, 满了以后新向量写到淘汰掉的向量的行
+        """
+        new = self._new_indexes(keys)[-self.max_size:]
+        self._reserve(min(self.size + len(new), self.max_size))
+        for index in new:
+            if self.size < self.max_size:
+                row = self.size
+                self.size += 1
+            else:
+                _, row = self.rows.popitem(last=False)
+            self.vectors[row] = vectors[index]
+            self.rows[keys[index]] = row
+
+    def _reserve(self, capacity):
+        # 内存缓存按倍数扩容, 不超过max_size
+        if capacity <= len(self.vectors):
+            return
+        vectors = np.empty((min(max(capacity, len(self.vectors) * 2, 1024), self.max_size), self.dim),
+                           dtype=np.float32)
+        vectors[:self.size] = self.vectors[:self.size]
+        self.vectors = vectors
+
+
+class EmbeddingService:
+    def __init__(self, backend=None, store=None, model=None):
+        """
+        :param backend: 批量embedding函数, 输入文本列表返回向量列表, 默认utils.embedding(经过GPT调度器请求openai),
+                        离线调试可用utils.stubs.FakeEmbedding
+        :param store: 向量缓存, 默认按cfg.EMBEDDING_CACHE_DIR创建, 没有配置目录时只缓存在内存里
+        :param model: embedding模型名, 是缓存键的一部分
+        """
+        self.backend = backend or utils.embedding
+        self.store = store if store is not None else EmbeddingStore(cfg.VECTOR_DIM, cfg.EMBEDDING_CACHE_DIR or None)
+        self.model = model or cfg.EMBEDDING_MODEL
+        self.lock = threading.Lock()
+        self.counters = {"texts": 0, "hits": 0, "deduplicated": 0, "embedded": 0, "requests": 0}
+
+    def key(self, text):
+        """
+        向量的缓存键, 文本做NFC规范化
+        """
+        return utils.md5_hash(f"{self.model}\x1f{unicodedata.normalize('NFC', text)}")
+
+    def plan(self, texts):
+        """
+        查缓存并去重
+        :param texts: 文本列表
+        :return: (每条文本的键, dict 已有的键 -> 向量, 去重后未命中的[(键, 文本)])
+        """
+        keys = [self.key(text) for text in texts]
+        vectors = self.store.get_many(list(dict.fromkeys(keys)))
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        with self.lock:
+            self.counters["texts"] += len(texts)
+            self.counters["hits"] += sum(key in vectors for key in keys)
+            self.counters["deduplicated"] += sum(key not in vectors for key in keys) - len(missing)
+        return keys, vectors, list(missing.items())
+
+    @staticmethod
+    def batches(items):
+        """
+        按cfg.EMBEDDING_BATCH_SIZE条数和cfg.EMBEDDING_BATCH_TOKENS token数切分批次
+        :param items: [(键, 文本)]
+        :return: 批次列表
+        """
+        batches, batch, batch_tokens = [], [], 0
+        for item, tokens in zip(items, utils.token_usage_batch([text for _, text in items])):
+            if batch and (len(batch) >= cfg.EMBEDDING_BATCH_SIZE or batch_tokens + tokens > cfg.EMBEDDING_BATCH_TOKENS):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(item)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def save(self, batch, result, vectors, cache=True):
+        keys = [key for key, _ in batch]
+        if cache:
+            self.store.put_many(keys, result)
+        vectors.update(zip(keys, np.asarray(result, dtype=np.float32)))
+        with self.lock:
+            self.counters["embedded"] += len(batch)
+            self.counters["requests"] += 1
+
+    @metrics.timed("embedding")
+    def embed(self, sentence, cache=True):
+        """
+        获取文本的embedding, 与utils.embedding的输入输出一致
+        :param sentence: str/list, 输入文本
+        :param cache: 新算的向量是否写入缓存, 批量导入时为False, 只读缓存, 不会把导入的向量都留在缓存里
+        :return: embedding列表
+        """
+        texts = [sentence] if isinstance(sentence, str) else list(sentence or [])
+        if not texts:
+            return []
+        keys, vectors, missing = self.plan(texts)
+        batches = self.batches(missing)
+        if batches:
+            with ThreadPoolExecutor(max_workers=max(1, min(cfg.EMBEDDING_CONCURRENCY, len(batches)))) as executor:
+                results = executor.map(metrics.propagate(lambda batch: self.backend([text for _, text in batch])), batches)
+                for batch, result in zip(batches, results):
+                    self.save(batch, result, vectors, cache)
+        return [vectors[key].tolist() for key in keys]
+
+    @metrics.timed("embedding")
+    async def aembed(self, sentence, backend):
+        """
+        embed的异步版本
+        :param sentence: str/list, 输入文本
+        :param backend: 异步的批量embedding函数
+        :return: embedding列表
+        """
+        texts = [sentence] if isinstance(sentence, str) else list(sentence or [])
+        if not texts:
+            return []
+        keys, vectors, missing = self.plan(texts)
+        batches = self.batches(missing)
+        semaphore = asyncio.Semaphore(max(1, cfg.EMBEDDING_CONCURRENCY))
+
+        async def run(batch):
+            async with semaphore:
+                self.save(batch, await backend([text for _, text in batch]), vectors)
+
+        await asyncio.gather(*[run(batch) for batch in batches])
+        return [vectors[key].tolist() for key in keys]
+
+    def stats(self):
+        """
+        :return: 命中/去重/实际embedding的条数和请求次数
+        """
+        with self.lock:
+            stats = dict(self.counters)
+        stats["cached_vectors"] = len(self.store)
+        return stats
+
+
+_embedding_service = None
+_service_lock = threading.Lock()
+
+
+def get_embedding_service():
+    """
+    获取进程内共享的embedding服务
+    """
+    global _embedding_service
+    if _embedding_service is None:
+        with _service_lock:
+            if _embedding_service is None:
+                _embedding_service = EmbeddingService()
+    return _embedding_service
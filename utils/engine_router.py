@@ -0,0 +1,426 @@
+"""
+GPT后端路由: 同一engine可以配置多个后端(Azure的多个部署/区域、openai、本地兼容openai接口的服务),
+按各后端最近的延迟、错误率和限流排队时间选出预计最快的健康后端, 上下文窗口放不下请求的后端不参与;
+可重试的错误换下一个后端, 最后一个后端按调度器的规则退避重试; 连续失败的后端熔断一段时间;
+请求超过后端延迟的p95还没返回时向下一个后端发出对冲请求, 先返回的结果生效
+"""
+import asyncio
+import collections
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from config.config import cfg
+from utils import metrics
+from utils.rate_limiter import get_llm_scheduler, is_retryable
+
+
+class HedgeCancelled(Exception):
+    """
+    对冲中输掉的请求还没发出时不再发出, 不可重试
+    """
+
+
+class BackendHealth:
+    """
+    后端最近cfg.ENGINE_HEALTH_WINDOW次请求的延迟和成败, 连续失败cfg.ENGINE_FAILURE_THRESHOLD次后熔断cfg.ENGINE_COOLDOWN秒
+    """
+
+    def __init__(self, window=None):
+        window = window or cfg.ENGINE_HEALTH_WINDOW
+        self.latencies = collections.deque(maxlen=window)
+        self.outcomes = collections.deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def success(self, seconds=None):
+        """
+        :param seconds: 请求耗时, 流式请求只拿到响应头的耗时, 不计入延迟统计
+        """
+        with self.lock:
+            self.requests += 1
+            self.outcomes.append(True)
+            if seconds is not None:
+                self.latencies.append(seconds)
+            self.consecutive_failures = 0
+            self.open_until = 0.0
+
+    def failure(self):
+        with self.lock:
+            self.requests += 1
+            self.failures += 1
+            self.outcomes.append(False)
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= cfg.ENGINE_FAILURE_THRESHOLD:
+                self.open_until = time.monotonic() + cfg.ENGINE_COOLDOWN
+
+    def available(self, now=None):
+        """
+        :return: 是否没有熔断
+        """
+        return (now or time.monotonic()) >= self.open_until
+
+    def samples(self):
+        return len(self.latencies)
+
+    def quantile(self, q):
+        """
+        :param q: 分位数, 0~1
+        :return: 最近请求延迟的分位数(秒), 没有数据时为None
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def error_rate(self):
+        with self.lock:
+            return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+
+class Backend:
+    def __init__(self, name, engine, deployment=None, model=None, api_base=None, api_key=None, api_type=None,
+                 api_version=None, max_tokens=None):
+        """
+        :param name: 后端名, 用于限流、指标和统计
+        :param engine: 模型名, 对应cfg.ENGINE_TOKENS_MAPPING
+        :param deployment: Azure的部署名, 与model二选一
+        :param model: openai的模型名, 都不配置时用engine
+        :param api_base: 接口地址, 不配置时用openai的全局配置, 下同
+        :param api_key: 密钥
+        :param api_type: azure/open_ai, 本地兼容openai接口的服务用open_ai
+        :param api_version: Azure的接口版本
+        :param max_tokens: 上下文窗口的token数, 默认按engine取cfg.ENGINE_TOKENS_MAPPING
+        """
+        self.name = name
+        self.engine = engine
+        self.target = {"engine": deployment} if deployment else {"model": model or engine}
+        connection = {"api_base": api_base, "api_key": api_key, "api_type": api_type, "api_version": api_version}
+        self.connection = {key: value for key, value in connection.items() if value is not None}
+        self.max_tokens = max_tokens or cfg.ENGINE_TOKENS_MAPPING.get(engine, 4096)
+        self.health = BackendHealth()
+
+    @classmethod
+    def default(cls, engine):
+        """
+        没有配置后端的engine使用的后端, 与原来的请求方式一致: Azure按engine作部署名, openai固定用gpt-3.5-turbo
+        """
+        if cfg.USE_AZURE_AI:
+            return cls(engine, engine, deployment=engine)
+        return cls(engine, engine, model="gpt-3.5-turbo")
+
+    def request_params(self):
+        """
+        :return: openai请求的engine/model和连接参数
+        """
+        return {**self.target, **self.connection}
+
+
+class EngineRouter:
+    def __init__(self, backends=None):
+        """
+        :param backends: Backend列表, 默认按cfg.LLM_BACKENDS创建, 没有配置后端的engine使用Backend.default
+        """
+        if backends is None:
+            backends = [Backend(**item) for item in cfg.LLM_BACKENDS]
+        self.backends = list(backends)
+        self.defaults = {}
+        self.counts = {"requests": 0, "failovers": 0, "hedges": 0, "hedge_wins": 0, "hedges_skipped": 0}
+        # 还没结束的对冲(两个请求都结束才算结束)
+        self.hedging = 0
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def backends_for(self, engine):
+        """
+        :return: engine和它的cfg.LLM_ENGINE_FALLBACKS的所有后端
+        """
+        engines = [engine] + list(cfg.LLM_ENGINE_FALLBACKS.get(engine, []))
+        backends = [backend for backend in self.backends if backend.engine in engines]
+        if not any(backend.engine == engine for backend in backends):
+            with self.lock:
+                if engine not in self.defaults:
+                    self.defaults[engine] = Backend.default(engine)
+                backends.insert(0, self.defaults[engine])
+        return backends
+
+    def expected_seconds(self, backend, tokens):
+        """
+        预计的耗时: 限流排队时间 + 延迟中位数按错误率折算的期望
+        :return: 秒数, 没有延迟数据时为None
+        """
+        latency = backend.health.quantile(0.5)
+        if latency is None:
+            return None
+        # 后端的配额按后端名配置, 没有时按engine, Azure的配额是按部署计算的
+        wait_seconds = get_llm_scheduler().estimated_wait(backend.name, tokens, backend.engine)
+        return wait_seconds + latency / (1 - min(backend.health.error_rate(), 0.9))
+
+    def candidates(self, engine, tokens):
+        """
+        :param engine: 模型名
+        :param tokens: 预估的token数(prompt + 回复)
+        :return: 按预计耗时排好序的后端列表, 没有延迟数据的按配置的顺序排在后面, 靠随机探索积累数据,
+                 熔断中的排在最后, 都放不下请求时只用窗口最大的后端
+        """
+        backends = self.backends_for(engine)
+        fits = [backend for backend in backends if backend.max_tokens >= tokens]
+        if not fits:
+            fits = [max(backends, key=lambda backend: backend.max_tokens)]
+        now = time.monotonic()
+        expected = {backend.name: self.expected_seconds(backend, tokens) for backend in fits}
+        healthy = sorted((backend for backend in fits if backend.health.available(now)),
+                         key=lambda backend: (expected[backend.name] is None, expected[backend.name] or 0.0))
+        if len(healthy) > 1 and random.random() < cfg.ENGINE_EXPLORE_RATIO:
+            healthy.insert(0, healthy.pop(random.randrange(1, len(healthy))))
+        broken = sorted((backend for backend in fits if not backend.health.available(now)),
+                        key=lambda backend: backend.health.open_until)
+        return healthy + broken
+
+    def hedge_delay(self, backend):
+        """
+        :return: 发出对冲请求前等待的秒数, 不对冲时为None
+        """
+        if not cfg.ENGINE_HEDGE_ENABLED or backend.health.samples() < cfg.ENGINE_HEDGE_MIN_SAMPLES:
+            return None
+        return backend.health.quantile(cfg.ENGINE_HEDGE_QUANTILE)
+
+    def _count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def _allow_hedge(self):
+        with self.lock:
+            if self.counts["hedges"] >= cfg.ENGINE_HEDGE_MAX_RATIO * self.counts["requests"]:
+                return False
+            if self.hedging >= cfg.ENGINE_HEDGE_MAX_CONCURRENT:
+                self.counts["hedges_skipped"] += 1
+                return False
+            self.counts["hedges"] += 1
+            self.hedging += 1
+            return True
+
+    def _hedge_finished(self, futures):
+        """
+        两个请求都结束后释放对冲的名额
+        :param futures: 对冲的两个Future或asyncio.Task
+        """
+        remaining = [len(futures)]
+
+        def done(_):
+            with self.lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    self.hedging -= 1
+
+        for future in futures:
+            future.add_done_callback(done)
+
+    def _executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=cfg.ENGINE_HEDGE_THREADS,
+                                                   thread_name_prefix="engine-hedge")
+            return self.executor
+
+    def _plan(self, engine, tokens, hedge):
+        """
+        :return: [(后端, 对冲用的后端, 重试次数)], 最后一个后端按调度器的默认次数重试, 其他失败一次就换下一个
+        """
+        candidates = self.candidates(engine, tokens)
+        self._count("requests")
+        plan = []
+        for index, backend in enumerate(candidates):
+            last = index == len(candidates) - 1
+            plan.append((backend, None if last or not hedge else candidates[index + 1], None if last else 0))
+        return plan
+
+    def _failover(self, backend, next_backend, err):
+        self._count("failovers")
+        metrics.LLM_ROUTES.inc(backend=next_backend.name, kind="failover")
+        print(f"LLM backend {backend.name} failed, fail over to {next_backend.name}, detail: {err}")
+
+    @staticmethod
+    def _track(backend, request, stream, lost=None):
+        """
+        :param lost: 对冲时的threading.Event, 另一个请求先返回后被设置, 这时还没发出的请求不再发出,
+                     已经发出的请求的结果和延迟都不计入后端的健康数据
+        """
+        if lost is not None and lost.is_set():
+            raise HedgeCancelled(f"hedged request to {backend.name} lost before it was sent")
+        start = time.monotonic()
+        try:
+            response = request(backend)
+        except Exception as err:
+            if is_retryable(err) and not (lost is not None and lost.is_set()):
+                backend.health.failure()
+            raise
+        if lost is None or not lost.is_set():
+            backend.health.success(None if stream else time.monotonic() - start)
+        return response
+
+    @staticmethod
+    async def _atrack(backend, request, stream):
+        start = time.monotonic()
+        try:
+            response = await request(backend)
+        except Exception as err:
+            if is_retryable(err):
+                backend.health.failure()
+            raise
+        backend.health.success(None if stream else time.monotonic() - start)
+        return response
+
+    def _attempt(self, request, backend, tokens, priority, retries, stream, lost=None):
+        # 与expected_seconds一样, 后端名没有单独的配额时按engine的配额限流
+        return get_llm_scheduler().call(lambda: self._track(backend, request, stream, lost), backend.name, tokens,
+                                        priority, retries, backend.engine)
+
+    def _aattempt(self, request, backend, tokens, priority, retries, stream):
+        return get_llm_scheduler().acall(lambda: self._atrack(backend, request, stream), backend.name, tokens,
+                                         priority, retries, backend.engine)
+
+    def _hedged(self, request, backend, spare, tokens, priority, retries):
+        """
+        同步请求不能中途取消: 输掉的请求已经发出时会继续占用线程池的一个线程和已扣的限流配额直到返回,
+        只是结果和延迟不再计入后端的健康数据; 同时进行的对冲数由cfg.ENGINE_HEDGE_MAX_CONCURRENT限制
+        """
+        delay = self.hedge_delay(backend) if spare is not None else None
+        if delay is None:
+            return self._attempt(request, backend, tokens, priority, retries, False)
+        executor = self._executor()
+        first_lost, second_lost = threading.Event(), threading.Event()
+        first = executor.submit(metrics.propagate(self._attempt), request, backend, tokens, priority, retries, False,
+                                first_lost)
+        done, _ = wait([first], timeout=delay)
+        if done or not self._allow_hedge():
+            return first.result()
+        metrics.LLM_ROUTES.inc(backend=spare.name, kind="hedge")
+        second = executor.submit(metrics.propagate(self._attempt), request, spare, tokens, priority, 0, False,
+                                 second_lost)
+        self._hedge_finished([first, second])
+        pending, error = {first, second}, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self._count("hedge_wins")
+                        metrics.LLM_ROUTES.inc(backend=spare.name, kind="hedge_win")
+                    (first_lost if future is second else second_lost).set()
+                    for other in pending:
+                        other.cancel()
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    async def _ahedged(self, request, backend, spare, tokens, priority, retries):
+        delay = self.hedge_delay(backend) if spare is not None else None
+        if delay is None:
+            return await self._aattempt(request, backend, tokens, priority, retries, False)
+        first = asyncio.ensure_future(self._aattempt(request, backend, tokens, priority, retries, False))
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done or not self._allow_hedge():
+            return await first
+        metrics.LLM_ROUTES.inc(backend=spare.name, kind="hedge")
+        second = asyncio.ensure_future(self._aattempt(request, spare, tokens, priority, 0, False))
+        self._hedge_finished([first, second])
+        pending, error = {first, second}, None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self._count("hedge_wins")
+                            metrics.LLM_ROUTES.inc(backend=spare.name, kind="hedge_win")
+                        return task.result()
+                    error = error or task.exception()
+        finally:
+            # 先返回的结果已经生效, 另一个请求不再等待
+            for task in pending:
+                task.cancel()
+        raise error
+
+    def call(self, request, engine, tokens, priority="interactive", stream=False):
+        """
+        按candidates的顺序请求, 可重试的错误换下一个后端
+        :param request: 参数为Backend的请求函数, 返回openai的返回
+        :param engine: 模型名
+        :param tokens: 预估的token数
+        :param priority: interactive或batch
+        :param stream: 是否流式请求, 流式请求不对冲, 开始返回后失败也不再换后端
+        :return: request的返回
+        """
+        plan = self._plan(engine, tokens, not stream)
+        metrics.LLM_ROUTES.inc(backend=plan[0][0].name, kind="primary")
+        for index, (backend, spare, retries) in enumerate(plan):
+            try:
+                if stream:
+                    return self._attempt(request, backend, tokens, priority, retries, True)
+                return self._hedged(request, backend, spare, tokens, priority, retries)
+            except Exception as err:
+                if retries is None or not is_retryable(err):
+                    raise
+                self._failover(backend, plan[index + 1][0], err)
+
+    async def acall(self, request, engine, tokens, priority="interactive", stream=False):
+        """
+        call的异步版本
+        :param request: 参数为Backend、返回awaitable的请求函数
+        """
+        plan = self._plan(engine, tokens, not stream)
+        metrics.LLM_ROUTES.inc(backend=plan[0][0].name, kind="primary")
+        for index, (backend, spare, retries) in enumerate(plan):
+            try:
+                if stream:
+                    return await self._aattempt(request, backend, tokens, priority, retries, True)
+                return await self._ahedged(request, backend, spare, tokens, priority, retries)
+            except Exception as err:
+                if retries is None or not is_retryable(err):
+                    raise
+                self._failover(backend, plan[index + 1][0], err)
+
+    def stats(self):
+        """
+        :return: dict, 路由的请求/换后端/对冲次数, 以及每个后端的延迟分位数、错误率和熔断状态
+        """
+        with self.lock:
+            result = dict(self.counts)
+            backends = self.backends + [backend for backend in self.defaults.values() if backend not in self.backends]
+        now = time.monotonic()
+        result["backends"] = {}
+        for backend in backends:
+            p50, p95 = backend.health.quantile(0.5), backend.health.quantile(0.95)
+            result["backends"][backend.name] = {
+                "engine": backend.engine,
+                "max_tokens": backend.max_tokens,
+                "requests": backend.health.requests,
+                "failures": backend.health.failures,
+                "error_rate": round(backend.health.error_rate(), 4),
+                "p50_seconds": None if p50 is None else round(p50, 4),
+                "p95_seconds": None if p95 is None else round(p95, 4),
+                "circuit_open": not backend.health.available(now),
+            }
+        return result
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_engine_router():
+    """
+    获取进程内共享的GPT后端路由
+    """
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = EngineRouter()
+    return _router
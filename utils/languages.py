@@ -0,0 +1,89 @@
+"""
+语言注册表: 支持的语言从cfg.LANGUAGES_PATH的JSON文件加载, 不再写死在配置里, 加一种语言只需要改文件;
+接口参数可以用语言名、语言代码或别名, 统一解析成语言名, prompt、缓存键和记忆库uid里都用语言名
+"""
+import json
+import threading
+from collections import namedtuple
+
+from config.config import cfg
+
+Language = namedtuple("Language", ["name", "code", "aliases"])
+
+
+class LanguageRegistry:
+    def __init__(self, languages):
+        """
+        :param languages: list, 每项为{"name": 语言名, "code": 语言代码, "aliases": [别名]}
+        """
+        self.languages = [Language(item["name"], item.get("code") or item["name"], tuple(item.get("aliases") or ()))
+                          for item in languages]
+        self.by_name = {language.name: language for language in self.languages}
+        # 小写的语言名、代码、别名 -> 语言名, 语言名优先于其他语言的别名
+        self.lookup = {}
+        for language in self.languages:
+            for key in (language.code, *language.aliases):
+                self.lookup.setdefault(key.lower(), language.name)
+        self.lookup.update({language.name.lower(): language.name for language in self.languages})
+
+    @classmethod
+    def load(cls, path=None):
+        """
+        :param path: 语言列表文件, 默认cfg.LANGUAGES_PATH
+        """
+        with open(path or cfg.LANGUAGES_PATH, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def names(self):
+        """
+        :return: 支持的语言名列表, 按文件里的顺序
+        """
+        return [language.name for language in self.languages]
+
+    def resolve(self, value):
+        """
+        :param value: 语言名、语言代码或别名, 不区分大小写
+        :return: 语言名, 不支持时返回None
+        """
+        if not isinstance(value, str):
+            return None
+        return self.lookup.get(value.strip().lower())
+
+    def require(self, value, field="language"):
+        """
+        解析接口传入的语言, 不支持时抛出AssertionError
+        :param value: 语言名、语言代码或别名
+        :param field: 参数名, 用于错误信息
+        :return: 语言名
+        """
+        name = self.resolve(value)
+        assert name, f"{field} must be one of {self.names()}"
+        return name
+
+    def code(self, value):
+        """
+        :param value: 语言名、语言代码或别名
+        :return: 语言代码, 不在注册表里时原样返回
+        """
+        name = self.resolve(value)
+        return self.by_name[name].code if name else value
+
+    def to_dict(self):
+        return [{"name": language.name, "code": language.code, "aliases": list(language.aliases)}
+                for language in self.languages]
+
+
+_language_registry = None
+_language_registry_lock = threading.Lock()
+
+
+def get_language_registry():
+    """
+    获取进程内共享的语言注册表, 第一次使用时加载
+    """
+    global _language_registry
+    if _language_registry is None:
+        with _language_registry_lock:
+            if _language_registry is None:
+                _language_registry = LanguageRegistry.load()
+    return _language_registry
@@ -0,0 +1,92 @@
+"""
+逐块翻译时的对话历史: 固定的初始prompt前缀只计算一次token, 历史只保存之前文本块的原文和解析后的译文,
+不保存GPT的原始回复, 维护历史的token总数, 超出窗口时从最久远的一轮开始丢弃, 每轮只计数一次
+"""
+import json
+from collections import deque
+from functools import lru_cache
+
+from config.config import cfg, TranslationContext
+from utils import utils
+
+
+@lru_cache(maxsize=1024)
+def cached_message_tokens(role, content, engine):
+    """
+    固定内容消息(初始prompt)的token数, 同样的内容只计算一次
+    """
+    return message_tokens({"role": role, "content": content}, engine)
+
+
+def message_tokens(item, engine):
+    """
+    单条消息的token数, 没有对应消息格式的engine按内容的token数估算
+    """
+    try:
+        return utils.message_token_usage(item, engine)
+    except NotImplementedError:
+        return utils.token_usage(item.get("content", ""))
+
+
+class MessageHistory:
+    def __init__(self, prefix, ctx=None, max_turns=None, max_tokens=None):
+        """
+        :param prefix: 初始prompt的消息列表, 每次请求都原样放在最前面
+        :param ctx: TranslationContext, 按其中的engine计数, max_tokens为上下文窗口
+        :param max_turns: 最多保留的历史轮数, 默认cfg.HISTORY_MAX_TURNS
+        :param max_tokens: 历史最多占用的token数, 默认cfg.HISTORY_MAX_TOKENS
+        """
+        self.ctx = ctx or TranslationContext.create()
+        self.prefix = list(prefix)
+        self.prefix_tokens = sum(cached_message_tokens(item["role"], item["content"], self.ctx.engine)
+                                 for item in self.prefix)
+        self.max_turns = cfg.HISTORY_MAX_TURNS if max_turns is None else max_turns
+        self.max_tokens = cfg.HISTORY_MAX_TOKENS if max_tokens is None else max_tokens
+        # 每轮为(user消息, assistant消息, 两条消息的token数)
+        self.turns = deque()
+        self.tokens = 0
+
+    def __len__(self):
+        return len(self.turns)
+
+    def add(self, source, target):
+        """
+        记入一轮历史, 只保存原文和译文
+        :param source: 原文
+        :param target: 译文, 多目标语言翻译时为目标语言 -> 译文的dict
+        """
+        if not isinstance(target, (str, dict)) or not target:
+            return
+        user = {"role": "user", "content": f"```{source}```"}
+        assistant = {"role": "assistant", "content": json.dumps({"result": target}, ensure_ascii=False)}
+        tokens = message_tokens(user, self.ctx.engine) + message_tokens(assistant, self.ctx.engine)
+        self.turns.append((user, assistant, tokens))
+        self.tokens += tokens
+        self.trim()
+
+    def trim(self, extra=0):
+        """
+        从最久远的一轮开始丢弃, 直到不超过轮数和token上限, 且前缀、历史和extra加起来不超过上下文窗口
+        :param extra: 本次请求除前缀和历史之外还需要的token数(待翻译文本和给回复预留的)
+        """
+        while self.turns and (len(self.turns) > self.max_turns
+                              or (self.max_tokens and self.tokens > self.max_tokens)
+                              or self.prefix_tokens + self.tokens + extra + 3 >= self.ctx.max_tokens):
+            self.tokens -= self.turns.popleft()[2]
+
+    def build(self, content, reserve=0):
+        """
+        构造一次请求的message: 前缀 + 历史 + 待翻译文本
+        :param content: 待翻译文本的user消息内容
+        :param reserve: 给回复预留的token数
+        :return: (message, prompt的token数)
+        """
+        query = {"role": "user", "content": content}
+        query_tokens = message_tokens(query, self.ctx.engine)
+        self.trim(query_tokens + reserve)
+        message = list(self.prefix)
+        for user, assistant, _ in self.turns:
+            message.append(user)
+            message.append(assistant)
+        message.append(query)
+        return message, self.prefix_tokens + self.tokens + query_tokens + 3
@@ -0,0 +1,320 @@
+"""
+进程内的延迟和token指标: 翻译流程各阶段的耗时直方图、GPT请求的排队/网络/生成耗时和每个engine的token计数,
+在/metrics以Prometheus文本格式输出; 请求可以开启计时明细, 在返回里带上本次请求各阶段的耗时和token数
+多进程部署(gunicorn多个worker)时每个进程各自统计, 由Prometheus按实例分别抓取
+"""
+import asyncio
+import bisect
+import contextvars
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+# 各阶段耗时直方图的分桶(秒), 覆盖从切分句子的毫秒级到GPT请求的分钟级
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+                 120.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=""):
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        :param name: 指标名
+        :param documentation: 指标说明
+        :param labelnames: 标签名列表
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=STAGE_BUCKETS):
+        """
+        :param name: 指标名
+        :param documentation: 指标说明
+        :param labelnames: 标签名列表
+        :param buckets: 递增的分桶上界
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # 标签值 -> [各分桶的计数(不累加), 总和, 总数]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=STAGE_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        :return: Prometheus文本格式的全部指标
+        """
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+registry = Registry()
+STAGE_SECONDS = registry.histogram("translator_stage_seconds", "Time spent in each translation pipeline stage",
+                                   ["stage"])
+LLM_SECONDS = registry.histogram("translator_llm_seconds",
+                                 "LLM request time by phase: queue (scheduler wait), request (until response headers), "
+                                 "network (request minus server processing), generation (server processing or "
+                                 "stream consumption)", ["engine", "phase"])
+LLM_TOKENS = registry.counter("translator_llm_tokens_total", "Tokens sent to and received from the LLM",
+                              ["engine", "kind"])
+LLM_REQUESTS = registry.counter("translator_llm_requests_total", "LLM requests by outcome", ["engine", "status"])
+LLM_ROUTES = registry.counter("translator_llm_routes_total",
+                              "LLM requests sent to each backend: primary, failover, hedge, hedge_win (hedge returned first)",
+                              ["backend", "kind"])
+INCREMENTAL_CHUNKS = registry.counter("translator_incremental_chunks_total",
+                                     "Chunks of versioned documents reused from the previous version or translated",
+                                     ["kind"])
+COALESCED = registry.counter("translator_coalesced_total",
+                             "Translations that waited for an identical in-flight translation instead of calling the LLM",
+                             ["level"])
+PLACEHOLDER_REPAIRS = registry.counter("translator_placeholder_repairs_total",
+                                      "Document text units whose translation lost or reordered placeholders: "
+                                      "retried (a retry kept them) or kept_source (left untranslated)", ["outcome"])
+REQUEST_SECONDS = registry.histogram("translator_request_seconds", "End-to-end API request time", ["endpoint"])
+
+_timings = contextvars.ContextVar("translator_request_timings", default=None)
+
+
+class RequestTimings:
+    """
+    一次请求里各阶段的累计耗时和token数, 各阶段可能嵌套(如切分句子时计算token), 耗时不能直接相加
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            item = self.stages.setdefault(stage, [0.0, 0])
+            item[0] += seconds
+            item[1] += 1
+
+    def add_tokens(self, engine, kind, amount):
+        with self.lock:
+            engine_tokens = self.tokens.setdefault(engine, {})
+            engine_tokens[kind] = engine_tokens.get(kind, 0) + amount
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def summary(self):
+        """
+        :return: dict, 总耗时、各阶段的耗时和次数、每个engine的token数
+        """
+        with self.lock:
+            return {
+                "total_seconds": round(self.elapsed(), 4),
+                "stages": {stage: {"seconds": round(seconds, 4), "count": count}
+                           for stage, (seconds, count) in sorted(self.stages.items(), key=lambda item: -item[1][0])},
+                "tokens": {engine: dict(tokens) for engine, tokens in self.tokens.items()},
+            }
+
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = _timings.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+@contextmanager
+def stage_timer(stage):
+    """
+    统计一段代码的耗时
+    :param stage: 阶段名
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def timed(stage):
+    """
+    统计函数耗时的装饰器, 支持普通函数和async函数
+    :param stage: 阶段名
+    """
+
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    observe_stage(stage, time.perf_counter() - start)
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                observe_stage(stage, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def observe_llm(engine, phase, seconds):
+    LLM_SECONDS.observe(seconds, engine=engine, phase=phase)
+    timings = _timings.get()
+    if timings is not None:
+        timings.add(f"llm_{phase}", seconds)
+
+
+def count_tokens(engine, kind, amount):
+    """
+    :param engine: 模型名
+    :param kind: prompt/completion
+    :param amount: token数
+    """
+    if not amount:
+        return
+    LLM_TOKENS.inc(amount, engine=engine, kind=kind)
+    timings = _timings.get()
+    if timings is not None:
+        timings.add_tokens(engine, kind, amount)
+
+
+def record_llm_response(engine, seconds, response):
+    """
+    记录一次GPT请求的耗时和token数, openai返回了服务端处理时间(openai-processing-ms)时拆分出网络和生成耗时
+    :param engine: 模型名
+    :param seconds: 发出请求到拿到返回的耗时, 流式请求为拿到响应头的耗时
+    :param response: openai的返回
+    """
+    LLM_REQUESTS.inc(engine=engine, status="ok")
+    observe_llm(engine, "request", seconds)
+    processing_ms = getattr(response, "response_ms", None)
+    if processing_ms is not None:
+        generation = min(seconds, processing_ms / 1000)
+        observe_llm(engine, "generation", generation)
+        observe_llm(engine, "network", seconds - generation)
+    try:
+        usage = response["usage"]
+    except (KeyError, TypeError):
+        return
+    count_tokens(engine, "prompt", usage.get("prompt_tokens", 0))
+    count_tokens(engine, "completion", usage.get("completion_tokens", 0))
+
+
+def record_llm_error(engine, err):
+    LLM_REQUESTS.inc(engine=engine, status=type(err).__name__)
+
+
+@contextmanager
+def collect_timings(endpoint):
+    """
+    统计一次API请求的耗时, 期间各阶段的耗时和token数记到返回的RequestTimings里
+    :param endpoint: 接口名
+    :return: RequestTimings
+    """
+    timings = RequestTimings()
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+        REQUEST_SECONDS.observe(timings.elapsed(), endpoint=endpoint)
+
+
+def propagate(fn):
+    """
+    线程池里执行的函数也记到当前请求的计时明细里
+    :param fn: 要提交到线程池的函数
+    :return: 包装后的函数
+    """
+    timings = _timings.get()
+    if timings is None:
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _timings.set(timings)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _timings.reset(token)
+
+    return wrapper
+
+
+def render():
+    return registry.render()
@@ -0,0 +1,370 @@
+"""
+GPT调用的统一调度: 按engine做每分钟请求数/token数的令牌桶限流, 交互请求优先于批量请求,
+429/5xx时按Retry-After或带抖动的指数退避重试, 并记录排队深度和等待时间
+"""
+import asyncio
+import heapq
+import itertools
+import random
+import threading
+import time
+
+import openai
+
+from config.config import cfg
+from utils import metrics
+
+# 优先级通道, 数值越小越先获得配额
+PRIORITIES = {"interactive": 0, "batch": 1}
+# 不是队首的异步请求重新检查配额的间隔(秒)
+ASYNC_POLL_INTERVAL = 0.01
+
+
+class TokenBucket:
+    def __init__(self, per_minute, burst_seconds=None):
+        """
+        :param per_minute: 每分钟的额度
+        :param burst_seconds: 桶的容量相当于多少秒的额度, 默认cfg.LLM_RATE_BURST_SECONDS
+        """
+        burst_seconds = cfg.LLM_RATE_BURST_SECONDS if burst_seconds is None else burst_seconds
+        self.rate = float(per_minute) / 60
+        self.capacity = max(1.0, self.rate * min(60, burst_seconds))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """
+        :return: 额度足够amount还需等待的秒数, 超过容量的请求按容量计算
+        """
+        self.refill(now)
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def take(self, amount):
+        self.tokens -= amount
+
+
+class EngineLimiter:
+    def __init__(self, engine, rpm=None, tpm=None):
+        """
+        :param engine: 模型名
+        :param rpm: 每分钟请求数上限, None不限制
+        :param tpm: 每分钟token数上限, None不限制
+        """
+        self.engine = engine
+        self.buckets = {"requests": TokenBucket(rpm) if rpm else None, "tokens": TokenBucket(tpm) if tpm else None}
+        # 收到429后整个engine暂停到这个时间
+        self.blocked_until = 0.0
+        # 等待中的(优先级, 序号)小顶堆, 只有队首可以拿配额
+        self.waiting = []
+        self.stats = {lane: {"queue_depth": 0, "max_queue_depth": 0, "acquired": 0, "wait_seconds": 0.0,
+                             "max_wait_seconds": 0.0} for lane in PRIORITIES}
+        self.stats["throttled"] = 0
+        self.stats["retries"] = 0
+        self.stats["failures"] = 0
+
+    def wait_time(self, tokens, now):
+        waits = [self.blocked_until - now]
+        if self.buckets["requests"]:
+            waits.append(self.buckets["requests"].wait_time(1, now))
+        if self.buckets["tokens"]:
+            waits.append(self.buckets["tokens"].wait_time(tokens, now))
+        return max(0.0, *waits)
+
+    def take(self, tokens):
+        if self.buckets["requests"]:
+            self.buckets["requests"].take(1)
+        if self.buckets["tokens"]:
+            self.buckets["tokens"].take(tokens)
+
+    def settle(self, estimated, actual):
+        """
+        请求结束后按实际用量修正token桶, 多估的退回, 少估的补扣
+        """
+        if self.buckets["tokens"] and actual is not None:
+            bucket = self.buckets["tokens"]
+            bucket.tokens = min(bucket.capacity, bucket.tokens + estimated - actual)
+
+
+class LLMScheduler:
+    def __init__(self, limits=None):
+        """
+        :param limits: dict, engine -> {"rpm": 每分钟请求数, "tpm": 每分钟token数}, 默认cfg.LLM_RATE_LIMITS,
+                       不在其中的engine不限流, 只做重试
+        """
+        self.limits = cfg.LLM_RATE_LIMITS if limits is None else limits
+        self.limiters = {}
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.sequence = itertools.count()
+
+    def limiter(self, engine, fallback=None):
+        """
+        :param engine: 模型名或后端名
+        :param fallback: self.limits里没有engine时, 按这个模型名的配额创建
+        """
+        with self.lock:
+            if engine not in self.limiters:
+                limit = self.limits.get(engine) or self.limits.get(fallback) or {}
+                self.limiters[engine] = EngineLimiter(engine, limit.get("rpm"), limit.get("tpm"))
+            return self.limiters[engine]
+
+    def _enqueue(self, limiter, priority):
+        ticket = (PRIORITIES.get(priority, PRIORITIES["batch"]), next(self.sequence))
+        lane = self._lane(ticket)
+        with self.lock:
+            heapq.heappush(limiter.waiting, ticket)
+            stats = limiter.stats[lane]
+            stats["queue_depth"] += 1
+            stats["max_queue_depth"] = max(stats["max_queue_depth"], stats["queue_depth"])
+        return ticket
+
+    def _try_take(self, limiter, ticket, tokens):
+        """
+        在锁内调用, 轮到ticket且配额足够时扣除配额
+        :return: 0表示已拿到配额, 否则为建议的等待秒数, 不是队首时为None
+        """
+        if limiter.waiting[0] != ticket:
+            return None
+        wait = limiter.wait_time(tokens, time.monotonic())
+        if wait > 0:
+            return wait
+        limiter.take(tokens)
+        heapq.heappop(limiter.waiting)
+        return 0
+
+    def _dequeue(self, limiter, ticket, start, granted):
+        """
+        在锁内调用, 记录等待时间; 没拿到配额就退出(如异常)时把ticket移出队列
+        """
+        lane = self._lane(ticket)
+        if not granted and ticket in limiter.waiting:
+            limiter.waiting.remove(ticket)
+            heapq.heapify(limiter.waiting)
+        waited = time.monotonic() - start
+        stats = limiter.stats[lane]
+        stats["queue_depth"] -= 1
+        if granted:
+            stats["acquired"] += 1
+            stats["wait_seconds"] += waited
+            stats["max_wait_seconds"] = max(stats["max_wait_seconds"], waited)
+        self.cond.notify_all()
+
+    @staticmethod
+    def _lane(ticket):
+        return "interactive" if ticket[0] == PRIORITIES["interactive"] else "batch"
+
+    def acquire(self, engine, tokens, priority="interactive", fallback=None):
+        """
+        阻塞直到engine的请求数和token数配额足够, 同一engine下高优先级通道先获得配额
+        :param engine: 模型名或后端名
+        :param tokens: 预估的token数(prompt + 回复)
+        :param priority: interactive或batch
+        :param fallback: 同limiter
+        :return: 等待的秒数
+        """
+        limiter = self.limiter(engine, fallback)
+        ticket = self._enqueue(limiter, priority)
+        start = time.monotonic()
+        granted = False
+        with self.cond:
+            try:
+                while True:
+                    wait = self._try_take(limiter, ticket, tokens)
+                    if wait == 0:
+                        granted = True
+                        break
+                    self.cond.wait(timeout=wait)
+            finally:
+                self._dequeue(limiter, ticket, start, granted)
+        return time.monotonic() - start
+
+    async def acquire_async(self, engine, tokens, priority="interactive", fallback=None):
+        """
+        acquire的异步版本, 等待时让出事件循环
+        """
+        limiter = self.limiter(engine, fallback)
+        ticket = self._enqueue(limiter, priority)
+        start = time.monotonic()
+        granted = False
+        try:
+            while True:
+                with self.lock:
+                    wait = self._try_take(limiter, ticket, tokens)
+                if wait == 0:
+                    granted = True
+                    break
+                await asyncio.sleep(ASYNC_POLL_INTERVAL if wait is None else wait)
+        finally:
+            with self.lock:
+                self._dequeue(limiter, ticket, start, granted)
+        return time.monotonic() - start
+
+    def estimated_wait(self, engine, tokens, fallback=None):
+        """
+        预估现在请求需要排队的秒数, 不扣配额, 不计入排在前面的请求
+        :param engine: 模型名或后端名
+        :param tokens: 预估的token数
+        :param fallback: 同limiter
+        """
+        limiter = self.limiter(engine, fallback)
+        with self.lock:
+            return limiter.wait_time(tokens, time.monotonic())
+
+    def _on_error(self, limiter, err, attempt, retries=None):
+        """
+        判断是否重试, 需要重试时返回退避秒数, 429会让整个engine暂停, 不再继续撞配额
+        """
+        retries = cfg.LLM_MAX_RETRIES if retries is None else retries
+        with self.lock:
+            if not is_retryable(err) or attempt >= retries:
+                limiter.stats["failures"] += 1
+                return None
+            delay = backoff_delay(attempt, retry_after(err))
+            limiter.stats["retries"] += 1
+            if isinstance(err, openai.error.RateLimitError):
+                limiter.stats["throttled"] += 1
+                limiter.blocked_until = max(limiter.blocked_until, time.monotonic() + delay)
+        print(f"LLM request to {limiter.engine} failed, retry in {delay:.1f}s ({attempt + 1}/{retries}), detail: {err}")
+        return delay
+
+    def _settle(self, limiter, tokens, response):
+        try:
+            actual = response["usage"]["total_tokens"]
+        except (KeyError, TypeError):
+            return
+        with self.lock:
+            limiter.settle(tokens, actual)
+
+    def call(self, fn, engine, tokens, priority="interactive", retries=None, fallback=None):
+        """
+        拿到配额后调用fn, 可重试的错误按退避时间重试
+        :param fn: 无参数的请求函数
+        :param engine: 模型名或后端名
+        :param tokens: 预估的token数
+        :param priority: interactive或batch
+        :param retries: 最大重试次数, 默认cfg.LLM_MAX_RETRIES
+        :param fallback: 同limiter, 后端名没有单独配额时按它的模型名限流
+        :return: fn的返回值
+        """
+        limiter = self.limiter(engine, fallback)
+        for attempt in itertools.count():
+            metrics.observe_llm(engine, "queue", self.acquire(engine, tokens, priority, fallback))
+            start = time.monotonic()
+            try:
+                response = fn()
+            except Exception as err:
+                metrics.record_llm_error(engine, err)
+                delay = self._on_error(limiter, err, attempt, retries)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            metrics.record_llm_response(engine, time.monotonic() - start, response)
+            self._settle(limiter, tokens, response)
+            return response
+
+    async def acall(self, fn, engine, tokens, priority="interactive", retries=None, fallback=None):
+        """
+        call的异步版本
+        :param fn: 无参数、返回awaitable的请求函数
+        """
+        limiter = self.limiter(engine, fallback)
+        for attempt in itertools.count():
+            metrics.observe_llm(engine, "queue", await self.acquire_async(engine, tokens, priority, fallback))
+            start = time.monotonic()
+            try:
+                response = await fn()
+            except Exception as err:
+                metrics.record_llm_error(engine, err)
+                delay = self._on_error(limiter, err, attempt, retries)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            metrics.record_llm_response(engine, time.monotonic() - start, response)
+            self._settle(limiter, tokens, response)
+            return response
+
+    def stats(self):
+        """
+        :return: dict, engine -> 各通道的排队深度、等待时间, 以及限流/重试/失败次数
+        """
+        with self.lock:
+            result = {}
+            for engine, limiter in self.limiters.items():
+                item = {key: dict(value) if isinstance(value, dict) else value for key, value in limiter.stats.items()}
+                for lane in PRIORITIES:
+                    lane_stats = item[lane]
+                    lane_stats["avg_wait_seconds"] = round(
+                        lane_stats["wait_seconds"] / lane_stats["acquired"], 4) if lane_stats["acquired"] else 0.0
+                    lane_stats["wait_seconds"] = round(lane_stats["wait_seconds"], 4)
+                    lane_stats["max_wait_seconds"] = round(lane_stats["max_wait_seconds"], 4)
+                item["available"] = {name: round(bucket.tokens, 1) for name, bucket in limiter.buckets.items() if bucket}
+                result[engine] = item
+            return result
+
+
+def is_retryable(err):
+    """
+    429、5xx、超时和连接错误可以重试, 参数错误等不重试
+    """
+    if isinstance(err, (openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.Timeout,
+                        openai.error.APIConnectionError, openai.error.TryAgain)):
+        return True
+    if isinstance(err, openai.error.OpenAIError):
+        return (err.http_status or 0) >= 500
+    return False
+
+
+def retry_after(err):
+    """
+    从错误的响应头中读取Retry-After(秒)或retry-after-ms
+    :return: 秒数, 没有时为None
+    """
+    headers = getattr(err, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("Retry-After") or headers.get("retry-after"):
+            return float(headers.get("Retry-After") or headers.get("retry-after"))
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def backoff_delay(attempt, after=None, base=None, cap=None):
+    """
+    带抖动的指数退避, 服务端给了Retry-After时至少等这么久
+    :param attempt: 第几次重试, 从0开始
+    :param after: 服务端要求的等待秒数
+    :param base: 初始退避秒数, 默认cfg.LLM_BACKOFF_BASE
+    :param cap: 最大退避秒数, 默认cfg.LLM_BACKOFF_MAX
+    :return: 等待秒数
+    """
+    base = cfg.LLM_BACKOFF_BASE if base is None else base
+    cap = cfg.LLM_BACKOFF_MAX if cap is None else cap
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if after is not None:
+        delay = after + random.uniform(0, base)
+    return delay
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_llm_scheduler():
+    """
+    获取进程内共享的GPT调度器
+    """
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = LLMScheduler()
+    return _scheduler
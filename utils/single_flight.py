@@ -0,0 +1,159 @@
+"""
+相同翻译的并发请求合并: 同一个键(文本、语言对、engine)同时只有一个调用真正执行, 其他调用等它的结果,
+执行失败时等待的调用收到同样的异常; 执行方被取消时(如异步请求的客户端断开), 还有等待方的话由等待方接着执行
+"""
+import asyncio
+import threading
+
+from config.config import cfg
+from utils import metrics
+
+
+class Flight:
+    """
+    一次正在执行的调用
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        # 执行方被KeyboardInterrupt等中断, 没有结果, 等待方要重新执行
+        self.abandoned = False
+
+
+class SingleFlight:
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.counts = {"executed": 0, "joined": 0}
+
+    def _finish(self, key, flight, value=None, error=None, abandoned=False):
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+        flight.value, flight.error, flight.abandoned = value, error, abandoned
+        flight.done.set()
+
+    def run(self, key, fn, level="chunk"):
+        """
+        同一个key的并发调用只执行一次fn, cfg.COALESCE_TRANSLATIONS关闭时直接执行
+        :param key: 合并的键
+        :param fn: 无参数的函数
+        :param level: 指标里的层级, document/chunk
+        :return: (fn的返回值, 是否等待了其他调用的结果)
+        """
+        if not cfg.COALESCE_TRANSLATIONS:
+            return fn(), False
+        while True:
+            with self.lock:
+                flight = self.flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self.flights[key] = Flight()
+                    self.counts["executed"] += 1
+            if leader:
+                try:
+                    value = fn()
+                except Exception as err:
+                    self._finish(key, flight, error=err)
+                    raise
+                except BaseException:
+                    self._finish(key, flight, abandoned=True)
+                    raise
+                self._finish(key, flight, value=value)
+                return value, False
+            flight.done.wait()
+            if flight.abandoned:
+                continue
+            with self.lock:
+                self.counts["joined"] += 1
+            metrics.COALESCED.inc(level=level)
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, True
+
+    def stats(self):
+        """
+        :return: 执行和合并的次数, 正在执行的调用数
+        """
+        with self.lock:
+            return {**self.counts, "in_flight": len(self.flights)}
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight的异步版本, 只在一个事件循环里使用; 调用在共享的task里执行, 每个调用方用shield等待,
+    一个调用方被取消不影响其他调用方, 所有调用方都取消时才取消task
+    """
+
+    def __init__(self):
+        # 键 -> [task, 等待的调用方数]
+        self.flights = {}
+        self.counts = {"executed": 0, "joined": 0}
+
+    def _release(self, key, entry):
+        entry[1] -= 1
+        if entry[1] == 0 and not entry[0].done():
+            if self.flights.get(key) is entry:
+                del self.flights[key]
+            entry[0].cancel()
+
+    async def run(self, key, fn, level="chunk"):
+        """
+        :param key: 合并的键
+        :param fn: 无参数、返回awaitable的函数
+        :param level: 指标里的层级, document/chunk
+        :return: (fn的结果, 是否等待了其他调用的结果)
+        """
+        if not cfg.COALESCE_TRANSLATIONS:
+            return await fn(), False
+        entry = self.flights.get(key)
+        joined = entry is not None
+        if joined:
+            self.counts["joined"] += 1
+            metrics.COALESCED.inc(level=level)
+        else:
+            entry = self.flights[key] = [asyncio.ensure_future(fn()), 0]
+            self.counts["executed"] += 1
+            entry[0].add_done_callback(lambda _: self.flights.pop(key) if self.flights.get(key) is entry else None)
+        entry[1] += 1
+        try:
+            value = await asyncio.shield(entry[0])
+        except asyncio.CancelledError:
+            self._release(key, entry)
+            raise
+        entry[1] -= 1
+        return value, joined
+
+    def stats(self):
+        return {**self.counts, "in_flight": len(self.flights)}
+
+
+_single_flight = None
+_async_single_flight = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight():
+    """
+    获取进程内共享的SingleFlight
+    """
+    global _single_flight
+    if _single_flight is None:
+        with _single_flight_lock:
+            if _single_flight is None:
+                _single_flight = SingleFlight()
+    return _single_flight
+
+
+def get_async_single_flight():
+    """
+    获取进程内共享的AsyncSingleFlight, 只在异步服务的事件循环里使用
+    """
+    global _async_single_flight
+    if _async_single_flight is None:
+        with _single_flight_lock:
+            if _async_single_flight is None:
+                _async_single_flight = AsyncSingleFlight()
+    return _async_single_flight
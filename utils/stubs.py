@@ -0,0 +1,500 @@
+"""
+离线使用的本地替身, 用于基准测试和在没有openai/ES的环境下调试
+"""
+import json
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubLLM:
+    """
+    本地的假GPT, 固定延迟后把```包裹的待翻译文本原样加上前缀返回, 返回格式和真实prompt要求的json一致
+    """
+
+    def __init__(self, latency=0.5, prefix="[译]"):
+        self.latency = latency
+        self.prefix = prefix
+        self.calls = 0
+
+    def __call__(self, message, ctx=None, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        # 待翻译文本是最后一个```包裹的部分, 前面可能还有参考资料
+        return fake_translation(message[-1].get("content", ""), self.prefix)
+
+
+class FakeEmbedding:
+    """
+    本地的假embedding, 把文本的字符三元组哈希到各个维度上再归一化, 结果固定, 相似的文本向量也相近,
+    可作为EmbeddingService的backend
+    """
+
+    def __init__(self, dim=1536, latency=0.0):
+        self.dim = dim
+        self.latency = latency
+        self.calls = 0
+        self.texts = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, texts):
+        with self.lock:
+            self.calls += 1
+            self.texts += len(texts)
+        time.sleep(self.latency)
+        return [self.vector(text) for text in texts]
+
+    def vector(self, text):
+        vector = [0.0] * self.dim
+        padded = f"  {text.lower()}  "
+        for start in range(len(padded) - 2):
+            gram = padded[start:start + 3].encode("utf-8")
+            vector[zlib.crc32(gram) % self.dim] += 1.0
+        norm = sum(value * value for value in vector) ** 0.5 or 1.0
+        return [value / norm for value in vector]
+
+
+class FakeEncoding:
+    """
+    不需要下载BPE文件的近似token编码器: 英文最多8个字母、数字最多3位、其他字符(包括CJK)单个字符算一个token,
+    前面的空白并入token, 实现了本项目用到的tiktoken.Encoding接口, 离线运行基准测试时代替tiktoken
+    """
+    PATTERN = re.compile(r"\s*(?:[A-Za-z]{1,8}|\d{1,3}|[^\sA-Za-z\d])|\s+")
+
+    def __init__(self):
+        self.vocab = {}
+        self.pieces = []
+        self.lock = threading.Lock()
+
+    def _token(self, piece):
+        token = self.vocab.get(piece)
+        if token is None:
+            with self.lock:
+                token = self.vocab.setdefault(piece, len(self.pieces))
+                if token == len(self.pieces):
+                    self.pieces.append(piece)
+        return token
+
+    def encode(self, text, **kwargs):
+        return [self._token(match.group(0)) for match in self.PATTERN.finditer(text)]
+
+    def encode_batch(self, texts, **kwargs):
+        return [self.encode(text) for text in texts]
+
+    def decode(self, tokens, **kwargs):
+        return "".join(self.pieces[token] for token in tokens)
+
+    def decode_single_token_bytes(self, token):
+        return self.pieces[token].encode("utf-8")
+
+
+class _JSONSerializer:
+    @staticmethod
+    def dumps(data):
+        if isinstance(data, str):
+            return data
+        return json.dumps(data, ensure_ascii=False)
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+
+def _field_matches(value, expected):
+    if isinstance(value, str) and isinstance(expected, str):
+        return expected.lower() in value.lower()
+    return value == expected
+
+
+def _cosine(left, right):
+    dot = sum(a * b for a, b in zip(left, right))
+    norm = (sum(a * a for a in left) ** 0.5) * (sum(b * b for b in right) ** 0.5)
+    return dot / norm if norm else 0.0
+
+
+def _score(query, source):
+    """
+    在单个文档上计算一个简化的ES查询, 不匹配返回None, 支持match_all/term/terms/match/multi_match/bool/script_score
+    """
+    if not query or "match_all" in query:
+        return 1.0
+    if "term" in query:
+        field, expected = next(iter(query["term"].items()))
+        expected = expected.get("value") if isinstance(expected, dict) else expected
+        return 1.0 if source.get(field) == expected else None
+    if "terms" in query:
+        field, expected = next(iter(query["terms"].items()))
+        return 1.0 if source.get(field) in expected else None
+    if "match" in query:
+        field, expected = next(iter(query["match"].items()))
+        expected = expected.get("query") if isinstance(expected, dict) else expected
+        return 1.0 if _field_matches(source.get(field), expected) else None
+    if "multi_match" in query:
+        expected = query["multi_match"]["query"]
+        fields = query["multi_match"].get("fields") or list(source)
+        return 1.0 if any(_field_matches(source.get(field), expected) for field in fields) else None
+    if "bool" in query:
+        bool_query = query["bool"]
+        score = 0.0
+        for clause in bool_query.get("must", []) + bool_query.get("filter", []):
+            clause_score = _score(clause, source)
+            if clause_score is None:
+                return None
+            score += clause_score
+        should = [_score(clause, source) for clause in bool_query.get("should", [])]
+        matched = [item for item in should if item is not None]
+        minimum = bool_query.get("minimum_should_match", 0 if bool_query.get("must") or bool_query.get("filter") else 1)
+        if should and len(matched) < int(minimum):
+            return None
+        return score + sum(matched) or 1.0
+    if "script_score" in query:
+        if _score(query["script_score"].get("query"), source) is None:
+            return None
+        params = query["script_score"]["script"].get("params", {})
+        return _cosine(params.get("query_vector", []), source.get("source_vector") or []) + 1.0
+    return None
+
+
+class FakeElasticsearch:
+    """
+    内存版的ES客户端替身, 实现了本项目用到的index/get/mget/search/bulk接口,
+    bulk兼容elasticsearch7.helpers的序列化方式, 可直接传给utils.Elastic(client=...)
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.indices_data = {}
+        self.scrolls = {}
+        self.transport = type("FakeTransport", (), {"serializer": _JSONSerializer()})()
+
+    def _docs(self, index):
+        return self.indices_data.setdefault(index, {})
+
+    def index(self, index, document=None, id=None, body=None, **kwargs):
+        self._docs(index)[id] = dict(document if document is not None else body)
+        return {"_index": index, "_id": id, "result": "created"}
+
+    def get(self, index, id, **kwargs):
+        source = self._docs(index).get(id)
+        return {"_index": index, "_id": id, "found": source is not None, "_source": source}
+
+    def mget(self, index=None, body=None, _source_excludes=None, **kwargs):
+        docs = []
+        for doc_id in body.get("ids", []):
+            source = self._docs(index).get(doc_id)
+            if source is None:
+                docs.append({"_index": index, "_id": doc_id, "found": False})
+                continue
+            source = {key: value for key, value in source.items() if key not in (_source_excludes or [])}
+            docs.append({"_index": index, "_id": doc_id, "found": True, "_source": source})
+        return {"docs": docs}
+
+    def search(self, index=None, query=None, size=10, body=None, scroll=None, from_=0, **kwargs):
+        query = query if query is not None else (body or {}).get("query", {"match_all": {}})
+        size = (body or {}).get("size", size)
+        hits = []
+        for doc_id, source in self._docs(index).items():
+            score = _score(query, source)
+            if score is not None:
+                hits.append({"_index": index, "_id": doc_id, "_score": score, "_source": source})
+        hits.sort(key=lambda hit: -hit["_score"])
+        response = {"_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+                    "hits": {"total": {"value": len(hits)}, "hits": hits[from_:from_ + size]}}
+        if scroll:
+            scroll_id = str(len(self.scrolls))
+            self.scrolls[scroll_id] = (hits, from_ + size, size)
+            response["_scroll_id"] = scroll_id
+        return response
+
+    def scroll(self, body=None, scroll_id=None, **kwargs):
+        scroll_id = scroll_id or (body or {}).get("scroll_id")
+        hits, offset, size = self.scrolls[scroll_id]
+        self.scrolls[scroll_id] = (hits, offset + size, size)
+        return {"_scroll_id": scroll_id, "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+                "hits": {"total": {"value": len(hits)}, "hits": hits[offset:offset + size]}}
+
+    def clear_scroll(self, body=None, scroll_id=None, **kwargs):
+        self.scrolls.pop(scroll_id or (body or {}).get("scroll_id"), None)
+        return {"succeeded": True}
+
+    def count(self, index=None, **kwargs):
+        return {"count": len(self._docs(index))}
+
+    def bulk(self, body=None, index=None, **kwargs):
+        lines = body.splitlines() if isinstance(body, str) else list(body)
+        lines = [json.loads(line) if isinstance(line, str) else line for line in lines if line]
+        items = []
+        position = 0
+        while position < len(lines):
+            op_type, meta = next(iter(lines[position].items()))
+            position += 1
+            doc_index = meta.get("_index", index)
+            docs = self._docs(doc_index)
+            if op_type == "delete":
+                docs.pop(meta.get("_id"), None)
+            else:
+                source = lines[position]
+                position += 1
+                if op_type == "update":
+                    docs.setdefault(meta.get("_id"), {}).update(source.get("doc", {}))
+                else:
+                    docs[meta.get("_id")] = source
+            items.append({op_type: {"_index": doc_index, "_id": meta.get("_id"), "status": 201}})
+        return {"took": 0, "errors": False, "items": items}
+
+
+def fake_translation(content, prefix="[译]", languages=None):
+    """
+    假翻译: 取消息里最后一个```包裹的文本加上前缀, 按prompt要求的json格式返回
+    :param languages: 多目标语言翻译时的目标语言列表, 按语言返回加了语言名前缀的译文
+    """
+    blocks = re.findall(r"```(.*?)```", content, re.S)
+    text = blocks[-1] if blocks else content
+    if languages:
+        return json.dumps({"result": {language: f"[{language}]{text}" for language in languages}}, ensure_ascii=False)
+    # 批量翻译时待翻译的是json数组, 逐条加前缀返回数组
+    if text.startswith("["):
+        try:
+            return json.dumps({"result": [f"{prefix}{item}" for item in json.loads(text)]}, ensure_ascii=False)
+        except ValueError:
+            pass
+    return json.dumps({"result": f"{prefix}{text}"}, ensure_ascii=False)
+
+
+class _ThreadingHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # 默认的监听队列只有5, 压测时几百个并发连接会被拒绝
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # 客户端取消请求(如对冲请求的另一方先返回)时连接已关闭, 不打印异常
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+class FakeOpenAIServer:
+    """
+    本地的OpenAI兼容接口假服务器, 支持普通和stream=True的chat completions以及embeddings,
+    路径兼容openai(/v1/chat/completions, /engines/<engine>/chat/completions)和Azure(/openai/deployments/<engine>/chat/completions)
+    截断和报错按请求内容的哈希决定, 与并发顺序无关, 同样的请求每次运行结果相同
+    """
+
+    def __init__(self, latency=0.0, stream_chunk_size=4, stream_interval=0.0, prefix="[译]", truncate_rate=0.0,
+                 error_rate=0.0, token_latency=0.0, slow_rate=0.0, slow_latency=0.0):
+        """
+        :param latency: 每个请求返回第一个字节前的延迟(秒)
+        :param stream_chunk_size: 流式返回时每个增量的字符数
+        :param stream_interval: 流式返回时增量之间的间隔(秒)
+        :param prefix: 假翻译的前缀
+        :param truncate_rate: 回复被截断(finish_reason为length)的请求比例
+        :param error_rate: 第一次请求返回429/500的比例, 重试同样的请求会成功
+        :param token_latency: 非流式回复每个token(按4个字符估算)额外的生成延迟(秒)
+        :param slow_rate: 随机变慢的请求比例, 模拟部署的长尾延迟, 每次请求单独抽样, 重试或对冲可能不再变慢
+        :param slow_latency: 变慢的请求额外的延迟(秒)
+        """
+        self.latency = latency
+        self.stream_chunk_size = stream_chunk_size
+        self.stream_interval = stream_interval
+        self.prefix = prefix
+        self.truncate_rate = truncate_rate
+        self.error_rate = error_rate
+        self.token_latency = token_latency
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        # 设为True时所有请求返回503, 模拟部署故障
+        self.down = False
+        self.random = random.Random(0)
+        self.embedding = FakeEmbedding()
+        self.calls = 0
+        self.counters = {"truncated": 0, "errors": 0, "embeddings": 0, "slow": 0}
+        # 请求内容的哈希 -> 收到的次数, 用于只让第一次请求报错
+        self.attempts = {}
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.server = _ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def configure_openai(self):
+        """
+        让openai库的请求都发到这个假服务器
+        """
+        import openai
+        openai.api_type = "open_ai"
+        openai.api_base = f"{self.url}/v1"
+        openai.api_key = "fake-key"
+        openai.api_version = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def reply(self, body):
+        """
+        根据请求体生成回复内容, 子类可以覆盖
+        """
+        messages = body.get("messages") or [{"content": ""}]
+        return fake_translation(messages[-1].get("content", ""), self.prefix, self.response_languages(messages))
+
+    @staticmethod
+    def response_languages(messages):
+        """
+        :return: system消息要求的回复格式是以语言为键的对象时返回这些语言, 否则返回None
+        """
+        match = re.search(r"Response Format: \n ```(.*?)```", str(messages[0].get("content", "")), re.S)
+        try:
+            result = json.loads(match.group(1)).get("result") if match else None
+        except ValueError:
+            return None
+        return list(result) if isinstance(result, dict) and result else None
+
+    @staticmethod
+    def digest(body, salt=""):
+        """
+        :return: 请求内容的哈希, 映射到[0, 1)
+        """
+        content = json.dumps([salt, body.get("messages"), body.get("input")], ensure_ascii=False, sort_keys=True)
+        return zlib.crc32(content.encode("utf-8")) / 2 ** 32
+
+    def complete(self, body):
+        """
+        返回(回复内容, finish_reason), 按truncate_rate只返回前一半内容模拟回复被max_tokens截断, 子类可以覆盖
+        """
+        content = self.reply(body)
+        if self.truncate_rate and len(content) > 1 and self.digest(body, "length") < self.truncate_rate:
+            with self.lock:
+                self.counters["truncated"] += 1
+            return content[:len(content) // 2], "length"
+        return content, "stop"
+
+    def reject(self, body):
+        """
+        返回(状态码, 响应头dict, 错误信息)时拒绝这个请求, 按error_rate让部分请求第一次返回429或500, 子类可以覆盖
+        """
+        if not self.error_rate:
+            return None
+        key = self.digest(body)
+        with self.lock:
+            self.attempts[key] = self.attempts.get(key, 0) + 1
+            if self.attempts[key] > 1 or self.digest(body, "error") >= self.error_rate:
+                return None
+            self.counters["errors"] += 1
+        if self.digest(body, "status") < 0.5:
+            return 429, {"Retry-After": 0}, "fake rate limit"
+        return 500, {}, "fake server error"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # 响应头和响应体分两次写, 不关掉Nagle算法时keep-alive连接上每个请求会多等40ms的延迟确认
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                # openai/Azure的engine在路径里, 放进body方便reply使用
+                engine = re.search(r"/(?:engines|deployments)/([^/]+)/", self.path)
+                if engine:
+                    body.setdefault("engine", engine.group(1))
+                with fake.lock:
+                    fake.calls += 1
+                    slow = fake.slow_rate and fake.random.random() < fake.slow_rate
+                    if slow:
+                        fake.counters["slow"] += 1
+                if fake.down:
+                    self.send_json(503, {"error": {"message": "fake service unavailable", "type": "server_error"}})
+                    return
+                time.sleep(fake.latency + (fake.slow_latency if slow else 0.0))
+                rejected = fake.reject(body)
+                if rejected:
+                    status, headers, message = rejected
+                    error_type = "rate_limit_exceeded" if status == 429 else "server_error"
+                    self.send_json(status, {"error": {"message": message, "type": error_type}}, headers)
+                elif self.path.split("?")[0].endswith("/chat/completions"):
+                    self.chat_completions(body)
+                elif self.path.split("?")[0].endswith("/embeddings"):
+                    self.embeddings(body)
+                else:
+                    self.send_json(404, {"error": {"message": f"unknown path {self.path}", "type": "invalid_request_error"}})
+
+            def send_json(self, status, data, headers=None):
+                payload = json.dumps(data, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                for key, value in (headers or {}).items():
+                    self.send_header(key, str(value))
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def chat_completions(self, body):
+                content, finish_reason = fake.complete(body)
+                base = {"id": "chatcmpl-fake", "created": int(time.time()), "model": body.get("model", "fake")}
+                if not body.get("stream"):
+                    # token数按4个字符一个token估算, 不依赖tiktoken
+                    prompt_tokens = sum(len(str(item.get("content", ""))) for item in body.get("messages", [])) // 4
+                    completion_tokens = len(content) // 4
+                    time.sleep(completion_tokens * fake.token_latency)
+                    processing_ms = int((fake.latency + completion_tokens * fake.token_latency) * 1000)
+                    self.send_json(200, {**base, "object": "chat.completion", "choices": [
+                        {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}],
+                                         "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                                   "total_tokens": prompt_tokens + completion_tokens}},
+                                   {"openai-processing-ms": processing_ms})
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                step = fake.stream_chunk_size
+                for start in range(0, len(content), step):
+                    self.send_event({**base, "object": "chat.completion.chunk", "choices": [
+                        {"index": 0, "delta": {"content": content[start:start + step]}, "finish_reason": None}]})
+                    time.sleep(fake.stream_interval)
+                self.send_event({**base, "object": "chat.completion.chunk",
+                                 "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]})
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+                self.close_connection = True
+
+            def embeddings(self, body):
+                texts = body.get("input") or []
+                texts = [texts] if isinstance(texts, str) else texts
+                with fake.lock:
+                    fake.counters["embeddings"] += len(texts)
+                tokens = sum(len(str(text)) for text in texts) // 4
+                self.send_json(200, {"object": "list", "model": body.get("model", "fake"), "data": [
+                    {"object": "embedding", "index": index, "embedding": vector}
+                    for index, vector in enumerate(fake.embedding(texts))],
+                                     "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+            def send_event(self, data):
+                self.wfile.write(f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+
+        return Handler
@@ -1,140 +1,328 @@
 import hashlib
+import json
+import os
 import re
 from regex import regex
 import openai
 import time
+from collections import namedtuple
+from functools import lru_cache
 from elasticsearch7 import Elasticsearch, helpers
 import tiktoken
 
-from config.config import cfg
+from config.config import cfg, TranslationContext
+from utils import metrics
+from utils.engine_router import get_engine_router
+from utils.rate_limiter import get_llm_scheduler, backoff_delay
 
 
-def token_usage(text):
+# 引擎名 -> 计算消息token时使用的tiktoken模型名
+MESSAGE_TOKEN_MODELS = {
+    "gpt35": "gpt-3.5-turbo-0301",
+    "gpt4-8k": "gpt-4-0314",
+    "gpt4-32k": "gpt-4-0314",
+}
+# tiktoken模型名 -> (每条消息的固定token, name字段的额外token)
+MESSAGE_TOKEN_OVERHEAD = {
+    "gpt-3.5-turbo-0301": (4, -1),  # every message follows <|start|>{role/name}\n{content}<|end|>\n, if there's a name, the role is omitted
+    "gpt-4-0314": (3, 1),
+}
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model="gpt-3.5-turbo"):
     """
-    计算token使用量
-    :param text: str, 输入文本
-    :return: token使用量
+    获取模型对应的tiktoken编码器, 每个模型只解析一次; cfg.TIKTOKEN_CACHE_DIR存在时从里面读BPE文件, 离线也能加载
+    :param model: 模型名
+    :return: tiktoken.Encoding
     """
-    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    return len(encoding.encode(text))
+    if os.path.isdir(cfg.TIKTOKEN_CACHE_DIR):
+        os.environ["TIKTOKEN_CACHE_DIR"] = cfg.TIKTOKEN_CACHE_DIR
+    return tiktoken.encoding_for_model(model)
 
 
-def get_entities(sentence):
+@metrics.timed("token_count")
+def token_usage(text, model="gpt-3.5-turbo"):
     """
-    获取实体
-    :param sentence: str, 输入文本
-    :return: 实体列表
+    计算token使用量
+    :param text: str, 输入文本
+    :param model: 模型名
+    :return: token使用量
     """
-    doc = cfg.NLP(sentence)
-    entities = [ent.text for sent in doc.sentences for ent in sent.ents]
-    return list(set([item.lower() for item in entities]))
+    return len(get_encoding(model).encode(text))
 
 
-def get_entities_by_nltk(sentence):
+@metrics.timed("token_count")
+def token_usage_batch(texts, model="gpt-3.5-turbo"):
     """
-    获取实体
-    :param sentence: str, 输入文本,使用nltk简单分,速度更快
-    :return: 实体列表
+    批量计算token使用量, 每段文本只编码一次
+    :param texts: list, 输入文本列表
+    :param model: 模型名
+    :return: 每段文本的token使用量列表
     """
-    doc = cfg.NLTK(sentence)
-    entities = [x for x, tag in doc if tag in ["NN", "NNP"]]
-    return list(set([item.lower() for item in entities]))
+    if not texts:
+        return []
+    return [len(tokens) for tokens in get_encoding(model).encode_batch(list(texts))]
 
 
 def embedding(sentence):
     """
-    获取文本的embedding
+    获取文本的embedding, 一次请求, 不做缓存和分批, 业务代码用embedding_service.get_embedding_service().embed
     :param sentence: str/list, 输入文本
     :return: embedding列表
     """
     if not sentence:
         return []
-    response = openai.Embedding.create(
-        input=sentence,
-        engine="text-embedding-ada-002"
+    tokens = sum(token_usage_batch(sentence if isinstance(sentence, list) else [sentence]))
+    response = get_llm_scheduler().call(
+        lambda: openai.Embedding.create(input=sentence, engine=cfg.EMBEDDING_MODEL),
+        cfg.EMBEDDING_MODEL, tokens
     )
     embeddings = [dict(item).get('embedding') for item in response['data']]
     return embeddings
 
 
+def message_token_usage(message, model="gpt35"):
+    """
+    返回单条消息使用的令牌数(包括每条消息的固定开销)
+    :param message: dict, 单条消息
+    :param model: 引擎名或tiktoken模型名
+    """
+    model = MESSAGE_TOKEN_MODELS.get(model, model)
+    if model not in MESSAGE_TOKEN_OVERHEAD:
+        raise NotImplementedError(f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens.""")
+    tokens_per_message, tokens_per_name = MESSAGE_TOKEN_OVERHEAD[model]
+    encoding = get_encoding(model)
+    num_tokens = tokens_per_message
+    for key, value in message.items():
+        num_tokens += len(encoding.encode(value))
+        if key == "name":
+            num_tokens += tokens_per_name
+    return num_tokens
+
+
 def token_usage_from_messages(messages, model="gpt35"):
     """
     返回消息列表使用的令牌数。
     """
-    mapping = {
-        "gpt35": "gpt-3.5-turbo-0301",
-        "gpt4-8k": "gpt-4-0314",
-        "gpt4-32k": "gpt-4-0314",
-    }
-    encoding = tiktoken.encoding_for_model(mapping.get(model, model))
-    if real_model := mapping.get(model):
-        return token_usage_from_messages(messages, real_model)
-    elif model == "gpt-3.5-turbo-0301":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif model == "gpt-4-0314":
-        tokens_per_message = 3
-        tokens_per_name = 1
-    else:
-        raise NotImplementedError(f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens.""")
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
+    num_tokens = sum(message_token_usage(message, model) for message in messages)
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens
 
 
-def gpt_request(message, translated_result=""):
+def prompt_token_usage(message, ctx=None):
     """
-    gpt3请求
+    计算一次GPT请求的prompt token数, 没有对应消息格式的engine按各条消息内容的token数估算
     :param message: list, 输入message
-    :param translated_result: str, 翻译结果
-    :return: str, 回复文本
+    :param ctx: TranslationContext, 本次请求的上下文
+    :return: prompt的token数
     """
-    if cfg.USE_AZURE_AI:
-        response = openai.ChatCompletion.create(
-            engine=cfg.AZURE_GPT_ENGINE,
-            messages=message,
-            temperature=0.5,  # 值在[0,1]之间，越大表示回复越具有不确定性
-            max_tokens=cfg.MAX_TOKENS,  # 回复最大的字符数
-            frequency_penalty=0.0,  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-            presence_penalty=0.0,  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-        )
-    else:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
+    ctx = ctx or TranslationContext.create()
+    try:
+        return token_usage_from_messages(message, ctx.engine)
+    except NotImplementedError:
+        return sum(token_usage_batch([item.get("content", "") for item in message]))
+
+
+def expected_output_tokens(text_tokens):
+    """
+    按待翻译文本的token数预估回复需要的token数
+    :param text_tokens: 待翻译文本的token数
+    :return: 预估的回复token数, 包括json格式的开销
+    """
+    return int(text_tokens * cfg.OUTPUT_TOKEN_RATIO) + cfg.OUTPUT_TOKEN_OVERHEAD
+
+
+def output_budget(message, ctx=None):
+    """
+    按输入的token数确定回复的max_tokens: 按最后一条消息(待翻译文本)预估, 不超过上下文窗口剩下的token数
+    :param message: list, 输入message
+    :param ctx: TranslationContext, 本次请求的上下文
+    :return: (prompt的token数, max_tokens)
+    """
+    ctx = ctx or TranslationContext.create()
+    if not message:
+        return 0, ctx.max_tokens
+    prompt_tokens = prompt_token_usage(message, ctx)
+    expected = expected_output_tokens(token_usage(message[-1].get("content", "")))
+    return prompt_tokens, max(1, min(ctx.max_tokens - prompt_tokens, expected))
+
+
+def continue_message(message, content, ctx=None):
+    """
+    回复被截断时构造请求继续输出的message, 在副本上修改, 不影响调用方的历史消息
+    :param message: list, 上一次请求的message
+    :param content: 被截断的回复
+    :param ctx: TranslationContext, 本次请求的上下文
+    :return: (新的message, 续写时的max_tokens), 续写不再按原文预估, 上下文窗口剩下的token都留给回复
+    """
+    ctx = ctx or TranslationContext.create()
+    message = message + [
+        {"role": "assistant", "content": content},
+        {"role": "user", "content": "Well translated, but the output does not end, please continue the output."},
+    ]
+    delete_oldest_history_message(message, ctx)
+    return message, max(1, ctx.max_tokens - prompt_token_usage(message, ctx))
+
+
+def chat_completion(message, ctx=None, max_tokens=None, **kwargs):
+    """
+    调用ChatCompletion, 由后端路由选择engine的后端(部署/区域/服务), 失败时换下一个后端,
+    请求经过GPT调度器, 按后端的配额排队, 429/5xx时自动退避重试
+    :param message: list, 输入message
+    :param ctx: TranslationContext, 本次请求的上下文, 默认按cfg创建
+    :param max_tokens: 回复的max_tokens, 默认按output_budget根据输入的token数计算
+    :param kwargs: 其他ChatCompletion参数, 如stream
+    :return: ChatCompletion的返回
+    """
+    ctx = ctx or TranslationContext.create()
+    prompt_tokens, budget = output_budget(message, ctx)
+    max_tokens = max_tokens or budget
+    if kwargs.get("stream"):
+        # 流式返回没有usage, prompt按本地计算的token数记录
+        metrics.count_tokens(ctx.engine, "prompt", prompt_tokens)
+    return get_engine_router().call(
+        lambda backend: openai.ChatCompletion.create(
+            **backend.request_params(),
             messages=message,
             temperature=0.5,  # 值在[0,1]之间，越大表示回复越具有不确定性
-            max_tokens=cfg.MAX_TOKENS,  # 回复最大的字符数
+            max_tokens=max_tokens,  # 回复最大的token数
             frequency_penalty=0.0,  # [-2,2]之间，该值越大则更倾向于产生不同的内容
             presence_penalty=0.0,  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-        )
-    content = response['choices'][0].get("message").get("content")
-    translated_result = f"{translated_result}{content}"
+            **kwargs
+        ),
+        ctx.engine, prompt_tokens + max_tokens, ctx.priority, stream=bool(kwargs.get("stream"))
+    )
 
-    while response['choices'][0].get("finish_reason") != "stop":
-        message.append({"role": "assistant", "content": content})
-        message.append({"role": "user", "content": "Well translated, but the output does not end, please continue the output."})
-        delete_oldest_history_message(message)
-        translated_result = gpt_request(message, translated_result)
-        return translated_result
-    return translated_result
+
+def gpt_request(message, ctx=None, max_tokens=None):
+    """
+    gpt3请求, 回复被截断时请求继续输出, 最多续写cfg.MAX_CONTINUATIONS次, 不修改传入的message
+    :param message: list, 输入message
+    :param ctx: TranslationContext, 本次请求的上下文
+    :param max_tokens: 第一次请求回复的max_tokens, 默认按output_budget计算
+    :return: str, 回复文本, 续写的部分直接拼接在后面
+    """
+    contents = []
+    for _ in range(cfg.MAX_CONTINUATIONS + 1):
+        response = chat_completion(message, ctx, max_tokens=max_tokens)
+        choice = response['choices'][0]
+        contents.append(choice.get("message").get("content"))
+        if choice.get("finish_reason") != "length":
+            break
+        message, max_tokens = continue_message(message, contents[-1], ctx)
+    return "".join(contents)
+
+
+def gpt_request_stream(message, ctx=None):
+    """
+    流式gpt请求, 回复被截断时请求继续输出, 最多续写cfg.MAX_CONTINUATIONS次, 不修改传入的message
+    :param message: list, 输入message
+    :param ctx: TranslationContext, 本次请求的上下文
+    :return: 回复文本增量的生成器
+    """
+    ctx = ctx or TranslationContext.create()
+    max_tokens = None
+    for _ in range(cfg.MAX_CONTINUATIONS + 1):
+        content = ""
+        finish_reason = None
+        response = chat_completion(message, ctx, max_tokens=max_tokens, stream=True)
+        start = time.monotonic()
+        for chunk in response:
+            if not chunk['choices']:
+                continue
+            choice = chunk['choices'][0]
+            delta = choice.get("delta", {}).get("content")
+            if delta:
+                content = f"{content}{delta}"
+                yield delta
+            finish_reason = choice.get("finish_reason") or finish_reason
+        metrics.observe_llm(ctx.engine, "generation", time.monotonic() - start)
+        metrics.count_tokens(ctx.engine, "completion", token_usage(content))
+        if finish_reason != "length":
+            return
+        message, max_tokens = continue_message(message, content, ctx)
+
+
+class ResultStreamParser:
+    """
+    从流式返回的{"result": "..."}中增量解析出result字符串的内容
+    """
+    KEY_PATTERN = re.compile(r'"result"\s*:\s*"')
+
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+        self.in_value = False
+        self.finished = False
+
+    def feed(self, delta):
+        """
+        :param delta: 新收到的回复文本
+        :return: 本次新解析出的result文本
+        """
+        self.buffer = f"{self.buffer}{delta}"
+        if self.finished:
+            return ""
+        if not self.in_value:
+            match = self.KEY_PATTERN.search(self.buffer, self.position)
+            if not match:
+                return ""
+            self.in_value = True
+            self.position = match.end()
+        output = []
+        buffer = self.buffer
+        while self.position < len(buffer):
+            char = buffer[self.position]
+            if char == '"':
+                self.finished = True
+                self.position += 1
+                break
+            if char != "\\":
+                output.append(char)
+                self.position += 1
+                continue
+            # 转义字符不完整时等待后续输入, 高位代理项要和后面的低位代理项一起解码
+            if buffer[self.position + 1:self.position + 2] == "u":
+                hex_code = buffer[self.position + 2:self.position + 6].lower()
+                if len(hex_code) < 4:
+                    break
+                escape_length = 12 if "d800" <= hex_code <= "dbff" else 6
+            else:
+                escape_length = 2
+            if self.position + escape_length > len(buffer):
+                break
+            try:
+                output.append(json.loads(f'"{buffer[self.position:self.position + escape_length]}"'))
+            except ValueError:
+                output.append(buffer[self.position:self.position + escape_length])
+            self.position += escape_length
+        return "".join(output)
 
 
-def delete_oldest_history_message(message):
+def delete_oldest_history_message(message, ctx=None, reserve=0):
     """
     如果token不够，删除最久远的历史消息
+    :param message: list, 输入message, 原地修改
+    :param ctx: TranslationContext, 本次请求的上下文
+    :param reserve: 给回复预留的token数
     """
-    message_tokens = token_usage_from_messages(message, cfg.AZURE_GPT_ENGINE)
-    while message_tokens >= cfg.MAX_TOKENS:
-        # 把最久远的上文丢掉, 索引0, 1是init的初始prompt, 索引2是最久远的message
-        message.pop(2)
-        # 重新计算token, 如果token不够，继续丢
-        message_tokens = token_usage_from_messages(message, cfg.AZURE_GPT_ENGINE)
+    ctx = ctx or TranslationContext.create()
+    # 每条消息只计算一次token, 删除时从总数里减掉
+    per_message_tokens = [message_token_usage(item, ctx.engine) for item in message]
+    message_tokens = sum(per_message_tokens) + 3
+    drop = 0
+    # 索引0, 1是init的初始prompt, 索引2开始是历史message, 最后一条是当前要翻译的文本不能丢
+    while message_tokens + reserve >= ctx.max_tokens and 2 + drop < len(message) - 1:
+        message_tokens -= per_message_tokens[2 + drop]
+        drop += 1
+    # 把最久远的上文一次性丢掉
+    del message[2:2 + drop]
+
+
+# 递归匹配最外层的json对象/数组, 模块加载时编译一次
+JSON_PATTERN = regex.compile(r"\{(?:[^{}]|(?R))*\}")
+JSON_ARRAY_PATTERN = regex.compile(r"\[(?:[^\[\]]|(?R))*\]")
 
 
 def json_regex(text):
@@ -144,8 +332,7 @@ def json_regex(text):
     :return: 可json.loads()的json字符串
     """
     try:
-        json_pattern = regex.compile(r"\{(?:[^{}]|(?R))*\}")
-        json_match = json_pattern.search(text)
+        json_match = JSON_PATTERN.search(text)
         json_string = json_match.group(0)
     except Exception as err:
         print(f"json_regex error: {err}")
@@ -153,6 +340,21 @@ def json_regex(text):
     return json_string
 
 
+def json_array_regex(text):
+    """
+    从文本中提取json数组字符串
+    :param text: str, 输入文本
+    :return: 可json.loads()的json数组字符串, 没有则返回空字符串
+    """
+    try:
+        json_match = JSON_ARRAY_PATTERN.search(text)
+        json_string = json_match.group(0)
+    except Exception as err:
+        print(f"json_array_regex error: {err}")
+        json_string = ""
+    return json_string
+
+
 def md5_hash(content):
     """
     计算md5
@@ -166,6 +368,20 @@ def md5_hash(content):
     return md5.hexdigest()
 
 
+def feedback_uid(text, source_lang, target_lang, data_tag="memory"):
+    """
+    人工反馈数据的唯一id, 也是记忆库精确匹配的键
+    :param text: 源语言文本
+    :param source_lang: 源语言
+    :param target_lang: 目标语言
+    :param data_tag: 数据标签, 术语和记忆原文相同时也不会互相覆盖
+    :return: md5 uid
+    """
+    if data_tag == "memory":
+        return md5_hash(f"{text}{source_lang}{target_lang}".lower())
+    return md5_hash(f"{data_tag}:{text}{source_lang}{target_lang}".lower())
+
+
 def format_es_data(source, doc_id):
     """
     格式化es数据
@@ -181,13 +397,25 @@ def format_es_data(source, doc_id):
     }
 
 
+@lru_cache(maxsize=None)
+def get_es_client():
+    """
+    进程内共享的ES客户端, 自带连接池且线程安全, 不必每个请求都新建
+    :return: Elasticsearch
+    """
+    return Elasticsearch(cfg.ELASTIC_SERVER, http_auth=(cfg.ELASTIC_USERNAME, cfg.ELASTIC_PASSWORD))
+
+
 class Elastic:
-    def __init__(self, index):
-        self.es = Elasticsearch(
-            cfg.ELASTIC_SERVER, http_auth=(cfg.ELASTIC_USERNAME, cfg.ELASTIC_PASSWORD)
-        )
+    def __init__(self, index, client=None):
+        """
+        :param index: 索引名
+        :param client: 可传入已有的ES客户端(如utils.stubs.FakeElasticsearch), 默认用进程内共享的客户端
+        """
+        self.es = client if client is not None else get_es_client()
         self.index_name = index
 
+    @metrics.timed("es_search")
     def es_search(self, should_query, top_k=3):
         if not should_query:
             return []
@@ -204,132 +432,199 @@ class Elastic:
         result = response["hits"]["hits"]
         return [item["_source"] for item in result]
 
+    @metrics.timed("es_mget")
+    def mget_sources(self, ids):
+        """
+        按id批量精确查询, 一次请求取回所有文档, 不返回向量字段
+        :param ids: list, 文档id列表
+        :return: 与ids一一对应的_source列表, 不存在的为None
+        """
+        if not ids:
+            return []
+        response = self.es.mget(index=self.index_name, body={"ids": ids}, _source_excludes=["source_vector"])
+        return [item.get("_source") if item.get("found") else None for item in response["docs"]]
+
+    def scan_sources(self, query, size=1000):
+        """
+        用scroll遍历索引里符合条件的全部文档
+        :param query: ES查询条件
+        :param size: 每批拉取条数
+        :return: (文档id, _source)的迭代器
+        """
+        for item in helpers.scan(self.es, index=self.index_name, query={"query": query}, size=size):
+            yield item["_id"], item["_source"]
+
     def insert_into_es(self, row_list, batch=False):
-        try_num = cfg.DATA_INSERT_TRY_NUM
+        """
+        写入数据, 失败时按带抖动的指数退避重试, 最多cfg.DATA_INSERT_TRY_NUM次
+        :param row_list: format_es_data构造的数据列表
+        :param batch: 是否用bulk一次写入
+        """
         if batch:
-            while True:
-                try:
-                    helpers.bulk(self.es, row_list)
-                    break
-                except Exception as err:
-                    print(f"insert data went wrong! detail: {err}")
-                    time.sleep(5)
-                    try_num -= 1
-                    if try_num == 0:
-                        break
+            self._retry_insert(lambda: helpers.bulk(self.es, row_list))
         else:
             for content in row_list:
-                while True:
-                    try:
-                        self.es.index(index=self.index_name, document=content.get("_source"), id=content.get("_id"))
-                        break
-                    except Exception as err:
-                        print(f"insert data went wrong! detail: {err}")
-                        time.sleep(2)
-                        try_num -= 1
-                        if try_num == 0:
-                            break
-                        continue
-
-def force_breakdown(txt, limit, get_token_fn):
-    """
-    当无法用标点、空行分割时，我们用最暴力的方法切割
-    """
-    for i in reversed(range(len(txt))):
-        if get_token_fn(txt[:i]) < limit:
-            return txt[:i], txt[i:]
-    return "Tiktoken未知错误", "Tiktoken未知错误"
-
-
-def cut(txt_tocut, must_break_at_empty_line, limit, break_anyway=False):
-    """
-    递归切分文本
-    :txt_tocut:待切分文本
-    :must_break_at_empty_line:是否切分空行
-    :limit: token限制
-    :break_anyway:是否使用暴力分割
-    :return: 切分后文本列表
-    """
-    if token_usage(txt_tocut) <= limit:
-        return [txt_tocut]
-    else:
-        lines = txt_tocut.split('\n')
-        print(lines)
-        estimated_line_cut = limit / token_usage(txt_tocut) * len(lines)
-        estimated_line_cut = int(estimated_line_cut)
-        cnt = 0
-        for cnt in reversed(range(estimated_line_cut)):
-            if must_break_at_empty_line:
-                if lines[cnt] != "":
-                    continue
-            prev = "\n".join(lines[:cnt])
-            post = "\n".join(lines[cnt:])
-            if token_usage(prev) < limit:
-                break
-        if cnt == 0:
-            if break_anyway:
-                prev, post = force_breakdown(txt_tocut, limit, token_usage)
-            else:
-                raise RuntimeError(f"存在一行极长的文本！{txt_tocut}")
-        result = [prev]
-        result.extend(cut(post, must_break_at_empty_line, limit, break_anyway=break_anyway))
-        return result
-
-def breakdown_text(txt, limit):
-    """
-    用不同的分隔符切分文本
-    :txt:待切分文本
-    :limit: token限制
-    :return: 切分后文本列表
-    """
-    args_list = [txt, txt, txt.replace('.', '。\n'), txt.replace('。', '。。\n')]
-    kwargs_list = [{"must_break_at_empty_line": True,},
-                   {"must_break_at_empty_line": False,},
-                   {"must_break_at_empty_line": False,},
-                   {"must_break_at_empty_line": False}]
-    kwargs_list = [{**kw, "limit": limit} for kw in kwargs_list]
-    count = 0
-    for args, kwargs in zip(args_list, kwargs_list):
-        try:
-            res = cut(args, **kwargs)
-            return res
-        except RuntimeError as e:
-            count += 1
-            if count == 3:
-                return [r.replace('。\n', '.').replace('。', '.') for r in cut(args, **kwargs)]
-            elif count == 4:
-                return [r.replace('。。\n', '。').replace('。。', '。') for r in cut(args, **kwargs)]
-            elif count == 5:
-                return cut(txt, must_break_at_empty_line=False, limit=limit, break_anyway=True)
-            continue
+                self._retry_insert(lambda: self.es.index(index=self.index_name, document=content.get("_source"),
+                                                         id=content.get("_id")))
+
+    @staticmethod
+    def _retry_insert(fn):
+        for attempt in range(cfg.DATA_INSERT_TRY_NUM):
+            try:
+                return fn()
+            except Exception as err:
+                print(f"insert data went wrong! detail: {err}")
+                if attempt + 1 < cfg.DATA_INSERT_TRY_NUM:
+                    time.sleep(backoff_delay(attempt, base=cfg.DATA_INSERT_BACKOFF_BASE, cap=cfg.DATA_INSERT_BACKOFF_MAX))
+
+
+# 句子结尾: 中文句末标点, 或后面跟空白/右引号/中文/结尾的英文句末标点(不切开7.1%、example.com这类)
+SENTENCE_END = re.compile(
+    r'(?:[\u3002\uff01\uff1f]+|\u2026+|[.!?]+(?=[\s"\'\u201d\u2019)\]\uff09\u300d\u300f]|$|[\u3000-\u9fff\uff00-\uffef]))'
+    r'["\'\u201d\u2019)\]\uff09\u300d\u300f]*\s*'
+    r'|\n\s*'
+)
+# 分句: 中文逗号分号等, 或后面跟空白的英文逗号分号冒号(不切开1,000、12:30)
+CLAUSE_END = re.compile(r'(?:[\uff0c\uff1b\uff1a\u3001]+|[,;:](?=\s))["\'\u201d\u2019)\]\uff09]*\s*')
+
+
+class Segment(namedtuple("Segment", ["text", "tokens"])):
+    """
+    切分出的文本片段和它的token数, 片段首尾相接就是原文, 空白都保留在片段末尾
+    """
 
 
-def split_sentences(text):
+def split_by_pattern(text, pattern):
     """
-    使用正则表达式匹配中英文句号进行切割
+    在pattern匹配结束的位置切开文本, 一次扫描, 分隔符和其后的空白留在前一段
     :param text: 待切分文本
-    :return: 切分后文本列表
+    :param pattern: 编译好的分隔符正则
+    :return: 文本片段列表, 拼接后与原文相同
     """
-    sentences = re.split(r'(?<=\D)[\u3002\.](?=\D|$)', text)
-    # 把句号加回去
-    sentences = [f"{item}。" if re.search(r"[\u4e00-\u9fa5]", item) else f"{item}." for item in sentences if item.strip()!=""]
-    return sentences
+    bounds = [0, *(match.end() for match in pattern.finditer(text)), len(text)]
+    return [text[start:end] for start, end in zip(bounds, bounds[1:]) if end > start]
 
 
-def cut_text_as_short_as_possible(text, limit=None):
+def hard_split(text, limit, model="gpt-3.5-turbo"):
+    """
+    没有标点可切时按token边界切分, 整段只编码一次找切点, 优先在空白处切开, 空白留在前一段末尾, 不会切开多字节字符
+    :param text: 待切分文本
+    :param limit: 每段的token限制
+    :param model: 模型名
+    :return: Segment列表
     """
-    将文本切分为尽可能短的句子
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text)
+    data = text.encode("utf-8")
+    offsets = [0]
+    for token in tokens:
+        offsets.append(offsets[-1] + len(encoding.decode_single_token_bytes(token)))
+    # 切点的字节必须是一个字符的开头, 不能是utf-8的后续字节
+    is_char_start = lambda index: index == len(tokens) or data[offsets[index]] & 0xC0 != 0x80
+    segments, start, start_byte = [], 0, 0
+    while start < len(tokens):
+        end = min(start + limit, len(tokens))
+        end_byte = offsets[end]
+        if end < len(tokens):
+            # 在最后1/4的范围内找以空白开头的token, 在空白之后切开; 留一个token的余量给移到段末的空白
+            for candidate in range(end - 1, max(start, end - 1 - max(1, limit // 4)), -1):
+                whitespace_end = offsets[candidate]
+                while whitespace_end < len(data) and data[whitespace_end:whitespace_end + 1].isspace():
+                    whitespace_end += 1
+                if whitespace_end > offsets[candidate]:
+                    end, end_byte = candidate, whitespace_end
+                    break
+            else:
+                while end > start + 1 and not is_char_start(end):
+                    end -= 1
+                while not is_char_start(end):
+                    end += 1
+                end_byte = offsets[end]
+        piece = data[start_byte:end_byte].decode("utf-8")
+        piece_tokens = len(encoding.encode(piece))
+        if piece_tokens > limit and end_byte > offsets[end]:
+            # 空白单独编码后超限时退回token边界, 空白留给下一段
+            end_byte = offsets[end]
+            piece = data[start_byte:end_byte].decode("utf-8")
+            piece_tokens = len(encoding.encode(piece))
+        segments.append(Segment(piece, piece_tokens))
+        # 空白可能跨过几个token, 下一段从包含end_byte的token开始计
+        while end < len(tokens) and offsets[end + 1] <= end_byte:
+            end += 1
+        start, start_byte = end, end_byte
+    return segments
+
+
+@metrics.timed("segmentation")
+def split_segments(text, limit=None, model="gpt-3.5-turbo"):
+    """
+    单次扫描把文本切分为带token数的句子片段: 段落/句子 -> 分句 -> 按token硬切, 只有超过limit的片段才继续往下切,
+    每个片段都不超过limit, 片段拼接后与原文完全相同(包括空白)
     :param text: 待切分文本
-    :param limit: token限制
-    :return: 切分后文本列表
+    :param limit: token限制, 默认cfg.TEXT_TOKEN_LIMIT
+    :param model: 模型名
+    :return: Segment列表, 整段不超过limit时只有一个片段
+    """
+    limit = limit or cfg.TEXT_TOKEN_LIMIT
+    if not text:
+        return []
+    sentences = split_by_pattern(text, SENTENCE_END)
+    sentence_tokens = token_usage_batch(sentences, model)
+    # 整段的token数一般不多于各句之和, 只有各句加起来不大时才再编码整段, 长文档不会把全文编码两遍
+    if sum(sentence_tokens) <= 2 * limit:
+        total_tokens = token_usage(text, model)
+        if total_tokens <= limit:
+            return [Segment(text, total_tokens)]
+    segments = []
+    for sentence, tokens in zip(sentences, sentence_tokens):
+        if tokens <= limit:
+            segments.append(Segment(sentence, tokens))
+            continue
+        clauses = split_by_pattern(sentence, CLAUSE_END)
+        for clause, clause_tokens in zip(clauses, token_usage_batch(clauses, model)):
+            if clause_tokens <= limit:
+                segments.append(Segment(clause, clause_tokens))
+            else:
+                segments.extend(hard_split(clause, limit, model))
+    return segments
+
+
+def pack_chunks(text_list, limit, tokens=None):
+    """
+    按token限制把句子列表贪心地打包成文本块, 不会切开句子; 顺序不变时贪心得到的文本块数最少
+    :param text_list: list, 句子列表
+    :param limit: int, 每个文本块的token限制
+    :param tokens: list, 每个句子的token数, 不传时在这里批量计算
+    :return: 文本块列表
+    """
+    tokens = token_usage_batch(text_list) if tokens is None else tokens
+    chunks = []
+    chunk, chunk_tokens = [], 0
+    for text, text_tokens in zip(text_list, tokens):
+        # 当前块加上这句会超限, 先把当前块收起来
+        if chunk and chunk_tokens + text_tokens > limit:
+            chunks.append("".join(chunk))
+            chunk, chunk_tokens = [], 0
+        chunk.append(text)
+        chunk_tokens += text_tokens
+    if chunk:
+        chunks.append("".join(chunk))
+    return chunks
+
+
+def pack_segments(segments, limit):
+    """
+    把split_segments的结果打包成文本块, 直接使用片段上已有的token数
+    :param segments: Segment列表
+    :param limit: int, 每个文本块的token限制
+    :return: 文本块列表
     """
-    cfg.TEXT_TOKEN_LIMIT = limit if limit else cfg.TEXT_TOKEN_LIMIT
-    return [text] if token_usage(text) <= cfg.TEXT_TOKEN_LIMIT else split_sentences(text)
+    return pack_chunks([segment.text for segment in segments], limit, [segment.tokens for segment in segments])
 
 
 if __name__ == '__main__':
     test = "值得注意的是，《意见》还提到，要扎实做好稳地价、稳[房价]、稳预期工作，稳妥有序推进房地产风险化解处置。严格落实地方政府债务限额管理，坚决遏制新增隐性债务。\n\n**“[中特估]”又飙了**\n\n**值得注意的是，今天 中特估这个板块又飙了，可以说对市场起到了较大的支撑作用。**\n\n![]\n\n那么，究竟是何缘故呢？\n\n首先，从财政部的数据来看，1—4月，国有企业营业总收入262281.9亿元，同比增长7.1%。从利润总额来看，1—4月，国有企业利润总额14388.1亿元，同比增长15.1%。Microglia belong to tissue-resident macrophages of the central nervous system (CNS), representing the primary innate immune cells. This cell type constitutes ~7% of non-neuronal cells in the mammalian brain and has a variety of biological roles integral to homeostasis and pathophysiology from the late embryonic to adult brain. Its unique identity that distinguishes its \"glial\" features from tissue-resident macrophages resides in the fact that once entering the CNS, it is perennially exposed to a unique environment following the formation of the blood-brain barrier. Additionally, tissue-resident macrophage progenies derive from various peripheral sites that exhibit hematopoietic potential, and this has resulted in interpretation issues surrounding their origin. "
-    result = cut_text_as_short_as_possible(test, limit=100)
+    result = split_segments(test, limit=100)
     print(result)
 
 
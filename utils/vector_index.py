@@ -0,0 +1,244 @@
+"""
+进程内向量索引, 用于记忆库的相似度检索, 代替ES里逐条扫描的cosineSimilarity script_score
+flat: numpy暴力内积, 精确; ivf: k-means粗聚类后只扫nprobe个簇; hnsw: 需要安装hnswlib
+"""
+import threading
+
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+def normalize(vectors):
+    """
+    L2归一化, 归一化后内积即为余弦相似度
+    :param vectors: 二维向量数组
+    :return: 归一化后的float32数组
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class FlatIndex:
+    def __init__(self, dim):
+        """
+        :param dim: 向量维度
+        """
+        self.dim = dim
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self.size = 0
+        self.ids = []
+        self.payloads = []
+        self.id_rows = {}
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return self.size
+
+    def add(self, ids, vectors, payloads):
+        """
+        批量加入向量, id已存在时覆盖
+        :param ids: 文档id列表
+        :param vectors: 向量列表
+        :param payloads: 每个向量对应的数据
+        :return: 新写入(或覆盖)的行号列表
+        """
+        vectors = normalize(vectors)
+        rows = []
+        with self.lock:
+            for doc_id, vector, payload in zip(ids, vectors, payloads):
+                row = self.id_rows.get(doc_id)
+                if row is None:
+                    row = self.size
+                    self._reserve(row + 1)
+                    self.size += 1
+                    self.ids.append(doc_id)
+                    self.payloads.append(payload)
+                    self.id_rows[doc_id] = row
+                else:
+                    self.payloads[row] = payload
+                self.vectors[row] = vector
+                rows.append(row)
+        return rows
+
+    def _reserve(self, capacity):
+        # 按倍数扩容, 逐条加入时均摊O(1)
+        if capacity <= len(self.vectors):
+            return
+        new_capacity = max(capacity, len(self.vectors) * 2, 1024)
+        vectors = np.empty((new_capacity, self.dim), dtype=np.float32)
+        vectors[:self.size] = self.vectors[:self.size]
+        self.vectors = vectors
+
+    def search(self, queries, top_k=1):
+        """
+        批量检索最相似的top_k条
+        :param queries: 查询向量列表
+        :param top_k: 返回条数
+        :return: 每个查询一个列表, 元素为(余弦相似度, payload)
+        """
+        queries = normalize(queries)
+        with self.lock:
+            if not self.size:
+                return [[] for _ in range(len(queries))]
+            scores = queries @ self.vectors[:self.size].T
+            return [self._top_k(row_scores, np.arange(self.size), top_k) for row_scores in scores]
+
+    def _top_k(self, scores, rows, top_k):
+        top_k = min(top_k, len(scores))
+        if not top_k:
+            return []
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[index]), self.payloads[rows[index]]) for index in best]
+
+
+class IVFIndex(FlatIndex):
+    def __init__(self, dim, nlist=None, nprobe=None):
+        """
+        :param dim: 向量维度
+        :param nlist: 聚类中心数, 默认按数据量取sqrt(n)
+        :param nprobe: 每次检索扫描的簇数
+        """
+        super().__init__(dim)
+        self.nlist = nlist
+        self.nprobe = nprobe or 8
+        self.centroids = None
+        self.assignments = np.empty(0, dtype=np.int32)
+        self.lists = []
+
+    def add(self, ids, vectors, payloads):
+        with self.lock:
+            rows = super().add(ids, vectors, payloads)
+            if self.centroids is None:
+                return rows
+            self._reserve_assignments()
+            assigned = self._assign(self.vectors[rows])
+            for row, cluster in zip(rows, assigned):
+                old = self.assignments[row]
+                if old >= 0:
+                    self.lists[old] = self.lists[old][self.lists[old] != row]
+                self.assignments[row] = cluster
+                self.lists[cluster] = np.append(self.lists[cluster], row)
+            return rows
+
+    def _reserve_assignments(self):
+        if len(self.assignments) < self.size:
+            assignments = np.full(len(self.vectors), -1, dtype=np.int32)
+            assignments[:len(self.assignments)] = self.assignments
+            self.assignments = assignments
+
+    def _assign(self, vectors):
+        return np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+    def train(self, iterations=10, sample_size=50000, seed=0):
+        """
+        用球面k-means训练聚类中心, 并把已有向量分配到各簇
+        """
+        with self.lock:
+            if not self.size:
+                return
+            vectors = self.vectors[:self.size]
+            nlist = self.nlist or max(1, int(np.sqrt(self.size)))
+            nlist = min(nlist, self.size)
+            rng = np.random.default_rng(seed)
+            sample = vectors[rng.choice(self.size, min(sample_size, self.size), replace=False)]
+            centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+            for _ in range(iterations):
+                assigned = np.argmax(sample @ centroids.T, axis=1)
+                for cluster in range(nlist):
+                    members = sample[assigned == cluster]
+                    if len(members):
+                        centroids[cluster] = members.mean(axis=0)
+                centroids = normalize(centroids)
+            self.centroids = centroids
+            self.assignments = np.full(len(self.vectors), -1, dtype=np.int32)
+            self.assignments[:self.size] = self._assign(vectors)
+            order = np.argsort(self.assignments[:self.size], kind="stable")
+            bounds = np.searchsorted(self.assignments[:self.size][order], np.arange(nlist + 1))
+            self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(nlist)]
+
+    def search(self, queries, top_k=1):
+        with self.lock:
+            if self.centroids is None:
+                self.train()
+            if not self.size:
+                return [[] for _ in range(len(normalize(queries)))]
+            queries = normalize(queries)
+            nprobe = min(self.nprobe, len(self.centroids))
+            probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :nprobe]
+            results = []
+            for query, clusters in zip(queries, probes):
+                rows = np.concatenate([self.lists[cluster] for cluster in clusters])
+                scores = self.vectors[rows] @ query
+                results.append(self._top_k(scores, rows, top_k))
+            return results
+
+
+class HNSWIndex:
+    def __init__(self, dim, m=16, ef_construction=200, ef_search=64):
+        """
+        hnswlib封装, 需要pip install hnswlib
+        """
+        if hnswlib is None:
+            raise ImportError("hnsw vector index requires hnswlib, please `pip install hnswlib`")
+        self.dim = dim
+        self.index = hnswlib.Index(space="cosine", dim=dim)
+        self.index.init_index(max_elements=1024, ef_construction=ef_construction, M=m)
+        self.index.set_ef(ef_search)
+        self.labels = {}
+        self.payloads = []
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.payloads)
+
+    def add(self, ids, vectors, payloads):
+        vectors = normalize(vectors)
+        with self.lock:
+            labels = []
+            for doc_id, payload in zip(ids, payloads):
+                label = self.labels.get(doc_id)
+                if label is None:
+                    label = len(self.payloads)
+                    self.labels[doc_id] = label
+                    self.payloads.append(payload)
+                else:
+                    self.payloads[label] = payload
+                labels.append(label)
+            if len(self.payloads) > self.index.get_max_elements():
+                self.index.resize_index(max(len(self.payloads), self.index.get_max_elements() * 2))
+            self.index.add_items(vectors, labels)
+            return labels
+
+    def search(self, queries, top_k=1):
+        queries = normalize(queries)
+        with self.lock:
+            if not self.payloads:
+                return [[] for _ in range(len(queries))]
+            labels, distances = self.index.knn_query(queries, k=min(top_k, len(self.payloads)))
+            return [[(1.0 - float(distance), self.payloads[label]) for label, distance in zip(row_labels, row_distances)]
+                    for row_labels, row_distances in zip(labels, distances)]
+
+
+def build_index(index_type, dim):
+    """
+    按类型创建向量索引
+    :param index_type: flat/ivf/hnsw
+    :param dim: 向量维度
+    :return: 向量索引
+    """
+    if index_type == "flat":
+        return FlatIndex(dim)
+    if index_type == "ivf":
+        return IVFIndex(dim)
+    if index_type == "hnsw":
+        return HNSWIndex(dim)
+    raise ValueError(f"unknown vector index type: {index_type}")